@@ -25,11 +25,26 @@ def extract_data_func(args):
             args.patch_size,
             args.stride_size,
             args.slice_direction,
-            args.slice_mode
+            args.slice_mode,
+            args.packed,
+            args.storage_dtype,
+            args.compress
             )
     wf.run(plugin='MultiProc', plugin_args={'n_procs': args.nproc})
 
 
+def pack_data_func(args):
+    from .tools.deep_learning.data import pack_cohort
+
+    pack_cohort(
+        args.caps_dir,
+        args.tsv_file,
+        args.output_path,
+        preprocessing=args.preprocessing,
+        dtype=args.dtype
+    )
+
+
 def generate_data_func(args):
     from .tools.data.generate_data import generate_random_dataset, generate_trivial_dataset
 
@@ -57,6 +72,44 @@ def generate_data_func(args):
         )
 
 
+def training_resource_plan(args):
+    """
+    Splits the cores between the data loading workers and the compute threads of a training.
+    The folds and the CNNs of a multi-CNN trained in parallel each have their own workers and threads.
+    """
+    from .tools.deep_learning.resources import plan_resources
+
+    num_threads = args.num_threads
+    n_processes = 1
+    if (args.mode == 'patch' and not args.train_autoencoder and args.network_type == 'multi'
+            and not args.multihead and args.num_parallel_cnn > 1):
+        n_processes = args.num_parallel_cnn
+        if args.threads_per_cnn > 0:
+            num_threads = args.threads_per_cnn
+    if args.num_parallel_folds > 1:
+        n_processes *= args.num_parallel_folds
+
+    return plan_resources(args.nproc, num_threads, args.num_interop_threads, args.pin_workers, n_processes)
+
+
+def run_training(train_function, params, args):
+    """
+    Runs train_function on params, or trains all the folds in parallel processes if num_parallel_folds > 1.
+    """
+    from .tools.deep_learning.cross_validation import run_folds
+
+    if args.num_parallel_folds > 1:
+        if args.n_splits is None:
+            raise ValueError("The folds can only be trained in parallel in a k-fold cross-validation (n_splits).")
+        failed_folds = run_folds(train_function, params, range(args.n_splits), args.num_parallel_folds,
+                                 n_threads=params.resource_plan['num_threads'], retries=args.fold_retries)
+        if len(failed_folds) > 0:
+            raise Exception("The training of the folds %s failed. Each of them can be trained again on its own "
+                            "with --split." % str(failed_folds))
+    else:
+        train_function(params)
+
+
 # Function to dispatch training to corresponding function
 def train_func(args):
     from .subject_level.train_autoencoder import train_autoencoder
@@ -66,6 +119,8 @@ def train_func(args):
     from .patch_level.train_singleCNN import train_patch_single_cnn
     from .patch_level.train_multiCNN import train_patch_multi_cnn
 
+    resource_plan = training_resource_plan(args)
+
     if args.mode == 'subject':
         if args.train_autoencoder:
             train_params_autoencoder = Parameters(
@@ -95,9 +150,10 @@ def train_func(args):
                     gpu=args.use_gpu,
                     batch_size=args.batch_size,
                     evaluation_steps=args.evaluation_steps,
-                    num_workers=args.nproc
+                    num_workers=args.nproc,
+                    resource_plan=resource_plan
                     )
-            train_autoencoder(train_params_autoencoder)
+            run_training(train_autoencoder, train_params_autoencoder, args)
         else:
             train_params_cnn = Parameters(
                     args.tsv_path,
@@ -124,14 +180,21 @@ def train_func(args):
                     optimizer='Adam',
                     weight_decay=args.weight_decay,
                     gpu=args.use_gpu,
+                    precision=args.precision,
                     batch_size=args.batch_size,
                     evaluation_steps=args.evaluation_steps,
                     num_workers=args.nproc,
+                    resource_plan=resource_plan,
                     transfer_learning_path=args.transfer_learning_path,
                     transfer_learning_autoencoder=args.transfer_learning_autoencoder,
-                    selection=args.selection
+                    selection=args.selection,
+                    cohort_path=args.cohort_path,
+                    feature_cache=args.feature_cache,
+                    feature_cache_dtype=args.feature_cache_dtype,
+                    train_probe_size=args.train_probe_size,
+                    train_probe_frequency=args.train_probe_frequency
                     )
-            train_cnn(train_params_cnn)
+            run_training(train_cnn, train_params_cnn, args)
     elif args.mode == 'slice':
         train_params_slice = Parameters(
                 args.tsv_path,
@@ -141,6 +204,9 @@ def train_func(args):
                 )
         train_params_slice.write(
                 mri_plane=args.mri_plane,
+                foreground_threshold=args.foreground_threshold,
+                feature_cache=args.feature_cache,
+                feature_cache_dtype=args.feature_cache_dtype,
                 diagnoses=args.diagnoses,
                 baseline=args.baseline,
                 learning_rate=args.learning_rate,
@@ -153,11 +219,17 @@ def train_func(args):
                 optimizer='Adam',
                 weight_decay=args.weight_decay,
                 gpu=args.use_gpu,
+                precision=args.precision,
                 num_workers=args.nproc,
+                resource_plan=resource_plan,
                 selection_threshold=args.selection_threshold,
-                prepare_dl=args.use_extracted_patches
+                prepare_dl=args.use_extracted_patches,
+                sampler=args.sampler,
+                image_cache_size=args.image_cache_size,
+                train_probe_size=args.train_probe_size,
+                train_probe_frequency=args.train_probe_frequency
                 )
-        train_slice(train_params_slice)
+        run_training(train_slice, train_params_slice, args)
     elif args.mode == 'patch':
         if args.train_autoencoder:
             train_params_autoencoder = Parameters(
@@ -173,7 +245,7 @@ def train_func(args):
                     diagnoses=args.diagnoses,
                     baseline=args.baseline,
                     minmaxnormalization=args.minmaxnormalization,
-                    sampler='random',
+                    sampler=args.sampler,
                     n_splits=args.n_splits,
                     split=args.split,
                     accumulation_steps=args.accumulation_steps,
@@ -188,13 +260,18 @@ def train_func(args):
                     batch_size=args.batch_size,
                     evaluation_steps=args.evaluation_steps,
                     num_workers=args.nproc,
+                    resource_plan=resource_plan,
                     patch_size=args.patch_size,
                     patch_stride=args.patch_stride,
                     hippocampus_roi=args.hippocampus_roi,
                     visualization=args.visualization,
-                    prepare_dl=args.use_extracted_patches
+                    prepare_dl=args.use_extracted_patches,
+                    packed_patches=args.packed_patches,
+                    image_cache_size=args.image_cache_size,
+                    train_probe_size=args.train_probe_size,
+                    train_probe_frequency=args.train_probe_frequency
                     )
-            train_autoencoder_patch(train_params_autoencoder)
+            run_training(train_autoencoder_patch, train_params_autoencoder, args)
         else:
             train_params_patch = Parameters(
                     args.tsv_path,
@@ -209,7 +286,7 @@ def train_func(args):
                     diagnoses=args.diagnoses,
                     baseline=args.baseline,
                     minmaxnormalization=args.minmaxnormalization,
-                    sampler='random',
+                    sampler=args.sampler,
                     n_splits=args.n_splits,
                     split=args.split,
                     accumulation_steps=args.accumulation_steps,
@@ -221,9 +298,11 @@ def train_func(args):
                     optimizer='Adam',
                     weight_decay=args.weight_decay,
                     gpu=args.use_gpu,
+                    precision=args.precision,
                     batch_size=args.batch_size,
                     evaluation_steps=args.evaluation_steps,
                     num_workers=args.nproc,
+                    resource_plan=resource_plan,
                     transfer_learning_path=args.transfer_learning_path,
                     transfer_learning_autoencoder=args.transfer_learning_autoencoder,
                     transfer_learning_multicnn=args.transfer_learning_multicnn,
@@ -231,14 +310,24 @@ def train_func(args):
                     patch_size=args.patch_size,
                     patch_stride=args.patch_stride,
                     hippocampus_roi=args.hippocampus_roi,
+                    feature_cache=args.feature_cache,
+                    feature_cache_dtype=args.feature_cache_dtype,
                     selection_threshold=args.selection_threshold,
                     num_cnn=args.num_cnn,
-                    prepare_dl=args.use_extracted_patches
+                    num_parallel_cnn=args.num_parallel_cnn,
+                    threads_per_cnn=args.threads_per_cnn,
+                    multihead=args.multihead,
+                    patch_occupancy_threshold=args.patch_occupancy_threshold,
+                    prepare_dl=args.use_extracted_patches,
+                    packed_patches=args.packed_patches,
+                    image_cache_size=args.image_cache_size,
+                    train_probe_size=args.train_probe_size,
+                    train_probe_frequency=args.train_probe_frequency
                     )
             if args.network_type == 'single':
-                train_patch_single_cnn(train_params_patch)
+                run_training(train_patch_single_cnn, train_params_patch, args)
             else:
-                train_patch_multi_cnn(train_params_patch)
+                run_training(train_patch_multi_cnn, train_params_patch, args)
     elif args.mode == 'svn':
         pass
 
@@ -250,7 +339,20 @@ def train_func(args):
 
 
 def classify_func(args):
-    pass
+    from .tools.deep_learning.inference import classify
+
+    classify(
+            args.caps_dir,
+            args.tsv_path,
+            args.output_dir,
+            args.network_dir,
+            mode=args.mode,
+            selection=args.selection,
+            batch_size=args.batch_size,
+            num_workers=args.nproc,
+            gpu=args.use_gpu,
+            precision=args.precision
+            )
 
 
 def parse_command_line():
@@ -427,16 +529,37 @@ def parse_command_line():
             help='''Slice direction (only for 'slice' extraction). Three options:
                  '0' -> Sagittal plane,
                  '1' -> Coronal plane or
-                 '2' -> Axial plane''',
-            type=int, default=0
+                 '2' -> Axial plane.
+                 Several directions can be given (e.g. -sd 0 1 2), they are then
+                 extracted from one load of each image.''',
+            type=int, nargs='+', choices=[0, 1, 2], default=[0]
             )
     extract_parser.add_argument(
             '-sm', '--slice_mode',
             help='''Slice mode (only for 'slice' extraction). Two options:
                  'original' to save one single channel (intensity),
-                 'rgb' to saves three channel (with same intensity).''',
+                 'rgb' to save the normalized intensity used as the three channels
+                 (red, green, blue) of the image, stored with one channel.''',
             choices=['original', 'rgb'], default='rgb'
             )
+    extract_parser.add_argument(
+            '-pk', '--packed',
+            help='''Save all the patches of a session in one memory-mappable
+                 array instead of one file per patch (only for 'patch' extraction).''',
+            action='store_true', default=False
+            )
+    extract_parser.add_argument(
+            '--storage_dtype',
+            help='''Dtype of the saved tensors. 'uint16' and 'uint8' quantize each
+                 tensor between its minimum and maximum values. All the tensors are
+                 decoded to float32 when they are loaded.''',
+            choices=['float32', 'float16', 'uint16', 'uint8'], default='float32'
+            )
+    extract_parser.add_argument(
+            '--compress',
+            help='''Compress the saved tensors with zlib.''',
+            action='store_true', default=False
+            )
     extract_parser.add_argument(
             '-np', '--nproc',
             help='Number of cores used for processing',
@@ -445,6 +568,42 @@ def parse_command_line():
 
     extract_parser.set_defaults(func=extract_data_func)
 
+    # Preprocessing 3 - Pack data: whole MRI of a cohort in one array
+    # pack_parser: get command line argument and options
+
+    pack_parser = subparser.add_parser(
+            'pack',
+            help='Pack the whole MRI of a cohort in one memory-mappable array.'
+            )
+    pack_parser.add_argument(
+            'caps_dir',
+            help='Data using CAPS structure.',
+            default=None
+            )
+    pack_parser.add_argument(
+            'tsv_file',
+            help='tsv file with sujets/sessions to pack.',
+            default=None
+            )
+    pack_parser.add_argument(
+            'output_path',
+            help='''Path to the output .npy array. The index of the sessions is
+                 written next to it with the .tsv extension.''',
+            default=None
+            )
+    pack_parser.add_argument(
+            '--preprocessing',
+            help='Defines the type of preprocessing of CAPS data.',
+            choices=['linear', 'mni'], type=str, default='linear'
+            )
+    pack_parser.add_argument(
+            '--dtype',
+            help='Type of the values stored in the array.',
+            choices=['float32', 'float16'], type=str, default='float32'
+            )
+
+    pack_parser.set_defaults(func=pack_data_func)
+
     # Train - Train CNN model with preprocessed  data
     # train_parser: get command line arguments and options
 
@@ -479,10 +638,30 @@ def parse_command_line():
             '-gpu', '--use_gpu', action='store_true',
             help='Uses GPU instead of CPU if CUDA is available',
             default=False)
+    train_parser.add_argument(
+            '--precision',
+            help='Precision of the forward passes during the training of CNNs. With bf16 the convolutions and '
+                 'matrix multiplications run in bfloat16 with autocast, the weights stay in float32.',
+            choices=['fp32', 'bf16'], type=str,
+            default='fp32')
     train_parser.add_argument(
             '-np', '--nproc',
             help='Number of cores used during the training.',
             type=int, default=2)
+    train_parser.add_argument(
+            '--num_threads',
+            help='Number of intra-op threads of PyTorch (0 gives to the computation all the cores '
+                 'not used by the --nproc data loading workers).',
+            type=int, default=0)
+    train_parser.add_argument(
+            '--num_interop_threads',
+            help='Number of inter-op threads of PyTorch (0 keeps the default of PyTorch).',
+            type=int, default=0)
+    train_parser.add_argument(
+            '--pin_workers',
+            help='Pins the data loading workers and the computation to separate cores.',
+            action="store_true",
+            default=False)
     train_parser.add_argument(
             '--visualization',
             help='Save results in visualization folder',
@@ -527,6 +706,17 @@ def parse_command_line():
             '--split',
             help='Will load the specific split wanted.',
             type=int, default=0)
+    train_parser.add_argument(
+            '--num_parallel_folds',
+            help='''Number of folds trained at the same time in separate processes.
+                 If greater than 1 all the folds of n_splits are trained, and
+                 their metrics are gathered in performances/cross_validation.''',
+            default=1, type=int)
+    train_parser.add_argument(
+            '--fold_retries',
+            help='''Number of times a fold whose training failed is trained again
+                 (applies only with num_parallel_folds).''',
+            default=0, type=int)
 
     # Training arguments
     train_parser.add_argument(
@@ -549,6 +739,30 @@ def parse_command_line():
             help='''How many CNNs we want to train in a patch-wise way.
                  By default, we train each patch from all subjects for one CNN''',
             default=36, type=int)
+    train_parser.add_argument(
+            '--num_parallel_cnn',
+            help='''Number of CNNs trained at the same time in separate processes
+                 (applies only for multi-CNN patch-level).''',
+            default=1, type=int)
+    train_parser.add_argument(
+            '--threads_per_cnn',
+            help='''Number of CPU threads used by each CNN trained in parallel
+                 (0 keeps the default of PyTorch).''',
+            default=0, type=int)
+    train_parser.add_argument(
+            '--multihead',
+            help='''Train the CNNs of a multi-CNN together as the heads of one
+                 model, loading each session once per epoch (applies only for
+                 multi-CNN patch-level with Conv4_FC3). A batch then contains
+                 all the patches of batch_size sessions.''',
+            default=False, action="store_true")
+    train_parser.add_argument(
+            '--patch_occupancy_threshold',
+            help='''Exclude the patches whose mean fraction of foreground voxels
+                 in the training set is lower than this threshold (only for
+                 patch-level). The excluded patches are recorded for the
+                 evaluation and the voting.''',
+            default=0, type=float)
     train_parser.add_argument(
             '--mri_plane',
             help='''Which coordinate axis to take for slicing the MRI.
@@ -556,9 +770,33 @@ def parse_command_line():
                  1 for coronal
                  2 for axial direction.''',
             default=0, type=int)
+    train_parser.add_argument(
+            '--foreground_threshold',
+            help='''Skip the slices whose fraction of foreground voxels is lower
+                 than this threshold (only for slice-level). The fractions are
+                 read from the metadata written by extract.''',
+            default=0, type=float)
+    train_parser.add_argument(
+            '--feature_cache',
+            help='''Folder in which the outputs of the frozen layers are stored.
+                 They are computed once per input and reused by all folds and
+                 epochs. For slice-level the first layers of resnet18 are
+                 frozen and the training only runs layer4 and the FC layers.
+                 For subject and patch-level the convolutional layers,
+                 initialized with transfer learning (typically from an
+                 autoencoder), are frozen and only the FC layers are trained.''',
+            default=None, type=str)
+    train_parser.add_argument(
+            '--feature_cache_dtype',
+            help='Type of the cached features.',
+            choices=['float16', 'float32'],
+            default='float16', type=str)
     train_parser.add_argument(
             '--sampler', '-sm',
-            help='Sampler to be used.',
+            help='''Sampler to be used. 'random' shuffles all the elements,
+                 'grouped' shuffles the images and yields the patches / slices of
+                 an image consecutively (to be used with --image_cache_size).''',
+            choices=['random', 'grouped'],
             default='random', type=str)
     train_parser.add_argument(
             '--accumulation_steps', '-asteps',
@@ -637,6 +875,33 @@ def parse_command_line():
             help='''If True the outputs of preprocessing are used, else the whole
                  MRI is loaded.''',
             default=False, action="store_true")
+    train_parser.add_argument(
+            '--image_cache_size',
+            help='''Memory budget in MB of the cache of whole images of each data
+                 loading worker, used when the patches / slices are extracted on
+                 the fly (0 disables the cache).''',
+            type=int, default=0)
+    train_parser.add_argument(
+            '--packed_patches',
+            help='''If True the extracted patches are read from the packed array
+                 of each session (see the --packed option of extract).''',
+            default=False, action="store_true")
+    train_parser.add_argument(
+            '--cohort_path',
+            help='''Path to a cohort array written by the pack command. If given,
+                 the whole MRI are read from this array (only for 'subject' mode).''',
+            type=str, default=None)
+    train_parser.add_argument(
+            '--train_probe_size',
+            help='''Number of training sessions on which the training metrics are
+                 evaluated. If 0 the training metrics are computed during the
+                 training pass instead of evaluating the whole training set.''',
+            type=int, default=0)
+    train_parser.add_argument(
+            '--train_probe_frequency',
+            help='''The train probe is evaluated once every train_probe_frequency
+                 evaluations, the metrics of the training pass are used otherwise.''',
+            type=int, default=1)
     train_parser.set_defaults(func=train_func)
 
     # Classify - Classify a subject or a list of tesv files with the CNN
@@ -649,8 +914,10 @@ def parse_command_line():
                  trained model.''')
     classify_parser.add_argument(
             'mode',
-            help='Choose your mode (subject level, slice level, patch level, svm).',
-            choices=['subject', 'slice', 'patch', 'svm'],
+            help='''Mode of the training whose models are used (subject level or
+                 patch level). The classification is not implemented for the
+                 other modes.''',
+            choices=['subject', 'patch'],
             default='subject')
     classify_parser.add_argument(
             'caps_dir',
@@ -662,12 +929,35 @@ def parse_command_line():
             default=None)
     classify_parser.add_argument(
             'output_dir',
-            help='Folder containing results of the training.',
+            help='Folder in which the results of the classification are written.',
             default=None)
     classify_parser.add_argument(
             'network_dir',
-            help='Model to use during classification.',
+            help='''Output folder of the training whose models are used. The
+                 models of all the folds are loaded once and their
+                 probabilities are averaged.''',
             default=None)
+    classify_parser.add_argument(
+            '--selection',
+            help='Model of each fold which is loaded.',
+            type=str, default='best_loss', choices=['best_loss', 'best_acc'])
+    classify_parser.add_argument(
+            '--batch_size',
+            help='Number of sessions classified in a batch.',
+            type=int, default=8)
+    classify_parser.add_argument(
+            '-np', '--nproc',
+            help='Number of cores used to load the data.',
+            type=int, default=2)
+    classify_parser.add_argument(
+            '-gpu', '--use_gpu', action='store_true',
+            help='Uses GPU instead of CPU if CUDA is available',
+            default=False)
+    classify_parser.add_argument(
+            '--precision',
+            help='Precision of the forward passes (bf16 runs them in bfloat16 with autocast).',
+            choices=['fp32', 'bf16'], type=str,
+            default='fp32')
 
     classify_parser.set_defaults(func=classify_func)
 
@@ -16,7 +16,10 @@ def main():
 
     arguments = vars(args)
 
-    if (arguments['task'] != 'preprocessing') and (arguments['task'] != 'extract') and (arguments['task'] != 'generate'):
+    if arguments['task'] not in ['preprocessing', 'extract', 'pack', 'generate', 'classify']:
+        if arguments['task'] == 'train' and arguments['mode'] != 'svm':
+            # the split of the cores used by the training is logged with the options
+            commandline[0].resource_plan = cli.training_resource_plan(args)
         commandline_to_json(commandline, model_type)
 
     args.func(args)
@@ -4,7 +4,7 @@ import torch
 import torchvision.transforms as transforms
 from torch.utils.data import DataLoader
 
-from utils import MRIDataset_patch, test, patch_level_to_tsvs, soft_voting_to_tsvs
+from utils import MRIDataset_patch, test, patch_level_to_tsvs, soft_voting_to_tsvs, selected_patches
 from clinicadl.tools.deep_learning.models import create_model, load_model
 from clinicadl.tools.deep_learning.data import MinMaxNormalization, load_data, load_data_test
 
@@ -43,6 +43,8 @@ parser.add_argument("--split", default=None, type=int,
                     help="Default behaviour will run all splits, else only the splits specified will be run.")
 parser.add_argument('--prepare_dl', default=False, action="store_true",
                     help="If True the outputs of preprocessing prepare_dl are used, else the whole MRI is loaded.")
+parser.add_argument('--packed_patches', default=False, action="store_true",
+                    help="If True the patches are read from the packed array of each session written by extract.")
 
 # test arguments
 parser.add_argument("--network", default="Conv4_FC3",
@@ -88,7 +90,12 @@ def main(options):
         else:
             test_df = load_data_test(options.diagnosis_tsv_path, options.diagnoses)
 
-        for n in range(options.num_cnn):
+        # the CNNs of the patches excluded during the training were not trained
+        cnn_indices = selected_patches(options.output_dir, fi)
+        if cnn_indices is None:
+            cnn_indices = range(options.num_cnn)
+
+        for n in [cnn for cnn in cnn_indices if cnn < options.num_cnn]:
 
             dataset = MRIDataset_patch(
                     options.caps_directory,
@@ -97,7 +104,8 @@ def main(options):
                     options.patch_stride,
                     transformations=transformations,
                     patch_index=n,
-                    prepare_dl=options.prepare_dl)
+                    prepare_dl=options.prepare_dl,
+                    packed=options.packed_patches)
 
             test_loader = DataLoader(
                     dataset,
@@ -5,6 +5,7 @@ from torch.utils.data import DataLoader
 import torch
 
 from utils import MRIDataset_patch_hippocampus, test, patch_level_to_tsvs, soft_voting_to_tsvs, MRIDataset_patch
+from utils import selected_patches
 from clinicadl.tools.deep_learning.data import MinMaxNormalization, load_data_test, load_data
 from clinicadl.tools.deep_learning import create_model, load_model
 
@@ -48,6 +49,8 @@ parser.add_argument('--hippocampus_roi', default=False, action="store_true",
                     help="If train the model using only hippocampus ROI")
 parser.add_argument('--prepare_dl', default=False, action="store_true",
                     help="If True the outputs of preprocessing prepare_dl are used, else the whole MRI is loaded.")
+parser.add_argument('--packed_patches', default=False, action="store_true",
+                    help="If True the patches are read from the packed array of each session written by extract.")
 parser.add_argument("--n_splits", default=5, type=int,
                     help="Define the cross validation, by default, we use 5-fold.")
 parser.add_argument("--split", default=None, type=int,
@@ -95,7 +98,9 @@ def main(options):
         else:
             data_test = MRIDataset_patch(options.caps_directory, test_df, options.patch_size,
                                          options.patch_stride, transformations=transformations,
-                                         prepare_dl=options.prepare_dl)
+                                         prepare_dl=options.prepare_dl,
+                                         packed=options.packed_patches,
+                                         patch_indices=selected_patches(options.output_dir, fi))
 
         test_loader = DataLoader(data_test,
                                  batch_size=options.batch_size,
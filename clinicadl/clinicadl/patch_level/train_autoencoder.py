@@ -11,7 +11,8 @@ from .utils import stacked_ae_learning, visualize_ae
 
 from ..tools.deep_learning.iotools import Parameters
 from ..tools.deep_learning import commandline_to_json, create_model
-from ..tools.deep_learning.data import load_data, MinMaxNormalization
+from ..tools.deep_learning.data import load_data, MinMaxNormalization, generate_sampler
+from ..tools.deep_learning.resources import apply_resource_plan, worker_init_function
 
 __author__ = "Junhao Wen, Elina Thibeau-Sutre, Mauricio Diaz"
 __copyright__ = "Copyright 2018 The Aramis Lab Team"
@@ -25,6 +26,8 @@ __status__ = "Development"
 
 def train_autoencoder_patch(params):
 
+    apply_resource_plan(params.resource_plan)
+
     model = create_model(params.model, params.gpu)
     init_state = copy.deepcopy(model.state_dict())
     transformations = transforms.Compose([MinMaxNormalization()])
@@ -65,21 +68,26 @@ def train_autoencoder_patch(params):
                     params.patch_size,
                     params.patch_stride,
                     transformations=transformations,
-                    prepare_dl=params.prepare_dl)
+                    prepare_dl=params.prepare_dl,
+                    packed=params.packed_patches,
+                    cache_size=params.image_cache_size * 1024 ** 2)
             data_valid = MRIDataset_patch(
                     params.input_dir,
                     valid_tsv,
                     params.patch_size,
                     params.patch_stride,
                     transformations=transformations,
-                    prepare_dl=params.prepare_dl)
+                    prepare_dl=params.prepare_dl,
+                    packed=params.packed_patches,
+                    cache_size=params.image_cache_size * 1024 ** 2)
 
         # Use argument load to distinguish training and testing
         train_loader = DataLoader(
                 data_train,
                 batch_size=params.batch_size,
-                shuffle=True,
+                sampler=generate_sampler(data_train, params.sampler),
                 num_workers=params.num_workers,
+                worker_init_fn=worker_init_function(params.resource_plan),
                 pin_memory=True
                                   )
 
@@ -88,6 +96,7 @@ def train_autoencoder_patch(params):
                 batch_size=params.batch_size,
                 shuffle=False,
                 num_workers=params.num_workers,
+                worker_init_fn=worker_init_function(params.resource_plan),
                 pin_memory=True
                                   )
 
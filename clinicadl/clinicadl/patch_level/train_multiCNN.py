@@ -8,11 +8,18 @@ from tensorboardX import SummaryWriter
 import torchvision.transforms as transforms
 
 from .utils import load_model_after_ae, load_model_after_cnn
-from .utils import MRIDataset_patch, train, test, patch_level_to_tsvs, soft_voting_to_tsvs
+from .utils import MRIDataset_patch, train, train_metrics, test, patch_level_to_tsvs, soft_voting_to_tsvs
+from .utils import MRIDataset_patch_multi, train_multihead, test_multihead, soft_voting
+from .utils import select_patches, write_patch_selection, selected_patches, cache_patch_features
 
-from ..tools.deep_learning.iotools import Parameters
+from ..tools.deep_learning.iotools import Parameters, check_and_clean
 from ..tools.deep_learning import EarlyStopping, save_checkpoint, commandline_to_json, create_model, load_model
-from ..tools.deep_learning.data import MinMaxNormalization, load_data
+from ..tools.deep_learning.data import MinMaxNormalization, load_data, generate_sampler, generate_probe_loader
+from ..tools.deep_learning.data import use_train_probe
+from ..tools.deep_learning.models import MultiConv4_FC3
+from ..tools.deep_learning.parallel import run_processes
+from ..tools.deep_learning.resources import apply_resource_plan, worker_init_function
+from ..tools.deep_learning.feature_cache import FeatureCache, encoder_feature_cache, freeze_encoder
 
 __author__ = "Junhao Wen, Elina Thibeau-Sutre, Mauricio Diaz"
 __copyright__ = "Copyright 2018 The Aramis Lab Team"
@@ -26,9 +33,15 @@ __status__ = "Development"
 
 def train_patch_multi_cnn(params):
 
+    apply_resource_plan(params.resource_plan)
+
+    if params.feature_cache is not None and params.transfer_learning_path is None:
+        raise ValueError("The feature cache freezes the encoder of the model, which must be initialized "
+                         "with transfer learning.")
+
     model = create_model(params.model, params.gpu)
-    init_state = copy.deepcopy(model.state_dict())
-    transformations = transforms.Compose([MinMaxNormalization()])
+    # the initial state is sent to the other processes, it must be on the CPU
+    init_state = {key: value.cpu() for key, value in copy.deepcopy(model.state_dict()).items()}
 
     if params.split is None:
         fold_iterator = range(params.n_splits)
@@ -39,276 +52,587 @@ def train_patch_multi_cnn(params):
     for fi in fold_iterator:
         print("Fold %i" % fi)
 
-        for i in range(params.num_cnn):
+        # The same split is used by all the CNNs of the fold
+        training_tsv, valid_tsv = load_data(
+                params.tsv_path,
+                params.diagnoses,
+                fi,
+                n_splits=params.n_splits,
+                baseline=params.baseline)
+
+        # the CNNs of the patches which are mostly background are not trained
+        if params.patch_occupancy_threshold > 0:
+            selection_df = select_patches(params.input_dir, training_tsv, params.patch_size, params.patch_stride,
+                                          params.patch_occupancy_threshold)
+            write_patch_selection(params.output_dir, fi, selection_df)
+            patch_list = [i for i in selected_patches(params.output_dir, fi) if i < params.num_cnn]
+            print("%i patches out of %i are excluded in fold %i."
+                  % (params.num_cnn - len(patch_list), params.num_cnn, fi))
+        else:
+            write_patch_selection(params.output_dir, fi, None)
+            patch_list = list(range(params.num_cnn))
+
+        cnn_list = []
+        for i in patch_list:
+            if cnn_is_finished(params.output_dir, fi, i):
+                print("The %d-th CNN of fold %i was already trained." % (i, fi))
+            else:
+                cnn_list.append(i)
+
+        # the CNNs of a fold share the encoder given by the transfer learning, and therefore its feature cache,
+        # unless each CNN is initialized with its own pre-trained CNN
+        if (params.feature_cache is not None and not params.multihead and len(cnn_list) > 0
+                and (params.transfer_learning_autoencoder or not params.transfer_learning_multicnn)):
+            fold_model = initialize_cnn(params, fi, cnn_list[0], init_state)
+            feature_cache = FeatureCache(params.feature_cache, [fold_model.features],
+                                         dtype=params.feature_cache_dtype, input_tag='patch_minmax')
+            del fold_model
+        else:
+            feature_cache = None
+
+        if params.multihead:
+            # the unfinished CNNs are trained together as the heads of one model, the finished ones are kept
+            if len(cnn_list) > 0:
+                train_multihead_cnn(params, fi, training_tsv, valid_tsv, init_state, cnn_indices=cnn_list)
+        elif params.num_parallel_cnn > 1:
+            args_list = [(params, fi, i, training_tsv, valid_tsv, init_state, feature_cache) for i in cnn_list]
+            if params.resource_plan is not None:
+                n_threads = params.resource_plan['num_threads']
+            else:
+                n_threads = params.threads_per_cnn
+            failed_args = run_processes(train_single_cnn, args_list, params.num_parallel_cnn, n_threads=n_threads)
+            if len(failed_args) > 0:
+                raise Exception("The training of the CNNs %s of fold %i failed."
+                                % (str([args[2] for args in failed_args]), fi))
+        else:
+            if params.threads_per_cnn > 0:
+                torch.set_num_threads(params.threads_per_cnn)
+            for i in cnn_list:
+                train_single_cnn(params, fi, i, training_tsv, valid_tsv, init_state, feature_cache)
 
-            training_tsv, valid_tsv = load_data(
-                    params.tsv_path,
-                    params.diagnoses,
+        for selection in ['best_acc', 'best_loss']:
+            soft_voting_to_tsvs(
+                    params.output_dir,
                     fi,
-                    n_splits=params.n_splits,
-                    baseline=params.baseline)
-
-            print("Running for the %d-th CNN" % i)
-            if params.transfer_learning_path is not None:
-                if params.transfer_learning_autoencoder:
-                    print('Train the model with the weights from a pre-trained autoencoder.')
-                    model_folder = os.path.join(
-                            params.transfer_learning_path,
-                            'best_model_dir',
-                            "fold_" + str(fi),
-                            'ConvAutoencoder',
-                            'Encoder')
-                    model, _ = load_model_after_ae(
-                            model,
-                            model_folder,
-                            filename='model_best_encoder.pth.tar')
-                else:
-                    if params.transfer_learning_multicnn:
-                        print('Train each of the models of multiple CNN with the weights from a pre-trained CNN.')
-                        model_folder = os.path.join(
-                                params.transfer_learning_path,
-                                'best_model_dir',
-                                "fold_" + str(fi),
-                                'cnn-' + str(i),
-                                'best_acc')
-                        model, _ = load_model_after_cnn(
-                                model,
-                                model_folder,
-                                filename='model_best.pth.tar')
-                    else:
-                        print('Train the model with the weights from a pre-trained CNN.')
-                        model_folder = os.path.join(
-                                params.transfer_learning_path,
-                                'best_model_dir',
-                                "fold_" + str(fi),
-                                'CNN',
-                                'best_acc')
-                        model, _ = load_model_after_cnn(
-                                model,
-                                model_folder,
-                                filename='model_best.pth.tar')
-            else:
-                print('The model is trained from scratch.')
-                model.load_state_dict(init_state)
-
-            data_train = MRIDataset_patch(
-                    params.input_dir,
-                    training_tsv,
-                    params.patch_size,
-                    params.patch_stride,
-                    transformations=transformations,
-                    patch_index=i,
-                    prepare_dl=params.prepare_dl
-                    )
+                    selection,
+                    dataset='train',
+                    num_cnn=params.num_cnn,
+                    selection_threshold=params.selection_threshold)
+            soft_voting_to_tsvs(
+                    params.output_dir,
+                    fi,
+                    selection,
+                    dataset='validation',
+                    num_cnn=params.num_cnn,
+                    selection_threshold=params.selection_threshold)
 
-            data_valid = MRIDataset_patch(
-                    params.input_dir,
-                    valid_tsv,
-                    params.patch_size,
-                    params.patch_stride,
-                    transformations=transformations,
-                    patch_index=i,
-                    prepare_dl=params.prepare_dl
-                    )
 
-            # Use argument load to distinguish training and testing
-            train_loader = DataLoader(data_train,
-                                      batch_size=params.batch_size,
-                                      shuffle=True,
-                                      num_workers=params.num_workers,
-                                      pin_memory=True
-                                      )
-
-            valid_loader = DataLoader(data_valid,
-                                      batch_size=params.batch_size,
-                                      shuffle=False,
-                                      num_workers=params.num_workers,
-                                      pin_memory=True
-                                      )
-
-            # Define loss and optimizer
-            optimizer = eval("torch.optim." + params.optimizer)(filter(lambda x: x.requires_grad, model.parameters()), params.learning_rate, weight_decay=params.weight_decay)
-
-            loss = torch.nn.CrossEntropyLoss()
-
-            print('Beginning the training task')
-            # parameters used in training
-            best_accuracy = 0.0
-            best_loss_valid = np.inf
-            writer_train_batch = SummaryWriter(
-                    log_dir=(
-                        os.path.join(
-                            params.output_dir,
-                            "log_dir",
-                            "fold_%i" % fi,
-                            "cnn-%i" % i,
-                            "train_batch"
-                            )
-                        )
-                    )
+def train_single_cnn(params, fi, i, training_tsv, valid_tsv, init_state, feature_cache=None):
+    """
+    Trains the CNN of the i-th patch on the fold fi and writes its patch level results.
+    This function may be run in a separate process.
+
+    :param params: (Parameters) options of the training.
+    :param fi: (int) index of the fold.
+    :param i: (int) index of the patch (and of the CNN).
+    :param training_tsv: (DataFrame) training sessions of the fold.
+    :param valid_tsv: (DataFrame) validation sessions of the fold.
+    :param init_state: (dict) initial state_dict of the CNN when it is trained from scratch.
+    :param feature_cache: (FeatureCache) cache of the encoder shared by the CNNs of the fold. If None and
+                          params.feature_cache is given, the cache of the encoder of the CNN is used.
+    """
+    transformations = transforms.Compose([MinMaxNormalization()])
 
-            writer_train_all_data = SummaryWriter(
-                    log_dir=(
-                        os.path.join(
-                            params.output_dir,
-                            "log_dir",
-                            "fold_%i" % fi,
-                            "cnn-%i" % i,
-                            "train_all_data"
-                            )
-                        )
+    print("Running for the %d-th CNN" % i)
+    # A CNN which was not finished is trained again from the beginning
+    check_and_clean(os.path.join(params.output_dir, 'log_dir', 'fold_%i' % fi, 'cnn-%i' % i))
+    check_and_clean(os.path.join(params.output_dir, 'best_model_dir', 'fold_%i' % fi, 'cnn-%i' % i))
+
+    model = initialize_cnn(params, fi, i, init_state)
+
+    data_train = MRIDataset_patch(
+            params.input_dir,
+            training_tsv,
+            params.patch_size,
+            params.patch_stride,
+            transformations=transformations,
+            patch_index=i,
+            prepare_dl=params.prepare_dl,
+            packed=params.packed_patches,
+            cache_size=params.image_cache_size * 1024 ** 2
+            )
+
+    data_valid = MRIDataset_patch(
+            params.input_dir,
+            valid_tsv,
+            params.patch_size,
+            params.patch_stride,
+            transformations=transformations,
+            patch_index=i,
+            prepare_dl=params.prepare_dl,
+            packed=params.packed_patches,
+            cache_size=params.image_cache_size * 1024 ** 2
+            )
+
+    if params.feature_cache is not None:
+        # the features of a patch are computed once, then shared by the folds with the same encoder
+        if feature_cache is None:
+            feature_cache = encoder_feature_cache(params.feature_cache, model, dtype=params.feature_cache_dtype,
+                                                  input_tag='patch_minmax')
+        else:
+            freeze_encoder(model)
+        data_train = cache_patch_features(model, data_train, feature_cache, batch_size=params.batch_size,
+                                          num_workers=params.num_workers, gpu=params.gpu)
+        data_valid = cache_patch_features(model, data_valid, feature_cache, batch_size=params.batch_size,
+                                          num_workers=params.num_workers, gpu=params.gpu)
+
+    # Use argument load to distinguish training and testing
+    train_loader = DataLoader(data_train,
+                              batch_size=params.batch_size,
+                              sampler=generate_sampler(data_train, params.sampler),
+                              num_workers=params.num_workers,
+                              worker_init_fn=worker_init_function(params.resource_plan),
+                              pin_memory=True
+                              )
+
+    valid_loader = DataLoader(data_valid,
+                              batch_size=params.batch_size,
+                              shuffle=False,
+                              num_workers=params.num_workers,
+                              worker_init_fn=worker_init_function(params.resource_plan),
+                              pin_memory=True
+                              )
+
+    probe_loader = generate_probe_loader(train_loader, params.train_probe_size)
+
+    # Define loss and optimizer
+    optimizer = eval("torch.optim." + params.optimizer)(filter(lambda x: x.requires_grad, model.parameters()), params.learning_rate, weight_decay=params.weight_decay)
+
+    loss = torch.nn.CrossEntropyLoss()
+
+    print('Beginning the training task')
+    # parameters used in training
+    best_accuracy = 0.0
+    best_loss_valid = np.inf
+    writer_train_batch = SummaryWriter(
+            log_dir=(
+                os.path.join(
+                    params.output_dir,
+                    "log_dir",
+                    "fold_%i" % fi,
+                    "cnn-%i" % i,
+                    "train_batch"
                     )
+                )
+            )
 
-            writer_valid = SummaryWriter(
-                    log_dir=(
-                        os.path.join(
-                            params.output_dir,
-                            "log_dir",
-                            "fold_%i" % fi,
-                            "cnn-%i" % i,
-                            "valid"
-                            )
-                        )
+    writer_train_all_data = SummaryWriter(
+            log_dir=(
+                os.path.join(
+                    params.output_dir,
+                    "log_dir",
+                    "fold_%i" % fi,
+                    "cnn-%i" % i,
+                    "train_all_data"
                     )
+                )
+            )
 
-            # initialize the early stopping instance
-            early_stopping = EarlyStopping(
-                    'min',
-                    min_delta=params.tolerance,
-                    patience=params.patience
+    writer_valid = SummaryWriter(
+            log_dir=(
+                os.path.join(
+                    params.output_dir,
+                    "log_dir",
+                    "fold_%i" % fi,
+                    "cnn-%i" % i,
+                    "valid"
                     )
-
-            for epoch in range(params.epochs):
-                print("At %i-th epoch." % epoch)
-
-                # train the model
-                train_df, acc_mean_train, loss_batch_mean_train, global_step,\
-                    = train(model,
-                            train_loader,
-                            params.gpu,
-                            loss,
-                            optimizer,
-                            writer_train_batch,
+                )
+            )
+
+    # initialize the early stopping instance
+    early_stopping = EarlyStopping(
+            'min',
+            min_delta=params.tolerance,
+            patience=params.patience
+            )
+
+    for epoch in range(params.epochs):
+        print("At %i-th epoch." % epoch)
+
+        # train the model
+        train_df, acc_mean_train, loss_batch_mean_train, global_step,\
+            = train(model,
+                    train_loader,
+                    params.gpu,
+                    loss,
+                    optimizer,
+                    writer_train_batch,
+                    epoch,
+                    model_mode='train',
+                    precision=params.precision)
+
+        # calculate the subject level training accuracy without a second pass on all the training data
+        acc_mean_train_all, loss_batch_mean_train_all \
+            = train_metrics(model,
+                            train_df,
+                            loss_batch_mean_train,
+                            probe_loader,
                             epoch,
-                            model_mode='train')
-
-                # calculate the training accuracy based on all the training data
-                train_all_df, acc_mean_train_all, loss_batch_mean_train_all, _,\
-                    = train(model,
-                            train_loader,
                             params.gpu,
                             loss,
-                            optimizer,
                             writer_train_all_data,
                             epoch,
-                            model_mode='valid')
-                print("For training, subject level balanced accuracy is %f at the end of epoch %d" % (acc_mean_train_all, epoch))
+                            probe_frequency=params.train_probe_frequency)
+        print("For training, subject level balanced accuracy is %f at the end of epoch %d" % (acc_mean_train_all, epoch))
+
+        # at then end of each epoch, we validate one time for the model
+        # with the validation data
+
+        valid_df, acc_mean_valid, loss_batch_mean_valid, _\
+            = train(model,
+                    valid_loader,
+                    params.gpu,
+                    loss,
+                    optimizer,
+                    writer_valid,
+                    epoch,
+                    model_mode='valid')
+        print("For validation, subject level balanced accuracy is %f at the end of epoch %d" % (acc_mean_valid, epoch))
+
+        # save the best model based on the best loss and accuracy
+        acc_is_best = acc_mean_valid > best_accuracy
+        best_accuracy = max(best_accuracy, acc_mean_valid)
+        loss_is_best = loss_batch_mean_valid < best_loss_valid
+        best_loss_valid = min(loss_batch_mean_valid, best_loss_valid)
+
+        save_checkpoint(
+                {
+                    'epoch': epoch + 1,
+                    'model': model.state_dict(),
+                    'loss': loss_batch_mean_valid,
+                    'accuracy': acc_mean_valid,
+                    'optimizer': optimizer.state_dict(),
+                    'global_step': global_step
+                    },
+                acc_is_best, loss_is_best,
+                os.path.join(
+                    params.output_dir,
+                    "best_model_dir",
+                    "fold_%i" % fi,
+                    "cnn-%i" % i
+                    )
+                )
 
-                # at then end of each epoch, we validate one time for the model
-                # with the validation data
+        # try early stopping criterion
+        if early_stopping.step(loss_batch_mean_valid) or epoch == params.epochs - 1:
+            print("By applying early stopping or at the last epoch defined by user,"
+                  "the training is stopped at %d-th epoch" % epoch)
 
-                valid_df, acc_mean_valid, loss_batch_mean_valid, _\
-                    = train(model,
-                            valid_loader,
-                            params.gpu,
-                            loss,
-                            optimizer,
-                            writer_valid,
-                            epoch,
-                            model_mode='valid')
-                print("For validation, subject level balanced accuracy is %f at the end of epoch %d" % (acc_mean_valid, epoch))
-
-                # save the best model based on the best loss and accuracy
-                acc_is_best = acc_mean_valid > best_accuracy
-                best_accuracy = max(best_accuracy, acc_mean_valid)
-                loss_is_best = loss_batch_mean_valid < best_loss_valid
-                best_loss_valid = min(loss_batch_mean_valid, best_loss_valid)
-
-                save_checkpoint(
-                        {
-                            'epoch': epoch + 1,
-                            'model': model.state_dict(),
-                            'loss': loss_batch_mean_valid,
-                            'accuracy': acc_mean_valid,
-                            'optimizer': optimizer.state_dict(),
-                            'global_step': global_step
-                            },
-                        acc_is_best, loss_is_best,
-                        os.path.join(
-                            params.output_dir,
-                            "best_model_dir",
-                            "fold_%i" % fi,
-                            "cnn-%i" % i
-                            )
-                        )
+            break
 
-                # try early stopping criterion
-                if early_stopping.step(loss_batch_mean_valid) or epoch == params.epochs - 1:
-                    print("By applying early stopping or at the last epoch defined by user,"
-                          "the training is stopped at %d-th epoch" % epoch)
-
-                    break
+    for selection in ['best_acc', 'best_loss']:
+        # load the best trained model during the training
+        model, best_epoch = load_model(
+                model,
+                os.path.join(
+                    params.output_dir,
+                    'best_model_dir',
+                    'fold_%i' % fi,
+                    'cnn-%i' % i,
+                    selection
+                    ),
+                gpu=params.gpu,
+                filename='model_best.pth.tar'
+                )
+
+        train_df, metrics_train = test(
+                model,
+                train_loader,
+                params.gpu,
+                loss
+                )
+        valid_df, metrics_valid = test(
+                model,
+                valid_loader,
+                params.gpu,
+                loss
+                )
+        patch_level_to_tsvs(
+                params.output_dir,
+                train_df,
+                metrics_train,
+                fi,
+                selection,
+                dataset='train',
+                cnn_index=i
+                )
+        patch_level_to_tsvs(
+                params.output_dir,
+                valid_df,
+                metrics_valid,
+                fi,
+                selection,
+                dataset='validation',
+                cnn_index=i
+                )
+
+        torch.cuda.empty_cache()
+
+
+def train_multihead_cnn(params, fi, training_tsv, valid_tsv, init_state, cnn_indices=None):
+    """
+    Trains the CNNs of fold fi as the heads of one MultiConv4_FC3, so that each session is loaded
+    once per epoch for all the CNNs. The checkpoints, logs and patch level results of each head are written
+    exactly as the ones of the CNN trained by train_single_cnn.
+
+    :param params: (Parameters) options of the training.
+    :param fi: (int) index of the fold.
+    :param training_tsv: (DataFrame) training sessions of the fold.
+    :param valid_tsv: (DataFrame) validation sessions of the fold.
+    :param init_state: (dict) initial state_dict of the CNNs when they are trained from scratch.
+    :param cnn_indices: (list) indices of the CNNs (i.e. of the patches) to train. If None the num_cnn CNNs
+                        are trained.
+    """
+    if params.feature_cache is not None:
+        raise NotImplementedError("The feature cache is not implemented for the multi-head training.")
+    if params.model != 'Conv4_FC3':
+        raise NotImplementedError("The multi-head training is only implemented for Conv4_FC3, not %s."
+                                  % params.model)
 
-            for selection in ['best_acc', 'best_loss']:
-                # load the best trained model during the training
-                model, best_epoch = load_model(
-                        model,
-                        os.path.join(
-                            params.output_dir,
-                            'best_model_dir',
-                            'fold_%i' % fi,
-                            'cnn-%i' % i,
-                            selection
-                            ),
-                        gpu=params.gpu,
-                        filename='model_best.pth.tar'
+    transformations = transforms.Compose([MinMaxNormalization()])
+    if cnn_indices is None:
+        cnn_indices = list(range(params.num_cnn))
+    n_heads = len(cnn_indices)
+    heads = range(n_heads)
+
+    for i in heads:
+        check_and_clean(os.path.join(params.output_dir, 'log_dir', 'fold_%i' % fi, 'cnn-%i' % cnn_indices[i]))
+        check_and_clean(os.path.join(params.output_dir, 'best_model_dir', 'fold_%i' % fi, 'cnn-%i' % cnn_indices[i]))
+
+    model = MultiConv4_FC3(n_heads)
+    model.load_heads([initialize_cnn(params, fi, cnn_indices[i], init_state).state_dict() for i in heads])
+    if params.gpu:
+        model.cuda()
+
+    data_train = MRIDataset_patch_multi(
+            params.input_dir,
+            training_tsv,
+            params.patch_size,
+            params.patch_stride,
+            n_heads,
+            transformations=transformations,
+            prepare_dl=params.prepare_dl,
+            packed=params.packed_patches,
+            patch_indices=cnn_indices
+            )
+
+    data_valid = MRIDataset_patch_multi(
+            params.input_dir,
+            valid_tsv,
+            params.patch_size,
+            params.patch_stride,
+            n_heads,
+            transformations=transformations,
+            prepare_dl=params.prepare_dl,
+            packed=params.packed_patches,
+            patch_indices=cnn_indices
+            )
+
+    train_loader = DataLoader(data_train,
+                              batch_size=params.batch_size,
+                              sampler=generate_sampler(data_train, params.sampler),
+                              num_workers=params.num_workers,
+                              worker_init_fn=worker_init_function(params.resource_plan),
+                              pin_memory=True
+                              )
+
+    valid_loader = DataLoader(data_valid,
+                              batch_size=params.batch_size,
+                              shuffle=False,
+                              num_workers=params.num_workers,
+                              worker_init_fn=worker_init_function(params.resource_plan),
+                              pin_memory=True
+                              )
+
+    probe_loader = generate_probe_loader(train_loader, params.train_probe_size)
+
+    # Define optimizer
+    optimizer = eval("torch.optim." + params.optimizer)(filter(lambda x: x.requires_grad, model.parameters()), params.learning_rate, weight_decay=params.weight_decay)
+
+    print('Beginning the training task')
+    log_dir = os.path.join(params.output_dir, "log_dir", "fold_%i" % fi)
+    writers_train_batch = [SummaryWriter(log_dir=os.path.join(log_dir, "cnn-%i" % cnn_indices[i], "train_batch")) for i in heads]
+    writers_train_all_data = [SummaryWriter(log_dir=os.path.join(log_dir, "cnn-%i" % cnn_indices[i], "train_all_data"))
+                              for i in heads]
+    writers_valid = [SummaryWriter(log_dir=os.path.join(log_dir, "cnn-%i" % cnn_indices[i], "valid")) for i in heads]
+
+    # each head has its own early stopping and best models
+    best_accuracy = np.zeros(n_heads)
+    best_loss_valid = np.full(n_heads, np.inf)
+    early_stoppings = [EarlyStopping('min', min_delta=params.tolerance, patience=params.patience) for _ in heads]
+    stopped = np.zeros(n_heads, dtype=bool)
+
+    for epoch in range(params.epochs):
+        print("At %i-th epoch." % epoch)
+
+        train_dfs, loss_batch_mean_train, global_step = train_multihead(
+                model, train_loader, params.gpu, optimizer, writers_train_batch, epoch, precision=params.precision)
+        if use_train_probe(probe_loader, epoch, params.train_probe_frequency):
+            probe_results = test_multihead(model, probe_loader, params.gpu)
+        else:
+            probe_results = None
+        valid_results = test_multihead(model, valid_loader, params.gpu)
+
+        for i in heads:
+            # subject level training accuracy of the head
+            if probe_results is not None:
+                probe_df, probe_metrics = probe_results[i]
+                _, metrics_subject = soft_voting(probe_df, probe_df)
+                loss_mean_train_all = probe_metrics['total_loss'] / len(probe_loader)
+            else:
+                _, metrics_subject = soft_voting(train_dfs[i], train_dfs[i])
+                loss_mean_train_all = loss_batch_mean_train[i]
+            writers_train_all_data[i].add_scalar('classification accuracy', metrics_subject['balanced_accuracy'],
+                                                 epoch)
+            writers_train_all_data[i].add_scalar('loss', loss_mean_train_all, epoch)
+
+            # subject level validation accuracy of the head
+            valid_df, valid_metrics = valid_results[i]
+            _, metrics_subject = soft_voting(valid_df, valid_df)
+            acc_mean_valid = metrics_subject['balanced_accuracy']
+            loss_batch_mean_valid = valid_metrics['total_loss'] / len(valid_loader)
+            writers_valid[i].add_scalar('classification accuracy', acc_mean_valid, epoch)
+            writers_valid[i].add_scalar('loss', loss_batch_mean_valid, epoch)
+
+            if stopped[i]:
+                continue
+            print("For validation, subject level balanced accuracy of the %d-th CNN is %f at the end of epoch %d"
+                  % (cnn_indices[i], acc_mean_valid, epoch))
+
+            # save the best model of the head based on the best loss and accuracy
+            acc_is_best = acc_mean_valid > best_accuracy[i]
+            best_accuracy[i] = max(best_accuracy[i], acc_mean_valid)
+            loss_is_best = loss_batch_mean_valid < best_loss_valid[i]
+            best_loss_valid[i] = min(loss_batch_mean_valid, best_loss_valid[i])
+
+            save_checkpoint(
+                    {
+                        'epoch': epoch + 1,
+                        'model': model.export_head(i),
+                        'loss': loss_batch_mean_valid,
+                        'accuracy': acc_mean_valid,
+                        'optimizer': model.export_head_optimizer(optimizer, i),
+                        'global_step': global_step
+                        },
+                    acc_is_best, loss_is_best,
+                    os.path.join(
+                        params.output_dir,
+                        "best_model_dir",
+                        "fold_%i" % fi,
+                        "cnn-%i" % cnn_indices[i]
                         )
+                    )
 
-                train_df, metrics_train = test(
+            # the best models of a stopped head are not updated anymore
+            if early_stoppings[i].step(loss_batch_mean_valid):
+                print("By applying early stopping, the training of the %d-th CNN is stopped at %d-th epoch"
+                      % (cnn_indices[i], epoch))
+                stopped[i] = True
+
+        if stopped.all():
+            break
+
+    for selection in ['best_acc', 'best_loss']:
+        # load the best trained model of each head
+        best_states = [torch.load(os.path.join(params.output_dir, 'best_model_dir', 'fold_%i' % fi, 'cnn-%i' % cnn_indices[i],
+                                               selection, 'model_best.pth.tar'), map_location='cpu')['model']
+                       for i in heads]
+        model.load_heads(best_states)
+
+        train_results = test_multihead(model, train_loader, params.gpu)
+        valid_results = test_multihead(model, valid_loader, params.gpu)
+        for i in heads:
+            patch_level_to_tsvs(params.output_dir, train_results[i][0], train_results[i][1], fi, selection,
+                                dataset='train', cnn_index=cnn_indices[i])
+            patch_level_to_tsvs(params.output_dir, valid_results[i][0], valid_results[i][1], fi, selection,
+                                dataset='validation', cnn_index=cnn_indices[i])
+
+        torch.cuda.empty_cache()
+
+
+def initialize_cnn(params, fi, i, init_state):
+    """
+    Creates the CNN of the i-th patch of fold fi, initialized according to the transfer learning options.
+
+    :param params: (Parameters) options of the training.
+    :param fi: (int) index of the fold.
+    :param i: (int) index of the patch (and of the CNN).
+    :param init_state: (dict) initial state_dict of the CNN when it is trained from scratch.
+    :return: (Module) the initialized CNN.
+    """
+    model = create_model(params.model, params.gpu)
+    model.load_state_dict(init_state)
+
+    if params.transfer_learning_path is not None:
+        if params.transfer_learning_autoencoder:
+            print('Train the model with the weights from a pre-trained autoencoder.')
+            model_folder = os.path.join(
+                    params.transfer_learning_path,
+                    'best_model_dir',
+                    "fold_" + str(fi),
+                    'ConvAutoencoder',
+                    'Encoder')
+            model, _ = load_model_after_ae(
+                    model,
+                    model_folder,
+                    filename='model_best_encoder.pth.tar')
+        else:
+            if params.transfer_learning_multicnn:
+                print('Train each of the models of multiple CNN with the weights from a pre-trained CNN.')
+                model_folder = os.path.join(
+                        params.transfer_learning_path,
+                        'best_model_dir',
+                        "fold_" + str(fi),
+                        'cnn-' + str(i),
+                        'best_acc')
+                model, _ = load_model_after_cnn(
                         model,
-                        train_loader,
-                        params.gpu,
-                        loss
-                        )
-                valid_df, metrics_valid = test(
+                        model_folder,
+                        filename='model_best.pth.tar')
+            else:
+                print('Train the model with the weights from a pre-trained CNN.')
+                model_folder = os.path.join(
+                        params.transfer_learning_path,
+                        'best_model_dir',
+                        "fold_" + str(fi),
+                        'CNN',
+                        'best_acc')
+                model, _ = load_model_after_cnn(
                         model,
-                        valid_loader,
-                        params.gpu,
-                        loss
-                        )
-                patch_level_to_tsvs(
-                        params.output_dir,
-                        train_df,
-                        metrics_train,
-                        fi,
-                        selection,
-                        dataset='train',
-                        cnn_index=i
-                        )
-                patch_level_to_tsvs(
-                        params.output_dir,
-                        valid_df,
-                        metrics_valid,
-                        fi,
-                        selection,
-                        dataset='validation',
-                        cnn_index=i
-                        )
+                        model_folder,
+                        filename='model_best.pth.tar')
+    else:
+        print('The model is trained from scratch.')
 
-                torch.cuda.empty_cache()
+    return model
 
-        for selection in ['best_acc', 'best_loss']:
-            soft_voting_to_tsvs(
-                    params.output_dir,
-                    fi,
-                    selection,
-                    dataset='train',
-                    num_cnn=params.num_cnn,
-                    selection_threshold=params.selection_threshold)
-            soft_voting_to_tsvs(
-                    params.output_dir,
-                    fi,
-                    selection,
-                    dataset='validation',
-                    num_cnn=params.num_cnn,
-                    selection_threshold=params.selection_threshold)
+
+def cnn_is_finished(output_dir, fi, i):
+    """
+    Checks if the training of the i-th CNN of fold fi was already finished, i.e. if its patch level results
+    were written for both selections and datasets.
+
+    :param output_dir: (str) path to the output directory.
+    :param fi: (int) index of the fold.
+    :param i: (int) index of the CNN.
+    :return: (bool)
+    """
+    for selection in ['best_acc', 'best_loss']:
+        for dataset in ['train', 'validation']:
+            metrics_path = os.path.join(output_dir, 'performances', 'fold_%i' % fi, 'cnn-%i' % i, selection,
+                                        dataset + '_patch_level_metrics.tsv')
+            if not os.path.exists(metrics_path):
+                return False
+
+    return True
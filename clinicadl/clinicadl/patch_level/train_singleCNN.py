@@ -9,12 +9,15 @@ import torchvision.transforms as transforms
 
 from .utils import MRIDataset_patch_hippocampus, MRIDataset_patch
 from .utils import load_model_after_ae, load_model_after_cnn
-from .utils import train, test, patch_level_to_tsvs, soft_voting_to_tsvs
+from .utils import train, train_metrics, test, patch_level_to_tsvs, soft_voting_to_tsvs
+from .utils import select_patches, write_patch_selection, selected_patches, cache_patch_features
 
 
 from ..tools.deep_learning.iotools import Parameters
 from ..tools.deep_learning import EarlyStopping, save_checkpoint, commandline_to_json, create_model, load_model
-from ..tools.deep_learning.data import MinMaxNormalization, load_data
+from ..tools.deep_learning.data import MinMaxNormalization, load_data, generate_sampler, generate_probe_loader
+from ..tools.deep_learning.resources import apply_resource_plan, worker_init_function
+from ..tools.deep_learning.feature_cache import encoder_feature_cache
 
 __author__ = "Junhao Wen, Elina Thibeau-Sutre, Mauricio Diaz"
 __copyright__ = "Copyright 2018 The Aramis Lab Team"
@@ -28,6 +31,15 @@ __status__ = "Development"
 
 def train_patch_single_cnn(params):
 
+    apply_resource_plan(params.resource_plan)
+
+    if params.feature_cache is not None:
+        if params.hippocampus_roi:
+            raise ValueError("The feature cache is not implemented for the hippocampus ROI.")
+        if params.transfer_learning_path is None:
+            raise ValueError("The feature cache freezes the encoder of the model, which must be initialized "
+                             "with transfer learning.")
+
     model = create_model(params.model, params.gpu)
     init_state = copy.deepcopy(model.state_dict())
     transformations = transforms.Compose([MinMaxNormalization()])
@@ -90,13 +102,25 @@ def train_patch_single_cnn(params):
                     )
 
         else:
+            # the patches which are mostly background are excluded from training and voting
+            if params.patch_occupancy_threshold > 0:
+                selection_df = select_patches(params.input_dir, training_tsv, params.patch_size,
+                                              params.patch_stride, params.patch_occupancy_threshold)
+                write_patch_selection(params.output_dir, fi, selection_df)
+            else:
+                write_patch_selection(params.output_dir, fi, None)
+            patch_indices = selected_patches(params.output_dir, fi)
+
             data_train = MRIDataset_patch(
                     params.input_dir,
                     training_tsv,
                     params.patch_size,
                     params.patch_stride,
                     transformations=transformations,
-                    prepare_dl=params.prepare_dl
+                    prepare_dl=params.prepare_dl,
+                    packed=params.packed_patches,
+                    cache_size=params.image_cache_size * 1024 ** 2,
+                    patch_indices=patch_indices
                     )
             data_valid = MRIDataset_patch(
                     params.input_dir,
@@ -104,15 +128,29 @@ def train_patch_single_cnn(params):
                     params.patch_size,
                     params.patch_stride,
                     transformations=transformations,
-                    prepare_dl=params.prepare_dl
+                    prepare_dl=params.prepare_dl,
+                    packed=params.packed_patches,
+                    cache_size=params.image_cache_size * 1024 ** 2,
+                    patch_indices=patch_indices
                     )
 
+        if params.feature_cache is not None:
+            # the encoder of each fold is frozen after its transfer learning, its outputs are computed once
+            # per patch and the training only runs the classifier
+            feature_cache = encoder_feature_cache(params.feature_cache, model, dtype=params.feature_cache_dtype,
+                                                  input_tag='patch_minmax')
+            data_train = cache_patch_features(model, data_train, feature_cache, batch_size=params.batch_size,
+                                              num_workers=params.num_workers, gpu=params.gpu)
+            data_valid = cache_patch_features(model, data_valid, feature_cache, batch_size=params.batch_size,
+                                              num_workers=params.num_workers, gpu=params.gpu)
+
         # Use argument load to distinguish training and testing
         train_loader = DataLoader(
                 data_train,
                 batch_size=params.batch_size,
-                shuffle=True,
+                sampler=generate_sampler(data_train, params.sampler),
                 num_workers=params.num_workers,
+                worker_init_fn=worker_init_function(params.resource_plan),
                 pin_memory=True
                 )
 
@@ -121,9 +159,12 @@ def train_patch_single_cnn(params):
                 batch_size=params.batch_size,
                 shuffle=False,
                 num_workers=params.num_workers,
+                worker_init_fn=worker_init_function(params.resource_plan),
                 pin_memory=True
                 )
 
+        probe_loader = generate_probe_loader(train_loader, params.train_probe_size)
+
         # Define loss and optimizer
         optimizer = eval("torch.optim." + params.optimizer)(filter(lambda x: x.requires_grad, model.parameters()), params.learning_rate, weight_decay=params.weight_decay)
 
@@ -191,13 +232,15 @@ def train_patch_single_cnn(params):
                         writer_train_batch,
                         epoch,
                         model_mode='train',
-                        selection_threshold=params.selection_threshold
+                        selection_threshold=params.selection_threshold,
+                        precision=params.precision
                         )
 
-            # calculate the training accuracy based on all the training data
-            train_all_df, acc_mean_train_all, loss_batch_mean_train_all, _\
-                = train(model, train_loader, params.gpu, loss, optimizer, writer_train_all_data, epoch,
-                        model_mode='valid', selection_threshold=params.selection_threshold)
+            # calculate the subject level training accuracy without a second pass on all the training data
+            acc_mean_train_all, loss_batch_mean_train_all \
+                = train_metrics(model, train_df, loss_batch_mean_train, probe_loader, epoch, params.gpu, loss,
+                                writer_train_all_data, epoch, probe_frequency=params.train_probe_frequency,
+                                selection_threshold=params.selection_threshold)
             print("For training, subject level balanced accuracy is %f at the end of epoch %d"
                   % (acc_mean_train_all, epoch))
 
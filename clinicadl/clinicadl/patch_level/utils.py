@@ -5,6 +5,12 @@ import os
 from torch.utils.data import Dataset
 from time import time
 
+from ..tools.deep_learning.data import ImageCache, log_cache_statistics, use_train_probe, patch_grid
+from ..tools.deep_learning.data import load_image, SessionIndex, caps_image_shape, read_patch_occupancy
+from ..tools.deep_learning.results import ResultsAccumulator, vote
+from ..tools.deep_learning.metrics import evaluate_prediction
+from ..tools.deep_learning.precision import autocast, ThroughputMeter
+
 __author__ = "Junhao Wen"
 __copyright__ = "Copyright 2018 The Aramis Lab Team"
 __credits__ = ["Junhao Wen"]
@@ -266,7 +272,7 @@ def load_model_after_cnn(model, checkpoint_dir, filename='checkpoint.pth.tar'):
 #################################
 
 def train(model, data_loader, use_cuda, loss_func, optimizer, writer, epoch, model_mode="train",
-          selection_threshold=None):
+          selection_threshold=None, precision='fp32'):
     """
     This is the function to train, validate or test the model, depending on the model_mode parameter.
     :param model:
@@ -276,15 +282,16 @@ def train(model, data_loader, use_cuda, loss_func, optimizer, writer, epoch, mod
     :param optimizer:
     :param writer:
     :param epoch:
+    :param precision: (str) precision of the forward passes during training ('fp32' or 'bf16').
     :return:
     """
     global_step = None
     softmax = torch.nn.Softmax(dim=1)
 
     if model_mode == "train":
-        columns = ['participant_id', 'session_id', 'patch_id', 'true_label', 'predicted_label', 'proba0', 'proba1']
-        results_batch_df = pd.DataFrame(columns=columns)
+        results_accumulator = ResultsAccumulator(len(data_loader.dataset), id_column='patch_id', n_probabilities=2)
         total_loss = 0.0
+        throughput = ThroughputMeter()
 
         model.train()  # set the model to training mode
 
@@ -297,17 +304,16 @@ def train(model, data_loader, use_cuda, loss_func, optimizer, writer, epoch, mod
             else:
                 imgs, labels = data['image'], data['label']
 
-            gound_truth_list = labels.data.cpu().numpy().tolist()
-
-            output = model(imgs)
+            throughput.start()
+            with autocast(precision, use_cuda):
+                output = model(imgs).float()
+                batch_loss = loss_func(output, labels)
             normalized_output = softmax(output)
             _, predicted = torch.max(output.data, 1)
-            predict_list = predicted.data.cpu().numpy().tolist()
-            batch_loss = loss_func(output, labels)
             total_loss += batch_loss.item()
 
             # calculate the batch balanced accuracy and loss
-            batch_metrics = evaluate_prediction(gound_truth_list, predict_list)
+            batch_metrics = evaluate_prediction(labels, predicted)
             batch_accuracy = batch_metrics['balanced_accuracy']
 
             writer.add_scalar('classification accuracy', batch_accuracy, global_step)
@@ -316,24 +322,21 @@ def train(model, data_loader, use_cuda, loss_func, optimizer, writer, epoch, mod
             optimizer.zero_grad()
             batch_loss.backward()
             optimizer.step()
+            throughput.stop(len(labels))
 
             # Generate detailed DataFrame
-            for idx, sub in enumerate(data['participant_id']):
-                row = [sub, data['session_id'][idx], data['patch_id'][idx].item(),
-                       labels[idx].item(), predicted[idx].item(),
-                       normalized_output[idx, 0].item(), normalized_output[idx, 1].item()]
-                row_df = pd.DataFrame(np.array(row).reshape(1, -1), columns=columns)
-                results_batch_df = pd.concat([results_batch_df, row_df])
+            results_accumulator.add_batch(data, labels, predicted, normalized_output)
 
             # delete the temporary variables taking the GPU memory
             del imgs, labels, output, predicted, batch_loss, batch_accuracy
             torch.cuda.empty_cache()
 
-        results_batch_df.reset_index(inplace=True, drop=True)
+        results_batch_df = results_accumulator.to_dataframe()
         epoch_metrics = evaluate_prediction(results_batch_df.true_label.values.astype(int),
                                             results_batch_df.predicted_label.values.astype(int))
         accuracy_batch_mean = epoch_metrics['balanced_accuracy']
         loss_batch_mean = total_loss / len(data_loader)
+        throughput.log(writer, epoch)
         torch.cuda.empty_cache()
 
     elif model_mode == "valid":
@@ -353,9 +356,176 @@ def train(model, data_loader, use_cuda, loss_func, optimizer, writer, epoch, mod
     else:
         raise ValueError('This mode %s was not implemented. Please choose between train and valid' % model_mode)
 
+    log_cache_statistics(data_loader.dataset, writer, epoch)
+
     return results_batch_df, accuracy_batch_mean, loss_batch_mean, global_step
 
 
+def train_multihead(model, data_loader, use_cuda, optimizer, writers, epoch, precision='fp32'):
+    """
+    Trains all the heads of a MultiConv4_FC3 during one epoch.
+    The loss of each head is the loss it would have if it was trained alone on the same batches.
+
+    :param model: (MultiConv4_FC3) the heads to train
+    :param data_loader: (DataLoader) wrapper of a MRIDataset_patch_multi
+    :param use_cuda: if True a gpu is used
+    :param optimizer: (torch.optim) optimizer linked to model parameters
+    :param writers: (list) SummaryWriter of the batch metrics of each head
+    :param epoch: (int) current epoch
+    :param precision: (str) precision of the forward passes ('fp32' or 'bf16')
+    :return:
+        (list) patch level results of the training pass of each head (DataFrame)
+        (np.array) mean loss of each head
+        (int) global step
+    """
+    import torch.nn.functional as F
+
+    global_step = None
+    n_heads = model.n_heads
+    accumulators = [ResultsAccumulator(len(data_loader.dataset), id_column='patch_id', n_probabilities=2)
+                    for _ in range(n_heads)]
+    total_loss = np.zeros(n_heads)
+    throughput = ThroughputMeter()
+
+    model.train()  # set the model to training mode
+
+    for i, data in enumerate(data_loader):
+        # update the global steps
+        global_step = i + epoch * len(data_loader)
+
+        if use_cuda:
+            imgs, labels = data['image'].cuda(), data['label'].cuda()
+        else:
+            imgs, labels = data['image'], data['label']
+
+        throughput.start()
+        with autocast(precision, use_cuda):
+            output = model(imgs).float()
+            # cross-entropy of each head, of shape [n_heads]
+            head_losses = F.cross_entropy(output.permute(0, 2, 1), labels.unsqueeze(1).expand(-1, n_heads),
+                                          reduction='none').mean(0)
+
+        optimizer.zero_grad()
+        head_losses.sum().backward()
+        optimizer.step()
+        throughput.stop(len(labels))
+
+        head_losses = head_losses.detach().cpu().numpy()
+        total_loss += head_losses
+        normalized_output = torch.softmax(output.detach(), dim=2)
+        _, predicted = torch.max(output.detach(), 2)
+
+        # batch metrics of all the heads in one call
+        head_index = np.tile(np.arange(n_heads), len(labels))
+        batch_metrics = evaluate_prediction(labels.unsqueeze(1).expand(-1, n_heads), predicted, groups=head_index)
+        for head in range(n_heads):
+            writers[head].add_scalar('classification accuracy', batch_metrics[head]['balanced_accuracy'],
+                                     global_step)
+            writers[head].add_scalar('loss', head_losses[head], global_step)
+
+            head_data = {'participant_id': data['participant_id'], 'session_id': data['session_id'],
+                         'patch_id': data['patch_id'][:, head]}
+            accumulators[head].add_batch(head_data, labels, predicted[:, head], normalized_output[:, head])
+
+        # delete the temporary variables taking the GPU memory
+        del imgs, labels, output, predicted
+        torch.cuda.empty_cache()
+
+    results_dfs = [accumulator.to_dataframe() for accumulator in accumulators]
+    throughput.log(writers[0], epoch)
+
+    return results_dfs, total_loss / len(data_loader), global_step
+
+
+def test_multihead(model, dataloader, use_cuda):
+    """
+    Computes the patch level results of all the heads of a MultiConv4_FC3.
+
+    :param model: (MultiConv4_FC3) the heads to evaluate
+    :param dataloader: (DataLoader) wrapper of a MRIDataset_patch_multi
+    :param use_cuda: if True a gpu is used
+    :return: (list) for each head a tuple (DataFrame of the results of each patch, dict of metrics + total loss)
+    """
+    import torch.nn.functional as F
+
+    n_heads = model.n_heads
+    accumulators = [ResultsAccumulator(len(dataloader.dataset), id_column='patch_id', n_probabilities=2)
+                    for _ in range(n_heads)]
+    total_loss = np.zeros(n_heads)
+
+    if use_cuda:
+        model.cuda()
+
+    model.eval()  # set the model to evaluation mode
+    torch.cuda.empty_cache()
+    with torch.no_grad():
+        for i, data in enumerate(dataloader):
+            if use_cuda:
+                imgs, labels = data['image'].cuda(), data['label'].cuda()
+            else:
+                imgs, labels = data['image'], data['label']
+
+            output = model(imgs)
+            head_losses = F.cross_entropy(output.permute(0, 2, 1), labels.unsqueeze(1).expand(-1, n_heads),
+                                          reduction='none').mean(0)
+            total_loss += head_losses.cpu().numpy()
+            normalized_output = torch.softmax(output, dim=2)
+            _, predicted = torch.max(output, 2)
+
+            for head in range(n_heads):
+                head_data = {'participant_id': data['participant_id'], 'session_id': data['session_id'],
+                             'patch_id': data['patch_id'][:, head]}
+                accumulators[head].add_batch(head_data, labels, predicted[:, head], normalized_output[:, head])
+
+            del imgs, labels, output
+            torch.cuda.empty_cache()
+
+    head_results = []
+    for head in range(n_heads):
+        results_df = accumulators[head].to_dataframe()
+        results = evaluate_prediction(results_df.true_label.values, results_df.predicted_label.values)
+        results['total_loss'] = total_loss[head]
+        head_results.append((results_df, results))
+
+    return head_results
+
+
+def train_metrics(model, train_df, train_loss, probe_loader, n_evaluations, use_cuda, loss_func, writer, epoch,
+                  probe_frequency=1, selection_threshold=None):
+    """
+    Computes the subject level metrics of the training set without a second pass on the whole training set.
+    The metrics are computed on the train probe (if any) once every probe_frequency evaluations, else they are
+    computed from the results of the training pass.
+
+    :param model: (Module) CNN being trained
+    :param train_df: (DataFrame) patch level results of the training pass
+    :param train_loss: (float) mean loss of the training pass
+    :param probe_loader: (DataLoader) wrapper of the train probe, or None
+    :param n_evaluations: (int) number of evaluations already performed
+    :param use_cuda: if True a gpu is used
+    :param loss_func: (loss) function to calculate the loss
+    :param writer: (SummaryWriter) writer of the training metrics
+    :param epoch: (int) current epoch
+    :param probe_frequency: (int) the train probe is used once every probe_frequency evaluations
+    :param selection_threshold: (float) threshold of the soft voting
+    :return:
+        (float) subject level balanced accuracy
+        (float) mean loss
+    """
+    if use_train_probe(probe_loader, n_evaluations, probe_frequency):
+        _, accuracy_mean, loss_mean, _ = train(model, probe_loader, use_cuda, loss_func, None, writer, epoch,
+                                               model_mode='valid', selection_threshold=selection_threshold)
+    else:
+        _, metrics_subject = soft_voting(train_df, train_df, selection_threshold=selection_threshold)
+        accuracy_mean = metrics_subject['balanced_accuracy']
+        loss_mean = train_loss
+
+        writer.add_scalar('classification accuracy', accuracy_mean, epoch)
+        writer.add_scalar('loss', loss_mean, epoch)
+
+    return accuracy_mean, loss_mean
+
+
 def test(model, dataloader, use_cuda, criterion):
     """
     Computes the balanced accuracy of the model
@@ -370,8 +540,7 @@ def test(model, dataloader, use_cuda, criterion):
     """
 
     softmax = torch.nn.Softmax(dim=1)
-    columns = ['participant_id', 'session_id', 'patch_id', 'true_label', 'predicted_label', 'proba0', 'proba1']
-    results_df = pd.DataFrame(columns=columns)
+    results_accumulator = ResultsAccumulator(len(dataloader.dataset), id_column='patch_id', n_probabilities=2)
     total_loss = 0
 
     if use_cuda:
@@ -393,95 +562,21 @@ def test(model, dataloader, use_cuda, criterion):
             _, predicted = torch.max(output.data, 1)
 
             # Generate detailed DataFrame
-            for idx, sub in enumerate(data['participant_id']):
-                row = [sub, data['session_id'][idx], data['patch_id'][idx].item(),
-                       labels[idx].item(), predicted[idx].item(),
-                       normalized_output[idx, 0].item(), normalized_output[idx, 1].item()]
-
-                row_df = pd.DataFrame(np.array(row).reshape(1, -1), columns=columns)
-                results_df = pd.concat([results_df, row_df])
+            results_accumulator.add_batch(data, labels, predicted, normalized_output)
 
             del imgs, labels, output
             torch.cuda.empty_cache()
 
         # calculate the balanced accuracy
+        results_df = results_accumulator.to_dataframe()
         results = evaluate_prediction(results_df.true_label.values.astype(int),
                                       results_df.predicted_label.values.astype(int))
-        results_df.reset_index(inplace=True, drop=True)
         results['total_loss'] = total_loss
         torch.cuda.empty_cache()
 
     return results_df, results
 
 
-def evaluate_prediction(y, y_hat):
-    """
-    This is a function to calculate the different metrics based on the list of true label and predicted label
-    :param y: list of labels
-    :param y_hat: list of predictions
-    :return: (dict) ensemble of metrics
-    """
-    true_positive = 0.0
-    true_negative = 0.0
-    false_positive = 0.0
-    false_negative = 0.0
-
-    tp = []
-    tn = []
-    fp = []
-    fn = []
-
-    for i in range(len(y)):
-        if y[i] == 1:
-            if y_hat[i] == 1:
-                true_positive += 1
-                tp.append(i)
-            else:
-                false_negative += 1
-                fn.append(i)
-        else:  # -1
-            if y_hat[i] == 0:
-                true_negative += 1
-                tn.append(i)
-            else:
-                false_positive += 1
-                fp.append(i)
-
-    accuracy = (true_positive + true_negative) / (true_positive + true_negative + false_positive + false_negative)
-
-    if (true_positive + false_negative) != 0:
-        sensitivity = true_positive / (true_positive + false_negative)
-    else:
-        sensitivity = 0.0
-
-    if (false_positive + true_negative) != 0:
-        specificity = true_negative / (false_positive + true_negative)
-    else:
-        specificity = 0.0
-
-    if (true_positive + false_positive) != 0:
-        ppv = true_positive / (true_positive + false_positive)
-    else:
-        ppv = 0.0
-
-    if (true_negative + false_negative) != 0:
-        npv = true_negative / (true_negative + false_negative)
-    else:
-        npv = 0.0
-
-    balanced_accuracy = (sensitivity + specificity) / 2
-
-    results = {'accuracy': accuracy,
-               'balanced_accuracy': balanced_accuracy,
-               'sensitivity': sensitivity,
-               'specificity': specificity,
-               'ppv': ppv,
-               'npv': npv,
-               'confusion_matrix': {'tp': len(tp), 'tn': len(tn), 'fp': len(fp), 'fn': len(fn)}
-               }
-
-    return results
-
 #################################
 # Voting systems
 #################################
@@ -517,6 +612,71 @@ def patch_level_to_tsvs(output_dir, results_df, results, fold, selection, datase
                                             index=False, sep='\t')
 
 
+def select_patches(caps_directory, data_df, patch_size, stride_size, occupancy_threshold):
+    """
+    Selects the patches on the population level: a patch is kept if the mean fraction of foreground voxels of
+    this patch in the sessions of data_df (usually the training set) is at least occupancy_threshold.
+    The occupancies are read from the files written by extract_patches (or computed from the images).
+
+    :param caps_directory: (str) path to the CAPS directory.
+    :param data_df: (DataFrame) sessions with participant_id and session_id columns.
+    :param patch_size: (int) size of the patches.
+    :param stride_size: (int) stride between two patches.
+    :param occupancy_threshold: (float) minimum mean fraction of foreground of a kept patch.
+    :return: (DataFrame) with columns patch_id, occupancy (mean fraction of foreground) and selected.
+    """
+    occupancies = np.array([read_patch_occupancy(os.path.join(caps_directory, 'subjects', participant_id, session_id,
+                                                              't1', 'preprocessing_dl',
+                                                              participant_id + '_' + session_id
+                                                              + '_space-MNI_res-1x1x1.pt'),
+                                                 patch_size, stride_size)
+                            for participant_id, session_id in zip(data_df.participant_id.values,
+                                                                  data_df.session_id.values)])
+    mean_occupancy = occupancies.mean(axis=0)
+
+    return pd.DataFrame({'patch_id': np.arange(len(mean_occupancy)),
+                         'occupancy': mean_occupancy,
+                         'selected': mean_occupancy >= occupancy_threshold},
+                        columns=['patch_id', 'occupancy', 'selected'])
+
+
+def write_patch_selection(output_dir, fold, selection_df):
+    """
+    Records the patches selected for a fold, so that the evaluation and the voting use the same patches.
+
+    :param output_dir: (str) path to the output directory.
+    :param fold: (int) fold of the selection.
+    :param selection_df: (DataFrame) output of select_patches. If None all the patches are used and the selection
+                         of a previous run is removed.
+    """
+    performance_dir = os.path.join(output_dir, 'performances', 'fold_%i' % fold)
+    selection_path = os.path.join(performance_dir, 'patch_selection.tsv')
+    if selection_df is None:
+        if os.path.exists(selection_path):
+            os.remove(selection_path)
+        return
+
+    if not os.path.exists(performance_dir):
+        os.makedirs(performance_dir)
+    selection_df.to_csv(selection_path, index=False, sep='\t')
+
+
+def selected_patches(output_dir, fold):
+    """
+    Reads the patches selected for a fold.
+
+    :param output_dir: (str) path to the output directory.
+    :param fold: (int) fold of the selection.
+    :return: (np.array) indices of the selected patches, or None if all the patches are used.
+    """
+    selection_path = os.path.join(output_dir, 'performances', 'fold_%i' % fold, 'patch_selection.tsv')
+    if not os.path.exists(selection_path):
+        return None
+
+    selection_df = pd.read_csv(selection_path, sep='\t')
+    return selection_df.patch_id.values[selection_df.selected.values.astype(bool)]
+
+
 def retrieve_patch_level_results(output_dir, fold, selection, dataset, num_cnn):
     """Retrieve performance_df for single or multi-CNN framework."""
     if num_cnn is None:
@@ -525,8 +685,14 @@ def retrieve_patch_level_results(output_dir, fold, selection, dataset, num_cnn):
         performance_df = pd.read_csv(result_tsv, sep='\t')
 
     else:
+        # the CNNs of the patches excluded by select_patches were not trained
+        cnn_indices = selected_patches(output_dir, fold)
+        if cnn_indices is None:
+            cnn_indices = np.arange(num_cnn)
+        else:
+            cnn_indices = cnn_indices[cnn_indices < num_cnn]
         performance_df = pd.DataFrame()
-        for cnn in range(num_cnn):
+        for cnn in cnn_indices:
             tsv_path = os.path.join(output_dir, 'performances', 'fold_%i' % fold, 'cnn-%i' % cnn, selection,
                                     dataset + '_patch_level_result-patch_index.tsv')
             cnn_df = pd.read_csv(tsv_path, sep='\t')
@@ -536,7 +702,8 @@ def retrieve_patch_level_results(output_dir, fold, selection, dataset, num_cnn):
     return performance_df
 
 
-def soft_voting_to_tsvs(output_dir, fold, selection, dataset='test', num_cnn=None, selection_threshold=None):
+def soft_voting_to_tsvs(output_dir, fold, selection, dataset='test', num_cnn=None, selection_threshold=None,
+                        method='soft'):
     """
     Save soft voting results to tsv files.
 
@@ -548,6 +715,7 @@ def soft_voting_to_tsvs(output_dir, fold, selection, dataset='test', num_cnn=Non
     :param num_cnn: (int) if given load the patch level results of a multi-CNN framework.
     :param selection_threshold: (float) all patches for which the classification accuracy is below the
                                 threshold is removed.
+    :param method: (str) 'soft' to combine the probabilities or 'hard' to combine the predicted labels.
 
     """
 
@@ -563,17 +731,18 @@ def soft_voting_to_tsvs(output_dir, fold, selection, dataset='test', num_cnn=Non
     if not os.path.exists(performance_path):
         os.makedirs(performance_path)
 
-    df_final, metrics = soft_voting(test_df, validation_df, selection_threshold=selection_threshold)
+    df_final, metrics = soft_voting(test_df, validation_df, selection_threshold=selection_threshold,
+                                    method=method)
 
-    df_final.to_csv(os.path.join(os.path.join(performance_path, dataset + '_subject_level_result_soft_vote.tsv')),
+    df_final.to_csv(os.path.join(performance_path, dataset + '_subject_level_result_%s_vote.tsv' % method),
                     index=False, sep='\t')
 
     pd.DataFrame(metrics, index=[0]).to_csv(os.path.join(output_dir, 'performances', 'fold_%i' % fold, selection,
-                                                         dataset + '_subject_level_metrics_soft_vote.tsv'),
+                                                         dataset + '_subject_level_metrics_%s_vote.tsv' % method),
                                             index=False, sep='\t')
 
 
-def soft_voting(performance_df, validation_df, selection_threshold=None):
+def soft_voting(performance_df, validation_df, selection_threshold=None, method='soft'):
     """
     Computes soft voting based on the probabilities in performance_df. Weights are computed based on the accuracies
     of validation_df.
@@ -583,54 +752,13 @@ def soft_voting(performance_df, validation_df, selection_threshold=None):
     :param validation_df: (DataFrame) results on patch level of the set used to compute the weights.
     :param selection_threshold: (float) if given, all patches for which the classification accuracy is below the
                                 threshold is removed.
+    :param method: (str) 'soft' to combine the probabilities or 'hard' to combine the predicted labels.
     :return:
         - df_final (DataFrame) the results on the subject level
         - results (dict) the metrics on the subject level
     """
 
-    # Compute the patch accuracies on the validation set:
-    right_classified_df = validation_df[validation_df['true_label'] == validation_df['predicted_label']]
-    n_valid = len(validation_df.groupby(['participant_id', 'session_id']).nunique())
-    patch_accuracies = right_classified_df['patch_id'].value_counts() / n_valid
-    if selection_threshold is not None:
-        patch_accuracies[patch_accuracies < selection_threshold] = 0
-    weight_series = patch_accuracies / patch_accuracies.sum()
-
-    # Add the weights to performance_df
-    for idx in performance_df.index.values:
-        patch_id = performance_df.loc[idx, 'patch_id']
-        weight = weight_series.loc[patch_id]
-        performance_df.loc[idx, 'weight'] = weight
-
-    # do soft majority vote
-    columns = ['participant_id', 'session_id', 'true_label', 'predicted_label']
-    df_final = pd.DataFrame(columns=columns)
-    for subject_session, subject_df in performance_df.groupby(['participant_id', 'session_id']):
-        subject, session = subject_session
-        num_patch = len(subject_df.predicted_label)
-        p0_all = 0
-        p1_all = 0
-        # reindex the subject_df.probability
-        proba0_series_reindex = subject_df.proba0.reset_index()
-        proba1_series_reindex = subject_df.proba1.reset_index()
-        weight_series_reindex = subject_df.weight.reset_index()
-        y_series_reindex = subject_df.true_label.reset_index()
-        y = y_series_reindex.true_label[0]
-
-        for i in range(num_patch):
-
-            p0 = weight_series_reindex.weight[i] * float(proba0_series_reindex.proba0[i])
-            p1 = weight_series_reindex.weight[i] * float(proba1_series_reindex.proba1[i])
-
-            p0_all += p0
-            p1_all += p1
-
-        proba_list = [p0_all, p1_all]
-        y_hat = proba_list.index(max(proba_list))
-
-        row_array = np.array(list([subject, session, y, y_hat])).reshape(1, 4)
-        row_df = pd.DataFrame(row_array, columns=columns)
-        df_final = df_final.append(row_df)
+    df_final = vote(performance_df, validation_df, 'patch_id', method=method, selection_threshold=selection_threshold)
 
     results = evaluate_prediction(df_final.true_label.values.astype(int),
                                   df_final.predicted_label.values.astype(int))
@@ -646,12 +774,18 @@ def soft_voting(performance_df, validation_df, selection_threshold=None):
 class MRIDataset_patch(Dataset):
 
     def __init__(self, caps_directory, data_file, patch_size, stride_size, transformations=None, prepare_dl=False,
-                 patch_index=None):
+                 patch_index=None, packed=False, cache_size=0, patch_indices=None):
         """
         Args:
             caps_directory (string): Directory of all the images.
             data_file (string): File name of the train/test split file.
             transformations (callable, optional): Optional transformations to be applied on a sample.
+            packed (bool): if True and prepare_dl is True, patches are sliced from the packed array of the session
+                written by extract_patches instead of being loaded one file per patch.
+            cache_size (int): memory budget in bytes of the cache of whole images used when prepare_dl is False.
+                The whole image is then loaded once for all its patches as long as it stays in the cache.
+            patch_indices (list, optional): indices of the patches of each session used when patch_index is None
+                (see select_patches). If None all the patches are used.
 
         """
         self.caps_directory = caps_directory
@@ -661,6 +795,15 @@ class MRIDataset_patch(Dataset):
         self.stride_size = stride_size
         self.prepare_dl = prepare_dl
         self.patch_index = patch_index
+        self.packed = packed
+        if patch_indices is not None and patch_index is None:
+            self.patch_indices = np.asarray(patch_indices, dtype=np.int64)
+        else:
+            self.patch_indices = None
+        if cache_size > 0:
+            self.image_cache = ImageCache(cache_size)
+        else:
+            self.image_cache = None
 
         # Check the format of the tsv file here
         if isinstance(data_file, str):
@@ -675,32 +818,43 @@ class MRIDataset_patch(Dataset):
             raise Exception("the data file is not in the correct format."
                             "Columns should include ['participant_id', 'session_id', 'diagnosis']")
 
+        self.sessions = SessionIndex(self.df, self.diagnosis_code)
+        self.file_prefixes = np.char.add(self.sessions.caps_prefixes(self.caps_directory, 't1', 'preprocessing_dl'),
+                                         '_space-MNI_res-1x1x1')
+        self.patch_suffix = '_patchsize-' + str(self.patch_size) + '_stride-' + str(self.stride_size)
+
         self.patchs_per_patient = self.num_patches_per_session()
 
     def __len__(self):
-        return len(self.df) * self.patchs_per_patient
+        return len(self.sessions) * self.patchs_per_patient
 
     def __getitem__(self, idx):
         sub_idx = idx // self.patchs_per_patient
-        img_name = self.df.loc[sub_idx, 'participant_id']
-        sess_name = self.df.loc[sub_idx, 'session_id']
-        img_label = self.df.loc[sub_idx, 'diagnosis']
-        label = self.diagnosis_code[img_label]
-        if self.patch_index is None:
-            patch_idx = idx % self.patchs_per_patient
-        else:
+        img_name = str(self.sessions.participant_id[sub_idx])
+        sess_name = str(self.sessions.session_id[sub_idx])
+        label = int(self.sessions.label[sub_idx])
+        file_prefix = str(self.file_prefixes[sub_idx])
+        if self.patch_index is not None:
             patch_idx = self.patch_index
+        elif self.patch_indices is not None:
+            patch_idx = int(self.patch_indices[idx % self.patchs_per_patient])
+        else:
+            patch_idx = idx % self.patchs_per_patient
 
-        if self.prepare_dl:
-            patch_path = os.path.join(self.caps_directory, 'subjects', img_name, sess_name, 't1', 'preprocessing_dl',
-                                      img_name + '_' + sess_name + '_space-MNI_res-1x1x1_patchsize-' + str(self.patch_size)
-                                      + '_stride-' + str(self.stride_size) + '_patch-' + str(patch_idx) + '.pt')
+        if self.prepare_dl and self.packed:
+            packed_path = file_prefix + self.patch_suffix + '_patches.npy'
 
-            patch = torch.load(patch_path)
+            patch = load_packed_patch(packed_path, patch_idx)
+        elif self.prepare_dl:
+            patch_path = file_prefix + self.patch_suffix + '_patch-' + str(patch_idx) + '.pt'
+
+            patch = load_image(patch_path)
         else:
-            image_path = os.path.join(self.caps_directory, 'subjects', img_name, sess_name, 't1', 'preprocessing_dl',
-                                      img_name + '_' + sess_name + '_space-MNI_res-1x1x1.pt')
-            image = torch.load(image_path)
+            image_path = file_prefix + '.pt'
+            if self.image_cache is not None:
+                image = self.image_cache.load(image_path)
+            else:
+                image = load_image(image_path)
             patch = extract_patch_from_mri(image, patch_idx, self.patch_size, self.stride_size)
 
         # check if the patch has NaN value
@@ -716,23 +870,124 @@ class MRIDataset_patch(Dataset):
 
         return sample
 
+    def element_patches(self):
+        """:return: (tuple) arrays of the session and of the patch index of each element of the dataset."""
+        element_session = np.repeat(np.arange(len(self.sessions)), self.patchs_per_patient)
+        if self.patch_index is not None:
+            patches = np.array([self.patch_index], dtype=np.int64)
+        elif self.patch_indices is not None:
+            patches = self.patch_indices
+        else:
+            patches = np.arange(self.patchs_per_patient, dtype=np.int64)
+
+        return element_session, np.tile(patches, len(self.sessions))
+
     def num_patches_per_session(self):
         if self.patch_index is not None:
             return 1
+        if self.patch_indices is not None:
+            return len(self.patch_indices)
+
+        image_shape = caps_image_shape(self.caps_directory, str(self.file_prefixes[0]) + '.pt')
+
+        grid = patch_grid(image_shape, self.patch_size, self.stride_size)
+        return grid.num_patches
+
+
+class MRIDataset_patch_multi(Dataset):
+    """
+    Dataset giving the num_patches first patches of a session as one sample, used to train all the
+    heads of a MultiConv4_FC3 from one load of each session.
+    """
+
+    def __init__(self, caps_directory, data_file, patch_size, stride_size, num_patches, transformations=None,
+                 prepare_dl=False, packed=False, patch_indices=None):
+        """
+        Args:
+            caps_directory (string): Directory of all the images.
+            data_file (string): File name of the train/test split file.
+            num_patches (int): number of patches (and heads) of a sample.
+            patch_indices (list, optional): indices of the patches of a sample. If None, the num_patches first
+                patches are used.
+            transformations (callable, optional): Optional transformations to be applied on each patch.
+            packed (bool): if True and prepare_dl is True, patches are sliced from the packed array of the session
+                written by extract_patches instead of being loaded one file per patch.
 
-        img_name = self.df.loc[0, 'participant_id']
-        sess_name = self.df.loc[0, 'session_id']
+        """
+        self.caps_directory = caps_directory
+        self.transformations = transformations
+        self.diagnosis_code = {'CN': 0, 'AD': 1, 'sMCI': 0, 'pMCI': 1, 'MCI': 1, 'unlabeled': -1}
+        self.patch_size = patch_size
+        self.stride_size = stride_size
+        if patch_indices is None:
+            patch_indices = np.arange(num_patches)
+        self.patch_indices = np.asarray(patch_indices, dtype=np.int64)
+        self.num_patches = len(self.patch_indices)
+        self.prepare_dl = prepare_dl
+        self.packed = packed
+
+        # Check the format of the tsv file here
+        if isinstance(data_file, str):
+            self.df = pd.read_csv(data_file, sep='\t')
+        elif isinstance(data_file, pd.DataFrame):
+            self.df = data_file
+        else:
+            raise Exception('The argument datafile is not of correct type.')
+
+        if ('diagnosis' not in list(self.df.columns.values)) or ('session_id' not in list(self.df.columns.values)) or \
+           ('participant_id' not in list(self.df.columns.values)):
+            raise Exception("the data file is not in the correct format."
+                            "Columns should include ['participant_id', 'session_id', 'diagnosis']")
+
+        self.sessions = SessionIndex(self.df, self.diagnosis_code)
+        self.file_prefixes = np.char.add(self.sessions.caps_prefixes(self.caps_directory, 't1', 'preprocessing_dl'),
+                                         '_space-MNI_res-1x1x1')
 
-        image_path = os.path.join(self.caps_directory, 'subjects', img_name, sess_name, 't1', 'preprocessing_dl',
-                                  img_name + '_' + sess_name + '_space-MNI_res-1x1x1.pt')
-        image = torch.load(image_path)
+    def __len__(self):
+        return len(self.sessions)
+
+    def __getitem__(self, idx):
+        img_name = str(self.sessions.participant_id[idx])
+        sess_name = str(self.sessions.session_id[idx])
+        label = int(self.sessions.label[idx])
+        file_prefix = str(self.file_prefixes[idx])
+
+        if self.prepare_dl and self.packed:
+            packed_path = file_prefix + '_patchsize-' + str(self.patch_size) + '_stride-' + str(self.stride_size) \
+                          + '_patches.npy'
+            patches = np.load(packed_path, mmap_mode='r')
+        elif self.prepare_dl:
+            patches = None
+        else:
+            image = load_image(file_prefix + '.pt')
+            grid = patch_grid(tuple(image.shape), self.patch_size, self.stride_size)
+            patches = grid.extract_all_patches(image)
+
+        if patches is not None and self.patch_indices.max() >= len(patches):
+            raise ValueError("Only %i patches can be extracted from session %s %s, the patch %i is not available."
+                             % (len(patches), img_name, sess_name, self.patch_indices.max()))
+
+        # patches is of shape [num_patches, 1, patch_size, patch_size, patch_size]
+        if patches is None:
+            patches = torch.stack([load_image(file_prefix + '_patchsize-' + str(self.patch_size) + '_stride-'
+                                             + str(self.stride_size) + '_patch-' + str(patch_idx) + '.pt')
+                                   for patch_idx in self.patch_indices])
+        elif isinstance(patches, np.ndarray):
+            # only the rows of the wanted patches are read from the packed array
+            patches = torch.from_numpy(patches[self.patch_indices])
+        else:
+            patches = patches[torch.from_numpy(self.patch_indices)]
+        if torch.isnan(patches).any():
+            print("Double check, the patches of %s have NaN values." % str(img_name + '_' + sess_name))
+            patches[torch.isnan(patches)] = 0
 
-        patches_tensor = image.unfold(1, self.patch_size, self.stride_size
-                                      ).unfold(2, self.patch_size, self.stride_size
-                                               ).unfold(3, self.patch_size, self.stride_size).contiguous()
-        patches_tensor = patches_tensor.view(-1, self.patch_size, self.patch_size, self.patch_size)
-        num_patches = patches_tensor.shape[0]
-        return num_patches
+        if self.transformations:
+            patches = torch.stack([self.transformations(patch) for patch in patches])
+
+        sample = {'image_id': img_name + '_' + sess_name, 'image': patches.squeeze(1), 'label': label,
+                  'participant_id': img_name, 'session_id': sess_name, 'patch_id': torch.from_numpy(self.patch_indices)}
+
+        return sample
 
 
 class MRIDataset_patch_hippocampus(Dataset):
@@ -762,31 +1017,30 @@ class MRIDataset_patch_hippocampus(Dataset):
             raise Exception("the data file is not in the correct format."
                             "Columns should include ['participant_id', 'session_id', 'diagnosis']")
 
+        self.sessions = SessionIndex(self.df, self.diagnosis_code)
+        self.file_prefixes = np.char.add(self.sessions.caps_prefixes(self.caps_directory, 't1', 'preprocessing_dl'),
+                                         '_space-MNI_res-1x1x1')
+
         self.patchs_per_patient = 2
 
     def __len__(self):
-        return len(self.df) * self.patchs_per_patient
+        return len(self.sessions) * self.patchs_per_patient
 
     def __getitem__(self, idx):
         sub_idx = idx // self.patchs_per_patient
-        img_name = self.df.loc[sub_idx, 'participant_id']
-        sess_name = self.df.loc[sub_idx, 'session_id']
-        img_label = self.df.loc[sub_idx, 'diagnosis']
-        label = self.diagnosis_code[img_label]
+        img_name = str(self.sessions.participant_id[sub_idx])
+        sess_name = str(self.sessions.session_id[sub_idx])
+        label = int(self.sessions.label[sub_idx])
 
         # 1 is left hippocampus, 0 is right
         left_is_odd = idx % self.patchs_per_patient
 
         if left_is_odd == 1:
-            patch_path = os.path.join(self.caps_directory, 'subjects', img_name, sess_name, 't1',
-                                      'preprocessing_dl',
-                                      img_name + '_' + sess_name + '_space-MNI_res-1x1x1_hippocampus_hemi-left.pt')
+            patch_path = str(self.file_prefixes[sub_idx]) + '_hippocampus_hemi-left.pt'
         else:
-            patch_path = os.path.join(self.caps_directory, 'subjects', img_name, sess_name, 't1',
-                                      'preprocessing_dl',
-                                      img_name + '_' + sess_name + '_space-MNI_res-1x1x1_hippocampus_hemi-right.pt')
+            patch_path = str(self.file_prefixes[sub_idx]) + '_hippocampus_hemi-right.pt'
 
-        patch = torch.load(patch_path)
+        patch = load_image(patch_path)
 
         # check if the patch has NaN value
         if torch.isnan(patch).any():
@@ -802,13 +1056,66 @@ class MRIDataset_patch_hippocampus(Dataset):
         return sample
 
 
+def load_packed_patch(packed_path, index_patch):
+    """
+    Reads one patch from the packed array of a session without loading the other patches.
+
+    :param packed_path: (str) path to the .npy array written by extract_patches with packed=True.
+    :param index_patch: (int) index of the wanted patch, i.e. the row of the array.
+    :return: (tensor) the patch of shape [1, patch_size, patch_size, patch_size]
+    """
+    patches_array = np.load(packed_path, mmap_mode='r')
+    # copy the row only, the other pages of the array are not read
+    return torch.from_numpy(np.array(patches_array[index_patch]))
+
+
 def extract_patch_from_mri(image_tensor, index_patch, patch_size, stride_size):
+    """
+    Returns a copy of the patch of index index_patch of an image, without computing the other patches.
+    The patch is copied so that the NaN replacement and the transformations never modify the image, which
+    may be shared by the other patches through the ImageCache.
+
+    :param image_tensor: (tensor) image of shape [C, X, Y, Z].
+    :param index_patch: (int) index of the patch.
+    :param patch_size: (int) size of the patches.
+    :param stride_size: (int) stride between two patches.
+    :return: (tensor) patch of shape [C, patch_size, patch_size, patch_size].
+    """
+    grid = patch_grid(tuple(image_tensor.shape), patch_size, stride_size)
+
+    return grid.extract_patch(image_tensor, index_patch).clone()
 
-    # use classifiers tensor.upfold to crop the patch.
-    patches_tensor = image_tensor.unfold(1, patch_size, stride_size
-                                         ).unfold(2, patch_size, stride_size
-                                                  ).unfold(3, patch_size, stride_size).contiguous()
-    patches_tensor = patches_tensor.view(-1, patch_size, patch_size, patch_size)
-    extracted_patch = patches_tensor[index_patch, ...].unsqueeze_(0).clone()
 
-    return extracted_patch
+def cache_patch_features(model, dataset, feature_cache, batch_size=32, num_workers=0, gpu=False):
+    """
+    Computes the encoder features of the patches of dataset which are not yet in the feature cache.
+    The features of a patch are keyed by the signature of the image from which it is extracted, the patch size,
+    the stride and its index.
+
+    :param model: (Module) model whose features are frozen (see encoder_feature_cache).
+    :param dataset: (MRIDataset_patch) dataset of the patches.
+    :param feature_cache: (FeatureCache) the cache.
+    :param batch_size: (int) size of the batches in which the features are computed.
+    :param num_workers: (int) number of data loading workers.
+    :param gpu: (bool) if True a gpu is used.
+    :return: (CachedFeatureDataset) dataset whose samples have the same keys as the samples of dataset.
+    """
+    from ..tools.deep_learning.feature_cache import cache_features, file_signature
+
+    element_session, element_patch = dataset.element_patches()
+    session_signatures = [file_signature(str(file_prefix) + '.pt') for file_prefix in dataset.file_prefixes]
+    keys = ['%s%s_patch-%i' % (session_signatures[session], dataset.patch_suffix, patch_idx)
+            for session, patch_idx in zip(element_session, element_patch)]
+
+    participant_id = dataset.sessions.participant_id[element_session]
+    session_id = dataset.sessions.session_id[element_session]
+    image_id = np.char.add(np.char.add(np.char.add(participant_id, '_'), session_id),
+                           np.char.add('_patch', element_patch.astype(str)))
+    metadata = {'image_id': image_id,
+                'label': dataset.sessions.label[element_session],
+                'participant_id': participant_id,
+                'session_id': session_id,
+                'patch_id': element_patch}
+
+    return cache_features(model.features, model, dataset, keys, metadata, feature_cache,
+                          batch_size=batch_size, num_workers=num_workers, gpu=gpu)
@@ -6,13 +6,16 @@ def extract_dl_t1w(caps_directory,
                    patch_size=50,
                    stride_size=50,
                    slice_direction=0,
-                   slice_mode='original'):
+                   slice_mode='original',
+                   packed=False,
+                   storage_dtype='float32',
+                   compress=False):
     """ This is a preprocessing pipeline to convert the MRIs in nii.gz format
     into tensor versions (using pytorch format). It also prepares the
     slice-level and patch-level data from the entire MRI and save them on disk.
     This enables the training process:
         - For slice-level CNN, all slices were extracted from the entire
-          MRI from three different axis. The first and last 15 slice were
+          MRI from three different axis. The first and last 20 slice were
           discarded due to the lack of information.
         - For patch-level CNN, the 3D patch (with specific patch size)
           were extracted by a 3D window.
@@ -33,15 +36,26 @@ def extract_dl_t1w(caps_directory,
       Size for extracted 3D patches (only 'patch' method).
     stride_size: int
       Sliding size window of when extracting the patches (only 'patch' method).
-    slice_direction: int
-      Which direction the slices will be extracted (only 'slice' method):
+    slice_direction: int or list of int
+      Which direction(s) the slices will be extracted (only 'slice' method),
+      all the directions are extracted from one load of the image:
       - 0: Sagittal plane
       - 1: Coronal plane
       - 2: Axial plane
     slice_mode: str
       Mode how slices are stored (only 'slice' method):
       - original: saves one single channel (intensity)
-      - rgb: saves with three channels (red, green, blue)
+      - rgb: saves the normalized intensity used as the three channels
+        (red, green, blue), stored with one channel
+    packed: bool
+      If True, all the patches of a session are saved in one memory-mappable
+      array instead of one file per patch (only 'patch' method).
+    storage_dtype: str
+      Dtype of the saved tensors, decoded to float32 when they are loaded:
+      - float32 or float16
+      - uint16 or uint8: quantized between the minimum and maximum values
+    compress: bool
+      If True the saved tensors are compressed with zlib.
     working_directory: str
       Folder containing a temporary space to save intermediate results.
     e
@@ -142,28 +156,32 @@ def extract_dl_t1w(caps_directory,
 
     # The processing nodes
 
+    # The read node iterates over the sessions, so that each of the following
+    # nodes processes one image: plain Nodes avoid the overhead of MapNodes
+    # and the sessions are processed in parallel by the MultiProc plugin.
+
     # Node to save MRI in nii.gz format into pytorch .pt format
     # ----------------------
-    save_as_pt = npe.MapNode(
+    save_as_pt = npe.Node(
            name='save_as_pt',
-           iterfield=['input_img'],
            interface=nutil.Function(
                function=save_as_pt,
-               input_names=['input_img'],
-               output_names=['output_file']
+               input_names=['input_img', 'dtype', 'compress'],
+               output_names=['output_file', 'shape_file']
                )
            )
+    save_as_pt.inputs.dtype = storage_dtype
+    save_as_pt.inputs.compress = compress
 
     # Extract slices node (options: 3 directions, mode)
     # ----------------------
-    extract_slices = npe.MapNode(
+    extract_slices = npe.Node(
             name='extract_slices',
-            iterfield=['preprocessed_T1'],
             interface=nutil.Function(
                 function=extract_slices,
                 input_names=[
                     'preprocessed_T1', 'slice_direction',
-                    'slice_mode'
+                    'slice_mode', 'dtype', 'compress'
                     ],
                 output_names=['output_file_rgb', 'output_file_original']
                 )
@@ -171,21 +189,25 @@ def extract_dl_t1w(caps_directory,
 
     extract_slices.inputs.slice_direction = slice_direction
     extract_slices.inputs.slice_mode = slice_mode
+    extract_slices.inputs.dtype = storage_dtype
+    extract_slices.inputs.compress = compress
 
     # Extract patches node (options, patch size and stride size)
     # ----------------------
-    extract_patches = npe.MapNode(
+    extract_patches = npe.Node(
             name='extract_patches',
-            iterfield=['preprocessed_T1'],
             interface=nutil.Function(
                 function=extract_patches,
-                input_names=['preprocessed_T1', 'patch_size', 'stride_size'],
+                input_names=['preprocessed_T1', 'patch_size', 'stride_size', 'packed', 'dtype', 'compress'],
                 output_names=['output_patch']
                 )
             )
 
     extract_patches.inputs.patch_size = patch_size
     extract_patches.inputs.stride_size = stride_size
+    extract_patches.inputs.packed = packed
+    extract_patches.inputs.dtype = storage_dtype
+    extract_patches.inputs.compress = compress
 
     # Output node
     # ----------------------
@@ -233,6 +255,7 @@ def extract_dl_t1w(caps_directory,
         (read_node, save_as_pt, [('t1w', 'input_img')]),
         (image_id_node, get_ids, [('image_id', 'image_id')]),
         # Connect to DataSink
+        (save_as_pt, write_node, [('shape_file', '@image_shape')]),
         (get_ids, write_node, [('image_id_out', '@image_id')]),
         (get_ids, write_node, [('subst_ls', 'substitutions')])
         ])
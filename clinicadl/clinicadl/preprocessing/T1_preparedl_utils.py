@@ -1,166 +1,135 @@
 
-def extract_slices(preprocessed_T1, slice_direction=0, slice_mode='original'):
+def save_tensors(tensors, output_files, n_threads=4, dtype='float32', compress=False):
     """
-    This function extracts the slices from three directions
+    Saves each tensor of tensors in the corresponding file of output_files, using a bounded pool of threads
+    so that the writes of one session overlap.
+
+    :param tensors: (iterable) tensors to save.
+    :param output_files: (list) paths of the .pt files.
+    :param n_threads: (int) maximum number of files written at the same time.
+    :param dtype: (str) storage dtype of the tensors (see clinicadl.tools.deep_learning.data.encode_image).
+    :param compress: (bool) if True the tensors are compressed.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from functools import partial
+    from clinicadl.tools.deep_learning.data import save_image
+
+    with ThreadPoolExecutor(max_workers=max(1, n_threads)) as executor:
+        # list() forwards the exceptions raised in the threads
+        list(executor.map(partial(save_image, dtype=dtype, compress=compress), tensors, output_files))
+
+
+def extract_slices(preprocessed_T1, slice_direction=0, slice_mode='original', n_threads=4, dtype='float32',
+                   compress=False):
+    """
+    This function extracts the slices from three directions.
+    All the slices of an axis are normalized together as one batched tensor, and several axes can be
+    extracted from one load of the image.
     :param preprocessed_T1:
-    :param slice_direction: which axis direction that the slices were extracted
+    :param slice_direction: (int or list of int) axis direction(s) in which the slices are extracted
+                            (0: sagittal, 1: coronal, 2: axial).
+    :param slice_mode: 'original' to save the slice or 'rgb' to save the normalized slice used to build the RGB
+                       image. In both cases one channel is saved, the three channels of the RGB image are
+                       created when the slice is loaded.
+    :param n_threads: (int) number of threads writing the slices.
+    :param dtype: (str) storage dtype of the slices (see clinicadl.tools.deep_learning.data.encode_image).
+    :param compress: (bool) if True the slices are compressed.
     :return:
     """
-    import torch
     import os
+    from clinicadl.preprocessing.T1_preparedl_utils import save_tensors
+    from clinicadl.tools.deep_learning.data import load_image, DISCARDED_SLICES, SLICE_AXES
 
-    image_tensor = torch.load(preprocessed_T1)
+    if isinstance(slice_direction, int):
+        slice_direction = [slice_direction]
+
+    image_tensor = load_image(preprocessed_T1)
     # reshape the tensor, delete the first dimension for slice-level
     image_tensor = image_tensor.view(image_tensor.shape[1], image_tensor.shape[2], image_tensor.shape[3])
 
-    # sagital
-    slice_list_sag = range(20, image_tensor.shape[0] - 20)  # delete the first 20 slice and last 20 slices
-
     basedir = os.getcwd()
+    prefix = os.path.join(basedir, os.path.basename(preprocessed_T1).split('.pt')[0])
     output_file_original = []
     output_file_rgb = []
-    if slice_direction == 0:
-        for index_slice, index_slice_list in zip(slice_list_sag, range(len(slice_list_sag))):
-            # for i in slice_list:
-            # sagital
-            slice_select_sag = image_tensor[index_slice, :, :]
-
-            # convert the slices to images based on if transfer learning or not
-            # train from scratch
-            extracted_slice_original_sag = slice_select_sag.unsqueeze(0)  # shape should be 1 * W * L
-
-            # train for transfer learning, creating the fake RGB image.
-            slice_select_sag = (slice_select_sag - slice_select_sag.min()) / (slice_select_sag.max() - slice_select_sag.min())
-            extracted_slice_rgb_sag = torch.stack((slice_select_sag, slice_select_sag, slice_select_sag))  # shape should be 3 * W * L
-
-            # save into .pt format
-            if slice_mode == 'original':
-                output_file_original.append(
-                        os.path.join(
-                            basedir,
-                            os.path.basename(preprocessed_T1).split('.pt')[0]
-                            + '_axis-sag_originalslice-'
-                            + str(index_slice)
-                            + '.pt'
-                            )
-                        )
-                torch.save(extracted_slice_original_sag.clone(), output_file_original[index_slice_list])
-            elif slice_mode == 'rgb':
-                output_file_rgb.append(
-                        os.path.join(
-                            basedir,
-                            os.path.basename(preprocessed_T1).split('.pt')[0]
-                            + '_axis-sag_rgbslice-'
-                            + str(index_slice)
-                            + '.pt'
-                            )
-                        )
-                torch.save(extracted_slice_rgb_sag.clone(), output_file_rgb[index_slice_list])
-
-    elif slice_direction == 1:
-        # cornal
-        slice_list_cor = range(15, image_tensor.shape[1] - 15)  # delete the first 20 slice and last 15 slices
-        for index_slice, index_slice_list in zip(slice_list_cor, range(len(slice_list_cor))):
-            # for i in slice_list:
-            # sagital
-            slice_select_cor = image_tensor[:, index_slice, :]
-
-            # convert the slices to images based on if transfer learning or not
-            # train from scratch
-            extracted_slice_original_cor = slice_select_cor.unsqueeze(0)  # shape should be 1 * W * L
-
+    for direction in slice_direction:
+        axis_name = SLICE_AXES[direction]
+        slice_list = range(DISCARDED_SLICES, image_tensor.shape[direction] - DISCARDED_SLICES)
+
+        # shape of slices is [n_slices, W, L]
+        other_dims = [dim for dim in range(3) if dim != direction]
+        slices = image_tensor.narrow(direction, DISCARDED_SLICES, len(slice_list)).permute(direction, *other_dims)
+
+        if slice_mode == 'original':
+            # train from scratch, shape of each slice should be 1 * W * L
+            extracted_slices = slices.unsqueeze(1)
+            output_files = [prefix + '_axis-' + axis_name + '_originalslice-' + str(index_slice) + '.pt'
+                            for index_slice in slice_list]
+            output_file_original += output_files
+        elif slice_mode == 'rgb':
             # train for transfer learning, creating the fake RGB image.
-            slice_select_cor = (slice_select_cor - slice_select_cor.min()) / (slice_select_cor.max() - slice_select_cor.min())
-            extracted_slice_rgb_cor = torch.stack((slice_select_cor, slice_select_cor, slice_select_cor))  # shape should be 3 * W * L
-
-            # save into .pt format
-            if slice_mode == 'original':
-                output_file_original.append(
-                        os.path.join(
-                            basedir,
-                            os.path.basename(preprocessed_T1).split('.pt')[0]
-                            + '_axis-cor_originalslice-'
-                            + str(index_slice)
-                            + '.pt')
-                        )
-                torch.save(extracted_slice_original_cor.clone(), output_file_original[index_slice_list])
-            elif slice_mode == 'rgb':
-                output_file_rgb.append(
-                    os.path.join(
-                        basedir,
-                        os.path.basename(preprocessed_T1).split('.pt')[0]
-                        + '_axis-cor_rgbslice-'
-                        + str(index_slice)
-                        + '.pt'
-                        )
-                    )
-                torch.save(extracted_slice_rgb_cor.clone(), output_file_rgb[index_slice_list])
-
-    else:
-
-        # axial
-        slice_list_axi = range(15, image_tensor.shape[2] - 15)  # delete the first 20 slice and last 15 slices
-        for index_slice, index_slice_list in zip(slice_list_axi, range(len(slice_list_axi))):
-            # for i in slice_list:
-            # sagital
-            slice_select_axi = image_tensor[:, :, index_slice]
-
-            # convert the slices to images based on if transfer learning or not
-            # train from scratch
-            extracted_slice_original_axi = slice_select_axi.unsqueeze(0)  # shape should be 1 * W * L
-
-            # train for transfer learning, creating the fake RGB image.
-            slice_select_axi = (slice_select_axi - slice_select_axi.min()) / (slice_select_axi.max() - slice_select_axi.min())
-            extracted_slice_rgb_axi = torch.stack((slice_select_axi, slice_select_axi, slice_select_axi))  # shape should be 3 * W * L
-
-            # save into .pt format
-            if slice_mode == 'original':
-                output_file_original.append(
-                        os.path.join(
-                            basedir,
-                            os.path.basename(preprocessed_T1).split('.pt')[0]
-                            + '_axis-axi_originalslice-'
-                            + str(index_slice)
-                            + '.pt'
-                            )
-                        )
-                torch.save(extracted_slice_original_axi.clone(), output_file_original[index_slice_list])
-            elif slice_mode == 'rgb':
-                output_file_rgb.append(
-                        os.path.join(
-                            basedir,
-                            os.path.basename(preprocessed_T1).split('.pt')[0]
-                            + '_axis-axi_rgbslice-'
-                            + str(index_slice)
-                            + '.pt'
-                            )
-                        )
-                torch.save(extracted_slice_rgb_axi.clone(), output_file_rgb[index_slice_list])
+            flat_slices = slices.reshape(len(slice_list), -1)
+            slice_min = flat_slices.min(dim=1)[0].view(-1, 1, 1)
+            slice_max = flat_slices.max(dim=1)[0].view(-1, 1, 1)
+            normalized_slices = (slices - slice_min) / (slice_max - slice_min)
+            # shape of each slice should be 1 * W * L, the channel is duplicated by the datasets
+            extracted_slices = normalized_slices.unsqueeze(1)
+            output_files = [prefix + '_axis-' + axis_name + '_rgbslice-' + str(index_slice) + '.pt'
+                            for index_slice in slice_list]
+            output_file_rgb += output_files
+        else:
+            raise ValueError("The slice mode %s must be in ['original', 'rgb']." % slice_mode)
+
+        # each slice is copied when it is saved, so the file does not contain the storage of the whole axis
+        save_tensors(extracted_slices, output_files, n_threads, dtype, compress)
 
     return output_file_rgb, output_file_original
 
 
-def extract_patches(preprocessed_T1, patch_size, stride_size):
+def extract_patches(preprocessed_T1, patch_size, stride_size, packed=False, n_threads=4, dtype='float32',
+                    compress=False):
     """
     This function extracts the patches from three directions
     :param preprocessed_T1:
+    :param packed: if True all the patches of the session are saved in one
+                   memory-mappable .npy array of shape [num_patches, 1, patch_size, patch_size, patch_size],
+                   in which the patch of index i is stored at row i.
+    :param n_threads: (int) number of threads writing the patches.
+    :param dtype: (str) storage dtype of the patches (see clinicadl.tools.deep_learning.data.encode_image).
+                  The packed array is always stored in float32.
+    :param compress: (bool) if True the patches are compressed (not used for the packed array).
     :return:
     """
-    import torch
+    import numpy as np
     import os
+    from clinicadl.tools.deep_learning.data import patch_grid, load_image, write_patch_occupancy
+    from clinicadl.preprocessing.T1_preparedl_utils import save_tensors
 
     basedir = os.getcwd()
-    image_tensor = torch.load(preprocessed_T1)
+    image_tensor = load_image(preprocessed_T1)
 
-    # use classifiers tensor.upfold to crop the patch.
-    patches_tensor = image_tensor.unfold(1, patch_size, stride_size).unfold(2, patch_size, stride_size).unfold(3, patch_size, stride_size).contiguous()
-    # the dimension of patch_tensor should be [1, patch_num1, patch_num2, patch_num3, patch_size1, patch_size2, patch_size3]
-    patches_tensor = patches_tensor.view(-1, patch_size, patch_size, patch_size)
+    # the dimension of patches_tensor is [num_patches, 1, patch_size1, patch_size2, patch_size3]
+    patches_tensor = patch_grid(tuple(image_tensor.shape), patch_size, stride_size).extract_all_patches(image_tensor)
+
+    # the fraction of foreground of each patch is used to select the patches used for training
+    output_patch = [write_patch_occupancy(image_tensor, os.path.join(basedir, os.path.basename(preprocessed_T1)),
+                                          patch_size, stride_size)]
+    if packed:
+        # one contiguous array per session: the offset of a patch is its index times the size of a patch
+        output_patch.append(
+                os.path.join(
+                    basedir,
+                    os.path.basename(preprocessed_T1).split('.pt')[0]
+                    + '_patchsize-'
+                    + str(patch_size)
+                    + '_stride-'
+                    + str(stride_size)
+                    + '_patches.npy'
+                    )
+                )
+        np.save(output_patch[-1], patches_tensor.numpy().astype(np.float32, copy=False))
+        return output_patch
 
-    output_patch = []
     for index_patch in range(patches_tensor.shape[0]):
-        extracted_patch = patches_tensor[index_patch, ...].unsqueeze_(0)  # add one dimension
-        # save into .pt format
         output_patch.append(
                 os.path.join(
                     basedir,
@@ -174,22 +143,27 @@ def extract_patches(preprocessed_T1, patch_size, stride_size):
                     + '.pt'
                     )
                 )
-        torch.save(extracted_patch.clone(), output_patch[index_patch])
+    # save into .pt format, the first output is the occupancy file
+    save_tensors(patches_tensor, output_patch[1:], n_threads, dtype, compress)
 
     return output_patch
 
 
-def save_as_pt(input_img):
+def save_as_pt(input_img, dtype='float32', compress=False):
     """
     This function transforms  nii.gz file into .pt format, in order to train
     the classifiers model more efficient when loading the data.
     :param input_img:
-    :return:
+    :param dtype: (str) storage dtype of the image (see clinicadl.tools.deep_learning.data.encode_image).
+    :param compress: (bool) if True the image is compressed.
+    :return: the path to the .pt file and the path to the json sidecar storing the shape of the image and the
+             foreground of its slices, which is read by the datasets instead of loading an image.
     """
 
     import torch
     import os
     import nibabel as nib
+    from clinicadl.tools.deep_learning.data import save_image, write_image_metadata
 
     basedir = os.getcwd()
     image_array = nib.load(input_img).get_fdata()
@@ -197,9 +171,10 @@ def save_as_pt(input_img):
     # make sure the tensor dtype is torch.float32
     output_file = os.path.join(basedir, os.path.basename(input_img).split('.nii.gz')[0] + '.pt')
     # save
-    torch.save(image_tensor.clone(), output_file)
+    save_image(image_tensor, output_file, dtype, compress)
+    shape_file = write_image_metadata(image_tensor, output_file)
 
-    return output_file
+    return output_file, shape_file
 
 # Get containers to ptoduce the CAPS structure
 def container_from_filename(bids_or_caps_filename):
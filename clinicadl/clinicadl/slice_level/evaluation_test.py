@@ -1,12 +1,11 @@
 import argparse
-import torchvision.transforms as transforms
 from torch.utils.data import DataLoader
 import torch
 import os
 
-from .utils import MRIDataset_slice, test, slice_level_to_tsvs, soft_voting_to_tsvs
+from .utils import MRIDataset_slice, SliceBatchTransform, test, slice_level_to_tsvs, soft_voting_to_tsvs
 from ..tools.deep_learning import create_model, load_model
-from ..tools.deep_learning.data import MinMaxNormalization, load_data_test, load_data
+from ..tools.deep_learning.data import load_data_test, load_data
 
 __author__ = "Junhao Wen"
 __copyright__ = "Copyright 2018 The Aramis Lab Team"
@@ -72,10 +71,8 @@ def main(options):
     # All pre-trained models expect input images normalized in the same way, i.e. mini-batches of 3-channel RGB
     # images of shape (3 x H x W), where H and W are expected to be at least 224. The images have to be loaded in
     # to a range of [0, 1] and then normalized using mean = [0.485, 0.456, 0.406] and std = [0.229, 0.224, 0.225].
-    transformations = transforms.Compose([MinMaxNormalization(),
-                                          transforms.ToPILImage(),
-                                          transforms.Resize(trg_size),
-                                          transforms.ToTensor()])
+    # The slices are normalized and resized by batch when they are collated.
+    batch_transform = SliceBatchTransform(trg_size)
     # Define loss and optimizer
     loss = torch.nn.CrossEntropyLoss()
 
@@ -94,14 +91,14 @@ def main(options):
         else:
             test_df = load_data_test(options.diagnosis_tsv_path, options.diagnoses)
 
-        data_test = MRIDataset_slice(options.caps_directory, test_df,
-                                     transformations=transformations, mri_plane=options.mri_plane,
+        data_test = MRIDataset_slice(options.caps_directory, test_df, mri_plane=options.mri_plane,
                                      prepare_dl=options.prepare_dl)
 
         test_loader = DataLoader(data_test,
                                  batch_size=options.batch_size,
                                  shuffle=False,
                                  num_workers=options.num_workers,
+                                 collate_fn=batch_transform,
                                  pin_memory=True)
 
         # load the best trained model during the training
@@ -1,5 +1,4 @@
 import argparse
-import torchvision.transforms as transforms
 from tensorboardX import SummaryWriter
 from torch.utils.data import DataLoader
 import copy
@@ -8,9 +7,11 @@ import os
 import numpy as np
 from time import time
 
-from .utils import MRIDataset_slice, train, test, slice_level_to_tsvs, soft_voting_to_tsvs
+from .utils import MRIDataset_slice, train, train_metrics, test, slice_level_to_tsvs, soft_voting_to_tsvs
+from .utils import SliceBatchTransform, SliceFeatureCache, cache_trunk_features
 from ..tools.deep_learning import EarlyStopping, save_checkpoint, commandline_to_json, create_model, load_model
-from ..tools.deep_learning.data import load_data, MinMaxNormalization
+from ..tools.deep_learning.data import load_data, generate_sampler, generate_probe_loader
+from ..tools.deep_learning.resources import apply_resource_plan, worker_init_function
 
 __author__ = "Junhao Wen"
 __copyright__ = "Copyright 2018-2020 The Aramis Lab Team"
@@ -27,6 +28,8 @@ __status__ = "Development"
 
 def train_slice(params):
 
+    apply_resource_plan(params.resource_plan)
+
     # Initialize the model
     print('Do transfer learning with existed model trained on ImageNet!\n')
     print('The chosen network is %s !' % params.model)
@@ -37,10 +40,19 @@ def train_slice(params):
     # All pre-trained models expect input images normalized in the same way, i.e. mini-batches of 3-channel RGB
     # images of shape (3 x H x W), where H and W are expected to be at least 224. The images have to be loaded in
     # to a range of [0, 1] and then normalized using mean = [0.485, 0.456, 0.406] and std = [0.229, 0.224, 0.225].
-    transformations = transforms.Compose([MinMaxNormalization(),
-                                          transforms.ToPILImage(),
-                                          transforms.Resize(trg_size),
-                                          transforms.ToTensor()])
+    # The slices are normalized and resized by batch when they are collated.
+    batch_transform = SliceBatchTransform(trg_size)
+
+    if params.feature_cache is not None:
+        # the outputs of the frozen layers are computed once per slice and shared by all folds and epochs,
+        # the training only runs the last layers
+        feature_cache = SliceFeatureCache(params.feature_cache, model, params.mri_plane,
+                                          dtype=params.feature_cache_dtype)
+        model.trunk_cached = True
+        collate_fn = None
+    else:
+        feature_cache = None
+        collate_fn = batch_transform
 
     # calculate the time consummation
     total_time = time()
@@ -58,24 +70,42 @@ def train_slice(params):
 
         print("Running for the %d-th fold" % fi)
 
-        data_train = MRIDataset_slice(params.input_dir, training_tsv, transformations=transformations,
-                                      mri_plane=params.mri_plane, prepare_dl=params.prepare_dl)
-        data_valid = MRIDataset_slice(params.input_dir, valid_tsv, transformations=transformations,
-                                      mri_plane=params.mri_plane, prepare_dl=params.prepare_dl)
+        data_train = MRIDataset_slice(params.input_dir, training_tsv,
+                                      mri_plane=params.mri_plane, prepare_dl=params.prepare_dl,
+                                      cache_size=params.image_cache_size * 1024 ** 2,
+                                      foreground_threshold=params.foreground_threshold)
+        data_valid = MRIDataset_slice(params.input_dir, valid_tsv,
+                                      mri_plane=params.mri_plane, prepare_dl=params.prepare_dl,
+                                      cache_size=params.image_cache_size * 1024 ** 2,
+                                      foreground_threshold=params.foreground_threshold)
+
+        if feature_cache is not None:
+            data_train = cache_trunk_features(model, data_train, feature_cache, batch_transform,
+                                              batch_size=params.batch_size, num_workers=params.num_workers,
+                                              gpu=params.gpu)
+            data_valid = cache_trunk_features(model, data_valid, feature_cache, batch_transform,
+                                              batch_size=params.batch_size, num_workers=params.num_workers,
+                                              gpu=params.gpu)
 
         # Use argument load to distinguish training and testing
         train_loader = DataLoader(data_train,
                                   batch_size=params.batch_size,
-                                  shuffle=True,
+                                  sampler=generate_sampler(data_train, params.sampler),
                                   num_workers=params.num_workers,
+                                  worker_init_fn=worker_init_function(params.resource_plan),
+                                  collate_fn=collate_fn,
                                   pin_memory=True)
 
         valid_loader = DataLoader(data_valid,
                                   batch_size=params.batch_size,
                                   shuffle=False,
                                   num_workers=params.num_workers,
+                                  worker_init_fn=worker_init_function(params.resource_plan),
+                                  collate_fn=collate_fn,
                                   pin_memory=True)
 
+        probe_loader = generate_probe_loader(train_loader, params.train_probe_size)
+
         # chosen optimizer for back-propagation
         optimizer = eval("torch.optim." + params.optimizer)(filter(lambda x: x.requires_grad, model.parameters()), params.learning_rate, weight_decay=params.weight_decay)
 
@@ -103,12 +133,14 @@ def train_slice(params):
             # train the model
             train_df, acc_mean_train, loss_batch_mean_train, global_step \
                 = train(model, train_loader, params.gpu, loss, optimizer, writer_train_batch, epoch,
-                        model_mode='train', selection_threshold=params.selection_threshold)
+                        model_mode='train', selection_threshold=params.selection_threshold,
+                        precision=params.precision)
 
-            # calculate the accuracy with the whole training data for subject level balanced accuracy
-            train_all_df, acc_mean_train_all, loss_batch_mean_train_all, _\
-                = train(model, train_loader, params.gpu, loss, optimizer, writer_train_all_data, epoch,
-                        model_mode='valid', selection_threshold=params.selection_threshold)
+            # calculate the subject level training accuracy without a second pass on all the training data
+            acc_mean_train_all, loss_batch_mean_train_all \
+                = train_metrics(model, train_df, loss_batch_mean_train, probe_loader, epoch, params.gpu, loss,
+                                writer_train_all_data, epoch, probe_frequency=params.train_probe_frequency,
+                                selection_threshold=params.selection_threshold)
             print("For training, subject level balanced accuracy is %f at the end of epoch %d" % (acc_mean_train_all, epoch))
 
             # at then end of each epoch, we validate one time for the model with the validation data
@@ -1,5 +1,4 @@
 import argparse
-import torchvision.transforms as transforms
 from tensorboardX import SummaryWriter
 from torch.utils.data import DataLoader
 import copy
@@ -8,9 +7,9 @@ import os
 import numpy as np
 from time import time
 
-from utils import mix_slices, MRIDataset_slice_mixed, train, test, slice_level_to_tsvs, soft_voting_to_tsvs
+from utils import mix_slices, MRIDataset_slice_mixed, SliceBatchTransform, train, test, slice_level_to_tsvs, soft_voting_to_tsvs
 from clinicadl.tools.deep_learning import EarlyStopping, create_model, save_checkpoint, load_model, commandline_to_json
-from clinicadl.tools.deep_learning.data import load_data, MinMaxNormalization
+from clinicadl.tools.deep_learning.data import load_data, caps_image_shape
 
 
 __author__ = "Junhao Wen"
@@ -164,10 +163,8 @@ def train_CNN_bad_data_split(params):
     # and W are expected to be at least 224. The images have to be loaded in to
     # a range of [0, 1] and then normalized using mean = [0.485, 0.456, 0.406]
     # and std = [0.229, 0.224, 0.225].
-    transformations = transforms.Compose([MinMaxNormalization(),
-                                          transforms.ToPILImage(),
-                                          transforms.Resize(trg_size),
-                                          transforms.ToTensor()])
+    # The slices are normalized and resized by batch when they are collated.
+    batch_transform = SliceBatchTransform(trg_size)
 
     total_time = time()
     init_state = copy.deepcopy(model.state_dict())
@@ -189,16 +186,20 @@ def train_CNN_bad_data_split(params):
                 )
 
         # split the training + validation by slice
+        first_image_path = os.path.join(params.caps_directory, 'subjects', training_sub_df.participant_id.iloc[0],
+                                        training_sub_df.session_id.iloc[0], 't1', 'preprocessing_dl',
+                                        training_sub_df.participant_id.iloc[0] + '_'
+                                        + training_sub_df.session_id.iloc[0] + '_space-MNI_res-1x1x1.pt')
         training_df, valid_df = mix_slices(
                 training_sub_df,
                 valid_sub_df,
-                mri_plane=params.mri_plane
+                mri_plane=params.mri_plane,
+                image_shape=caps_image_shape(params.caps_directory, first_image_path)
                 )
 
         data_train = MRIDataset_slice_mixed(
                 params.caps_directory,
                 training_df,
-                transformations=transformations,
                 mri_plane=params.mri_plane,
                 prepare_dl=params.prepare_dl
                 )
@@ -206,7 +207,6 @@ def train_CNN_bad_data_split(params):
         data_valid = MRIDataset_slice_mixed(
                 params.caps_directory,
                 valid_df,
-                transformations=transformations,
                 mri_plane=params.mri_plane,
                 prepare_dl=params.prepare_dl
                 )
@@ -217,6 +217,7 @@ def train_CNN_bad_data_split(params):
                 batch_size=params.batch_size,
                 shuffle=True,
                 num_workers=params.num_workers,
+                collate_fn=batch_transform,
                 pin_memory=True
                 )
 
@@ -225,6 +226,7 @@ def train_CNN_bad_data_split(params):
                 batch_size=params.batch_size,
                 shuffle=False,
                 num_workers=params.num_workers,
+                collate_fn=batch_transform,
                 pin_memory=True
                 )
 
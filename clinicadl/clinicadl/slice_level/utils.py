@@ -5,6 +5,14 @@ import pandas as pd
 import numpy as np
 from sklearn.model_selection import StratifiedShuffleSplit
 
+from ..tools.deep_learning.data import ImageCache, log_cache_statistics, use_train_probe, load_image
+from ..tools.deep_learning.data import SessionIndex, caps_image_shape, read_image_metadata
+from ..tools.deep_learning.data import DISCARDED_SLICES, SLICE_AXES
+from ..tools.deep_learning.results import ResultsAccumulator, vote
+from ..tools.deep_learning.metrics import evaluate_prediction
+from ..tools.deep_learning.precision import autocast, ThroughputMeter
+from ..tools.deep_learning.feature_cache import FeatureCache, cache_features, file_signature
+
 __author__ = "Junhao Wen"
 __copyright__ = "Copyright 2018 The Aramis Lab Team"
 __credits__ = ["Junhao Wen"]
@@ -20,7 +28,7 @@ __status__ = "Development"
 #################################
 
 def train(model, data_loader, use_cuda, loss_func, optimizer, writer, epoch, model_mode="train",
-          selection_threshold=None):
+          selection_threshold=None, precision='fp32'):
     """
     This is the function to train, validate or test the model, depending on the model_mode parameter.
     :param model:
@@ -30,14 +38,15 @@ def train(model, data_loader, use_cuda, loss_func, optimizer, writer, epoch, mod
     :param optimizer:
     :param writer:
     :param epoch:
+    :param precision: (str) precision of the forward passes during training ('fp32' or 'bf16').
     :return:
     """
     global_step = None
     softmax = torch.nn.Softmax(dim=1)
     if model_mode == "train":
-        columns = ['participant_id', 'session_id', 'slice_id', 'true_label', 'predicted_label', 'proba0', 'proba1']
-        results_df = pd.DataFrame(columns=columns)
+        results_accumulator = ResultsAccumulator(len(data_loader.dataset), id_column='slice_id', n_probabilities=2)
         total_loss = 0.0
+        throughput = ThroughputMeter()
 
         model.train()  # set the model to training mode
         print('The number of batches in this sampler based on the batch size: %s' % str(len(data_loader)))
@@ -51,17 +60,16 @@ def train(model, data_loader, use_cuda, loss_func, optimizer, writer, epoch, mod
             else:
                 imgs, labels = data['image'], data['label']
 
-            gound_truth_list = labels.data.cpu().numpy().tolist()
-
-            output = model(imgs)
+            throughput.start()
+            with autocast(precision, use_cuda):
+                output = model(imgs).float()
+                batch_loss = loss_func(output, labels)
             normalized_output = softmax(output)
             _, predicted = torch.max(output.data, 1)
-            predict_list = predicted.data.cpu().numpy().tolist()
-            batch_loss = loss_func(output, labels)
             total_loss += batch_loss.item()
 
             # calculate the batch balanced accuracy and loss
-            batch_metrics = evaluate_prediction(gound_truth_list, predict_list)
+            batch_metrics = evaluate_prediction(labels, predicted)
             batch_accuracy = batch_metrics['balanced_accuracy']
 
             writer.add_scalar('classification accuracy', batch_accuracy, global_step)
@@ -70,23 +78,21 @@ def train(model, data_loader, use_cuda, loss_func, optimizer, writer, epoch, mod
             optimizer.zero_grad()
             batch_loss.backward()
             optimizer.step()
+            throughput.stop(len(labels))
 
             # Generate detailed DataFrame
-            for idx, sub in enumerate(data['participant_id']):
-                row = [sub, data['session_id'][idx], data['slice_id'][idx],
-                       labels[idx].item(), predicted[idx].item(),
-                       normalized_output[idx, 0].item(), normalized_output[idx, 1]]
-                row_df = pd.DataFrame(np.array(row).reshape(1, -1), columns=columns)
-                results_df = pd.concat([results_df, row_df])
+            results_accumulator.add_batch(data, labels, predicted, normalized_output)
 
             # delete the temporary variables taking the GPU memory
             del imgs, labels, output, predicted, batch_loss, batch_accuracy
             torch.cuda.empty_cache()
 
+        results_df = results_accumulator.to_dataframe()
         epoch_metrics = evaluate_prediction(results_df.true_label.values.astype(int),
                                             results_df.predicted_label.values.astype(int))
         accuracy_batch_mean = epoch_metrics['balanced_accuracy']
         loss_batch_mean = total_loss / len(data_loader)
+        throughput.log(writer, epoch)
         torch.cuda.empty_cache()
 
     elif model_mode == "valid":
@@ -106,9 +112,47 @@ def train(model, data_loader, use_cuda, loss_func, optimizer, writer, epoch, mod
     else:
         raise ValueError('This mode %s was not implemented. Please choose between train and valid' % model_mode)
 
+    log_cache_statistics(data_loader.dataset, writer, epoch)
+
     return results_df, accuracy_batch_mean, loss_batch_mean, global_step
 
 
+def train_metrics(model, train_df, train_loss, probe_loader, n_evaluations, use_cuda, loss_func, writer, epoch,
+                  probe_frequency=1, selection_threshold=None):
+    """
+    Computes the subject level metrics of the training set without a second pass on the whole training set.
+    The metrics are computed on the train probe (if any) once every probe_frequency evaluations, else they are
+    computed from the results of the training pass.
+
+    :param model: (Module) CNN being trained
+    :param train_df: (DataFrame) slice level results of the training pass
+    :param train_loss: (float) mean loss of the training pass
+    :param probe_loader: (DataLoader) wrapper of the train probe, or None
+    :param n_evaluations: (int) number of evaluations already performed
+    :param use_cuda: if True a gpu is used
+    :param loss_func: (loss) function to calculate the loss
+    :param writer: (SummaryWriter) writer of the training metrics
+    :param epoch: (int) current epoch
+    :param probe_frequency: (int) the train probe is used once every probe_frequency evaluations
+    :param selection_threshold: (float) threshold of the soft voting
+    :return:
+        (float) subject level balanced accuracy
+        (float) mean loss
+    """
+    if use_train_probe(probe_loader, n_evaluations, probe_frequency):
+        _, accuracy_mean, loss_mean, _ = train(model, probe_loader, use_cuda, loss_func, None, writer, epoch,
+                                               model_mode='valid', selection_threshold=selection_threshold)
+    else:
+        _, metrics_subject = soft_voting(train_df, train_df, selection_threshold=selection_threshold)
+        accuracy_mean = metrics_subject['balanced_accuracy']
+        loss_mean = train_loss
+
+        writer.add_scalar('classification accuracy', accuracy_mean, epoch)
+        writer.add_scalar('loss', loss_mean, epoch)
+
+    return accuracy_mean, loss_mean
+
+
 def test(model, data_loader, use_cuda, loss_func):
     """
     The function to evaluate the testing data for the trained classifiers
@@ -119,8 +163,7 @@ def test(model, data_loader, use_cuda, loss_func):
     """
 
     softmax = torch.nn.Softmax(dim=1)
-    columns = ['participant_id', 'session_id', 'slice_id', 'true_label', 'predicted_label', 'proba0', 'proba1']
-    results_df = pd.DataFrame(columns=columns)
+    results_accumulator = ResultsAccumulator(len(data_loader.dataset), id_column='slice_id', n_probabilities=2)
     total_loss = 0
 
     if use_cuda:
@@ -142,121 +185,39 @@ def test(model, data_loader, use_cuda, loss_func):
             _, predicted = torch.max(output.data, 1)
 
             # Generate detailed DataFrame
-            for idx, sub in enumerate(data['participant_id']):
-                row = [sub, data['session_id'][idx], data['slice_id'][idx].item(),
-                       labels[idx].item(), predicted[idx].item(),
-                       normalized_output[idx, 0].item(), normalized_output[idx, 1].item()]
-
-                row_df = pd.DataFrame(np.array(row).reshape(1, -1), columns=columns)
-                results_df = pd.concat([results_df, row_df])
+            results_accumulator.add_batch(data, labels, predicted, normalized_output)
 
             del imgs, labels, output
             torch.cuda.empty_cache()
 
         # calculate the balanced accuracy
+        results_df = results_accumulator.to_dataframe()
         results = evaluate_prediction(results_df.true_label.values.astype(int),
                                       results_df.predicted_label.values.astype(int))
-        results_df.reset_index(inplace=True, drop=True)
         results['total_loss'] = total_loss
         torch.cuda.empty_cache()
 
     return results_df, results
 
 
-def evaluate_prediction(y, y_hat):
-    """
-    This is a function to calculate the different metrics based on the list of true label and predicted label
-    :param y: list
-    :param y_hat: list
-    :return:
-    """
-
-    true_positive = 0.0
-    true_negative = 0.0
-    false_positive = 0.0
-    false_negative = 0.0
-
-    tp = []
-    tn = []
-    fp = []
-    fn = []
-
-    for i in range(len(y)):
-        if y[i] == 1:
-            if y_hat[i] == 1:
-                true_positive += 1
-                tp.append(i)
-            else:
-                false_negative += 1
-                fn.append(i)
-        else:  # -1
-            if y_hat[i] == 0:
-                true_negative += 1
-                tn.append(i)
-            else:
-                false_positive += 1
-                fp.append(i)
-
-    accuracy = (true_positive + true_negative) / (true_positive + true_negative + false_positive + false_negative)
-
-    if (true_positive + false_negative) != 0:
-        sensitivity = true_positive / (true_positive + false_negative)
-    else:
-        sensitivity = 0.0
-
-    if (false_positive + true_negative) != 0:
-        specificity = true_negative / (false_positive + true_negative)
-    else:
-        specificity = 0.0
-
-    if (true_positive + false_positive) != 0:
-        ppv = true_positive / (true_positive + false_positive)
-    else:
-        ppv = 0.0
-
-    if (true_negative + false_negative) != 0:
-        npv = true_negative / (true_negative + false_negative)
-    else:
-        npv = 0.0
-
-    balanced_accuracy = (sensitivity + specificity) / 2
-
-    results = {'accuracy': accuracy,
-               'balanced_accuracy': balanced_accuracy,
-               'sensitivity': sensitivity,
-               'specificity': specificity,
-               'ppv': ppv,
-               'npv': npv,
-               'confusion_matrix': {'tp': len(tp), 'tn': len(tn), 'fp': len(fp), 'fn': len(fn)}
-               }
-
-    return results
-
-
 #################################
 # Datasets
 #################################
 
-def mix_slices(df_training, df_validation, mri_plane=0, val_size=0.15):
+def mix_slices(df_training, df_validation, mri_plane=0, val_size=0.15, image_shape=(1, 169, 208, 179)):
     """
     This is a function to gather the training and validation tsv together, then do the bad data split by slice.
     :param training_tsv:
     :param validation_tsv:
+    :param image_shape: (tuple) shape of the images (see clinicadl.tools.deep_learning.data.caps_image_shape).
     :return:
     """
 
     df_all = pd.concat([df_training, df_validation])
     df_all = df_all.reset_index(drop=True)
 
-    if mri_plane == 0:
-        slices_per_patient = 169 - 40
-        slice_index = list(np.arange(20, 169 - 20))
-    elif mri_plane == 1:
-        slices_per_patient = 208 - 40
-        slice_index = list(np.arange(20, 208 - 20))
-    else:
-        slices_per_patient = 179 - 40
-        slice_index = list(np.arange(20, 179 - 20))
+    slice_index = list(np.arange(DISCARDED_SLICES, image_shape[mri_plane + 1] - DISCARDED_SLICES))
+    slices_per_patient = len(slice_index)
 
     participant_list = list(df_all['participant_id'])
     session_list = list(df_all['session_id'])
@@ -292,16 +253,21 @@ class MRIDataset_slice(Dataset):
     """
     This class reads the CAPS of image processing pipeline of DL
 
-    To note, this class processes the MRI to be RGB for transfer learning.
+    To note, this class processes the MRI to be RGB for transfer learning. The slices are loaded and transformed
+    with one channel, and the three channels are a view of this channel.
 
     Return: a Pytorch Dataset objective
     """
 
-    def __init__(self, caps_directory, data_file, transformations=None, mri_plane=0, prepare_dl=False):
+    def __init__(self, caps_directory, data_file, transformations=None, mri_plane=0, prepare_dl=False,
+                 cache_size=0, foreground_threshold=0):
         """
         Args:
             caps_directory (string): the output folder of image processing pipeline.
             transformations (callable, optional): if the data sample should be done some transformations or not, such as resize the image.
+            cache_size (int): memory budget in bytes of the cache of whole images used when prepare_dl is False.
+            foreground_threshold (float): the slices whose fraction of foreground voxels is lower than this
+                threshold are skipped. The fractions are read from the metadata written at extraction.
 
         To note, for each view:
             Axial_view = "[:, :, slice_i]"
@@ -314,6 +280,11 @@ class MRIDataset_slice(Dataset):
         self.diagnosis_code = {'CN': 0, 'AD': 1, 'sMCI': 0, 'pMCI': 1, 'MCI': 1}
         self.mri_plane = mri_plane
         self.prepare_dl = prepare_dl
+        self.foreground_threshold = foreground_threshold
+        if cache_size > 0:
+            self.image_cache = ImageCache(cache_size)
+        else:
+            self.image_cache = None
 
         # Check the format of the tsv file here
         if isinstance(data_file, str):
@@ -323,53 +294,67 @@ class MRIDataset_slice(Dataset):
         else:
             raise Exception('The argument datafile is not of correct type.')
 
-        # This dimension is for the output of image processing pipeline of Raw: 169 * 208 * 179
-        if mri_plane == 0:
-            self.slices_per_patient = 169 - 40
-            self.slice_direction = 'sag'
-        elif mri_plane == 1:
-            self.slices_per_patient = 208 - 40
-            self.slice_direction = 'cor'
-        elif mri_plane == 2:
-            self.slices_per_patient = 179 - 40
-            self.slice_direction = 'axi'
+        if mri_plane not in [0, 1, 2]:
+            raise ValueError("This view does not exist, please choose view in [0, 1, 2]")
+        self.slice_direction = SLICE_AXES[mri_plane]
+
+        self.sessions = SessionIndex(self.df, self.diagnosis_code)
+        self.file_prefixes = np.char.add(self.sessions.caps_prefixes(self.caps_directory, 't1', 'preprocessing_dl'),
+                                         '_space-MNI_res-1x1x1')
+
+        # the first and last slices of the axis are discarded
+        image_shape = caps_image_shape(self.caps_directory, str(self.file_prefixes[0]) + '.pt')
+        slice_ids = np.arange(DISCARDED_SLICES, image_shape[mri_plane + 1] - DISCARDED_SLICES)
+
+        # index of the valid slices of each session, the slices of a session have consecutive indices
+        if foreground_threshold > 0:
+            session_slices = []
+            for file_prefix in self.file_prefixes:
+                foreground = read_image_metadata(str(file_prefix) + '.pt')['slice_foreground'][self.slice_direction]
+                session_slices.append(slice_ids[np.asarray(foreground)[slice_ids] >= foreground_threshold])
+        else:
+            session_slices = [slice_ids] * len(self.sessions)
+
+        n_slices = np.array([len(slices) for slices in session_slices], dtype=np.int64)
+        self.session_offsets = np.concatenate([[0], np.cumsum(n_slices)])
+        self.element_session = np.repeat(np.arange(len(self.sessions)), n_slices)
+        self.element_slice = np.concatenate(session_slices) if len(session_slices) > 0 else slice_ids[:0]
 
     def __len__(self):
-        return len(self.df) * self.slices_per_patient
+        return len(self.element_slice)
 
     def __getitem__(self, idx):
-        sub_idx = idx // self.slices_per_patient
-        img_name = self.df.loc[sub_idx, 'participant_id']
-        sess_name = self.df.loc[sub_idx, 'session_id']
-        img_label = self.df.loc[sub_idx, 'diagnosis']
-        label = self.diagnosis_code[img_label]
-        slice_idx = idx % self.slices_per_patient
+        sub_idx = self.element_session[idx]
+        img_name = str(self.sessions.participant_id[sub_idx])
+        sess_name = str(self.sessions.session_id[sub_idx])
+        label = int(self.sessions.label[sub_idx])
+        file_prefix = str(self.file_prefixes[sub_idx])
+        slice_id = int(self.element_slice[idx])
 
         if self.prepare_dl:
             # read the slices directly
-            slice_path = os.path.join(self.caps_directory, 'subjects', img_name, sess_name, 't1',
-                                      'preprocessing_dl',
-                                      img_name + '_' + sess_name + '_space-MNI_res-1x1x1_axis-' +
-                                      self.slice_direction + '_rgbslice-' + str(slice_idx + 20) + '.pt')
+            slice_path = file_prefix + '_axis-' + self.slice_direction + '_rgbslice-' + str(slice_id) + '.pt'
 
-            extracted_slice = torch.load(slice_path)
+            extracted_slice = load_image(slice_path)
         else:
-            image_path = os.path.join(self.caps_directory, 'subjects', img_name, sess_name, 't1',
-                                      'preprocessing_dl',
-                                      img_name + '_' + sess_name + '_space-MNI_res-1x1x1.pt')
-            image = torch.load(image_path)
-            extracted_slice = extract_slice_from_mri(image, slice_idx + 20, self.mri_plane)
+            image_path = file_prefix + '.pt'
+            if self.image_cache is not None:
+                image = self.image_cache.load(image_path)
+            else:
+                image = load_image(image_path)
+            extracted_slice = extract_slice_from_mri(image, slice_id, self.mri_plane)
 
         # check if the slice has NaN value
         if torch.isnan(extracted_slice).any():
-            print("Slice %s has NaN values." % str(img_name + '_' + sess_name + '_' + str(slice_idx + 20)))
+            print("Slice %s has NaN values." % str(img_name + '_' + sess_name + '_' + str(slice_id)))
             extracted_slice[torch.isnan(extracted_slice)] = 0
 
         if self.transformations:
             extracted_slice = self.transformations(extracted_slice)
+        extracted_slice = expand_to_rgb(extracted_slice)
 
-        sample = {'image_id': img_name + '_' + sess_name + '_slice' + str(slice_idx + 20), 'image': extracted_slice, 'label': label,
-                  'participant_id': img_name, 'session_id': sess_name, 'slice_id': slice_idx + 20}
+        sample = {'image_id': img_name + '_' + sess_name + '_slice' + str(slice_id), 'image': extracted_slice, 'label': label,
+                  'participant_id': img_name, 'session_id': sess_name, 'slice_id': slice_id}
 
         return sample
 
@@ -378,16 +363,19 @@ class MRIDataset_slice_mixed(Dataset):
     """
     This class reads the CAPS of image processing pipeline of DL. However, this is used for the bad data split strategy
 
-    To note, this class processes the MRI to be RGB for transfer learning.
+    To note, this class processes the MRI to be RGB for transfer learning. The slices are loaded and transformed
+    with one channel, and the three channels are a view of this channel.
 
     Return: a Pytorch Dataset objective
     """
 
-    def __init__(self, caps_directory, data_file, transformations=None, mri_plane=0, prepare_dl=False):
+    def __init__(self, caps_directory, data_file, transformations=None, mri_plane=0, prepare_dl=False,
+                 cache_size=0):
         """
         Args:
             caps_directory (string): the output folder of image processing pipeline.
             transformations (callable, optional): if the data sample should be done some transformations or not, such as resize the image.
+            cache_size (int): memory budget in bytes of the cache of whole images used when prepare_dl is False.
 
         To note, for each view:
             Axial_view = "[:, :, slice_i]"
@@ -400,6 +388,10 @@ class MRIDataset_slice_mixed(Dataset):
         self.diagnosis_code = {'CN': 0, 'AD': 1, 'sMCI': 0, 'pMCI': 1, 'MCI': 1}
         self.mri_plane = mri_plane
         self.prepare_dl = prepare_dl
+        if cache_size > 0:
+            self.image_cache = ImageCache(cache_size)
+        else:
+            self.image_cache = None
 
         # Check the format of the tsv file here
         if isinstance(data_file, str):
@@ -409,35 +401,36 @@ class MRIDataset_slice_mixed(Dataset):
         else:
             raise Exception('The argument datafile is not of correct type.')
 
-        if mri_plane == 0:
-            self.slice_direction = 'sag'
-        elif mri_plane == 1:
-            self.slice_direction = 'cor'
-        elif mri_plane == 2:
-            self.slice_direction = 'axi'
+        self.sessions = SessionIndex(self.df, self.diagnosis_code)
+        self.file_prefixes = np.char.add(self.sessions.caps_prefixes(self.caps_directory, 't1', 'preprocessing_dl'),
+                                         '_space-MNI_res-1x1x1')
+        self.slice_ids = self.df.slice_id.values.astype(np.int64)
+
+        if mri_plane not in [0, 1, 2]:
+            raise ValueError("This view does not exist, please choose view in [0, 1, 2]")
+        self.slice_direction = SLICE_AXES[mri_plane]
 
     def __len__(self):
-        return len(self.df)
+        return len(self.sessions)
 
     def __getitem__(self, idx):
-        img_name = self.df.loc[idx, 'participant_id']
-        sess_name = self.df.loc[idx, 'session_id']
-        slice_name = self.df.loc[idx, 'slice_id']
-        img_label = self.df.loc[idx, 'diagnosis']
-        label = self.diagnosis_code[img_label]
+        img_name = str(self.sessions.participant_id[idx])
+        sess_name = str(self.sessions.session_id[idx])
+        slice_name = int(self.slice_ids[idx])
+        label = int(self.sessions.label[idx])
+        file_prefix = str(self.file_prefixes[idx])
 
         if self.prepare_dl:
-            slice_path = os.path.join(self.caps_directory, 'subjects', img_name, sess_name, 't1',
-                                      'preprocessing_dl', img_name + '_' + sess_name + '_space-MNI_res-1x1x1_axis-' +
-                                      self.slice_direction + '_rgbslice-' + str(slice_name) + '.pt')
+            slice_path = file_prefix + '_axis-' + self.slice_direction + '_rgbslice-' + str(slice_name) + '.pt'
 
-            extracted_slice = torch.load(slice_path)
+            extracted_slice = load_image(slice_path)
 
         else:
-            image_path = os.path.join(self.caps_directory, 'subjects', img_name, sess_name, 't1',
-                                      'preprocessing_dl',
-                                      img_name + '_' + sess_name + '_space-MNI_res-1x1x1.pt')
-            image = torch.load(image_path)
+            image_path = file_prefix + '.pt'
+            if self.image_cache is not None:
+                image = self.image_cache.load(image_path)
+            else:
+                image = load_image(image_path)
             extracted_slice = extract_slice_from_mri(image, slice_name, self.mri_plane)
 
         # check if the slice has NaN value
@@ -447,6 +440,7 @@ class MRIDataset_slice_mixed(Dataset):
 
         if self.transformations:
             extracted_slice = self.transformations(extracted_slice)
+        extracted_slice = expand_to_rgb(extracted_slice)
 
         sample = {'image_id': img_name + '_' + sess_name + '_slice' + str(slice_name), 'image': extracted_slice,
                   'label': label, 'participant_id': img_name, 'session_id': sess_name, 'slice_id': slice_name}
@@ -456,11 +450,12 @@ class MRIDataset_slice_mixed(Dataset):
 
 def extract_slice_from_mri(image, index_slice, view):
     """
-    This is a function to grab one slice in each view and create a rgb image for transferring learning: duplicate the slices into R, G, B channel
+    This is a function to grab one slice in each view. The rgb image used for transferring learning is obtained
+    with expand_to_rgb, which duplicates the slice into R, G, B channel without copying it.
     :param image: (tensor)
     :param index_slice: (int) index of the wanted slice
     :param view:
-    :return:
+    :return: (tensor) the slice of shape [1, W, L]
     To note, for each view:
     Axial_view = "[:, :, slice_i]"
     Coronal_view = "[:, slice_i, :]"
@@ -485,11 +480,128 @@ def extract_slice_from_mri(image, index_slice, view):
     else:
         raise ValueError("This view does not exist, please choose view in [0, 1, 2]")
 
-    extracted_slice = torch.stack((slice_select, slice_select, slice_select))
+    extracted_slice = slice_select.unsqueeze(0)
+
+    return extracted_slice
+
 
+def expand_to_rgb(extracted_slice):
+    """
+    Duplicates a slice of one channel into R, G, B channel. The result is a view of the slice,
+    the slices which already have three channels are returned unchanged.
+    :param extracted_slice: (tensor) slice of shape [1, W, L] or [3, W, L]
+    :return: (tensor) slice of shape [3, W, L]
+    """
+    if extracted_slice.shape[0] == 1:
+        return extracted_slice.expand(3, -1, -1)
     return extracted_slice
 
 
+class SliceBatchTransform(object):
+    """
+    Collates the samples of the slice datasets, then normalizes and resizes the whole batch at once.
+    It is given as collate_fn to the DataLoaders, so it runs in the workers on float tensors, whereas the
+    transforms ToPILImage -> Resize -> ToTensor process each slice through an 8-bit PIL image.
+    """
+
+    def __init__(self, output_size=(224, 224), minmaxnormalization=True):
+        """
+        :param output_size: (tuple) size of the slices expected by the network. If None the slices are not resized.
+        :param minmaxnormalization: (bool) if True each slice is normalized between 0 and 1.
+        """
+        self.output_size = output_size
+        self.minmaxnormalization = minmaxnormalization
+
+    def __call__(self, samples):
+        """
+        :param samples: (list) samples of the dataset, built without transformations.
+        :return: (dict) batch in which 'image' is of shape [batch_size, 3, output_size[0], output_size[1]].
+        """
+        import torch.nn.functional as F
+        from torch.utils.data.dataloader import default_collate
+
+        # the three channels of a rgb slice are the same, only one of them is processed
+        images = torch.stack([sample['image'][:1] for sample in samples]).float()
+        batch = default_collate([{key: value for key, value in sample.items() if key != 'image'}
+                                 for sample in samples])
+
+        if self.minmaxnormalization:
+            flat_images = images.view(len(images), -1)
+            minimum = flat_images.min(dim=1)[0].view(-1, 1, 1, 1)
+            maximum = flat_images.max(dim=1)[0].view(-1, 1, 1, 1)
+            images = (images - minimum) / (maximum - minimum)
+
+        if self.output_size is not None and tuple(images.shape[2:]) != tuple(self.output_size):
+            images = F.interpolate(images, size=self.output_size, mode='bilinear', align_corners=False)
+
+        batch['image'] = images.expand(-1, 3, -1, -1)
+
+        return batch
+
+
+class SliceFeatureCache(FeatureCache):
+    """
+    Feature cache of the outputs of the frozen trunk of a model (see ResNetDesigner.trunk).
+    The features of a slice are keyed by the signature of the image from which it is extracted and its slice id.
+    """
+
+    def __init__(self, cache_dir, model, mri_plane=0, dtype='float16'):
+        """
+        :param cache_dir: (str) folder of the caches.
+        :param model: (Module) model with trunk and trunk_modules methods.
+        :param mri_plane: (int) axis of the slices.
+        :param dtype: (str) dtype of the stored features ('float16' or 'float32').
+        """
+        if not hasattr(model, 'trunk'):
+            raise ValueError("The model %s has no frozen trunk whose features can be cached."
+                             % model.__class__.__name__)
+
+        super(SliceFeatureCache, self).__init__(cache_dir, model.trunk_modules(), dtype=dtype,
+                                                input_tag='slice_rgb-224')
+        self.slice_direction = SLICE_AXES[mri_plane]
+
+    def keys(self, dataset):
+        """
+        :param dataset: (MRIDataset_slice) dataset whose slices are cached.
+        :return: (list) key of each slice of the dataset.
+        """
+        session_signatures = [file_signature(str(file_prefix) + '.pt') for file_prefix in dataset.file_prefixes]
+
+        return ['%s_axis-%s_slice-%i' % (session_signatures[session], self.slice_direction, slice_id)
+                for session, slice_id in zip(dataset.element_session, dataset.element_slice)]
+
+
+def cache_trunk_features(model, dataset, feature_cache, batch_transform, batch_size=32, num_workers=0,
+                         gpu=False):
+    """
+    Computes the trunk features of the slices of dataset which are not yet in the feature cache.
+
+    :param model: (ResNetDesigner) model whose trunk is cached.
+    :param dataset: (MRIDataset_slice) dataset built without transformations.
+    :param feature_cache: (SliceFeatureCache) the cache.
+    :param batch_transform: (SliceBatchTransform) stage giving the inputs of the model.
+    :param batch_size: (int) size of the batches in which the features are computed.
+    :param num_workers: (int) number of data loading workers.
+    :param gpu: (bool) if True a gpu is used.
+    :return: (CachedFeatureDataset) dataset whose samples have the same keys as the samples of the slice dataset.
+    """
+    sessions = dataset.sessions
+    session_idx = dataset.element_session
+    participant_id = np.asarray(sessions.participant_id)[session_idx].astype(str)
+    session_id = np.asarray(sessions.session_id)[session_idx].astype(str)
+    slice_id = np.asarray(dataset.element_slice).astype(int)
+    image_id = np.char.add(np.char.add(np.char.add(participant_id, '_'), session_id),
+                           np.char.add('_slice', slice_id.astype(str)))
+    metadata = {'image_id': image_id,
+                'label': np.asarray(sessions.label)[session_idx].astype(int),
+                'participant_id': participant_id,
+                'session_id': session_id,
+                'slice_id': slice_id}
+
+    return cache_features(model.trunk, model, dataset, feature_cache.keys(dataset), metadata, feature_cache,
+                          batch_size=batch_size, num_workers=num_workers, gpu=gpu, collate_fn=batch_transform)
+
+
 #################################
 # Voting systems
 #################################
@@ -528,11 +640,13 @@ def retrieve_slice_level_results(output_dir, fold, selection, dataset):
     return performance_df
 
 
-def soft_voting_to_tsvs(output_dir, fold, selection, dataset='test', selection_threshold=None):
+def soft_voting_to_tsvs(output_dir, fold, selection, dataset='test', selection_threshold=None,
+                        method='soft'):
     """
     This is for soft voting for subject-level performances
     :param performance_df: the pandas dataframe, including columns: iteration, y, y_hat, subject, probability
     :param selection: (str) the metrics on which the model was selected (best_acc, best_loss)
+    :param method: (str) 'soft' to combine the probabilities or 'hard' to combine the predicted labels.
 
     ref: S. Raschka. Python Machine Learning., 2015
     :return:
@@ -550,61 +664,34 @@ def soft_voting_to_tsvs(output_dir, fold, selection, dataset='test', selection_t
     if not os.path.exists(performance_path):
         os.makedirs(performance_path)
 
-    df_final, metrics = soft_voting(test_df, validation_df, selection_threshold=selection_threshold)
+    df_final, metrics = soft_voting(test_df, validation_df, selection_threshold=selection_threshold,
+                                    method=method)
 
-    df_final.to_csv(os.path.join(os.path.join(performance_path, dataset + '_subject_level_result_soft_vote.tsv')),
+    df_final.to_csv(os.path.join(performance_path, dataset + '_subject_level_result_%s_vote.tsv' % method),
                     index=False, sep='\t')
 
     pd.DataFrame(metrics, index=[0]).to_csv(os.path.join(output_dir, 'performances', 'fold_%i' % fold, selection,
-                                                         dataset + '_subject_level_metrics_soft_vote.tsv'),
+                                                         dataset + '_subject_level_metrics_%s_vote.tsv' % method),
                                             index=False, sep='\t')
 
 
-def soft_voting(performance_df, validation_df, selection_threshold=None):
-
-    # Compute the slice accuracies on the validation set:
-    right_classified_df = validation_df[validation_df['true_label'] == validation_df['predicted_label']]
-    n_valid = len(validation_df.groupby(['participant_id', 'session_id']).nunique())
-    slice_accuracies = right_classified_df['slice_id'].value_counts() / n_valid
-    if selection_threshold is not None:
-        slice_accuracies[slice_accuracies < selection_threshold] = 0
-    weight_series = slice_accuracies / slice_accuracies.sum()
-
-    # Add the weights to performance_df
-    for idx in performance_df.index.values:
-        slice_id = performance_df.loc[idx, 'slice_id']
-        weight = weight_series.loc[slice_id]
-        performance_df.loc[idx, 'weight'] = weight
-
-    # do soft majority vote
-    columns = ['participant_id', 'session_id', 'true_label', 'predicted_label']
-    df_final = pd.DataFrame(columns=columns)
-    for subject_session, subject_df in performance_df.groupby(['participant_id', 'session_id']):
-        subject, session = subject_session
-        num_slice = len(subject_df.predicted_label)
-        p0_all = 0
-        p1_all = 0
-        # reindex the subject_df.probability
-        proba0_series_reindex = subject_df.proba0.reset_index()
-        proba1_series_reindex = subject_df.proba1.reset_index()
-        weight_series_reindex = subject_df.weight.reset_index()
-        y_series_reindex = subject_df.true_label.reset_index()
-        y = y_series_reindex.true_label[0]
-
-        for i in range(num_slice):
-
-            p0 = weight_series_reindex.weight[i] * float(proba0_series_reindex.proba0[i])
-            p1 = weight_series_reindex.weight[i] * float(proba1_series_reindex.proba1[i])
-
-            p0_all += p0
-            p1_all += p1
-
-        proba_list = [p0_all, p1_all]
-        y_hat = proba_list.index(max(proba_list))
-
-        row_array = np.array(list([subject, session, y, y_hat])).reshape(1, 4)
-        row_df = pd.DataFrame(row_array, columns=columns)
-        df_final = df_final.append(row_df)
+def soft_voting(performance_df, validation_df, selection_threshold=None, method='soft'):
+    """
+    Computes soft voting based on the probabilities in performance_df. Weights are computed based on the accuracies
+    of validation_df.
+
+    ref: S. Raschka. Python Machine Learning., 2015
+    :param performance_df: (DataFrame) results on slice level of the set on which the combination is made.
+    :param validation_df: (DataFrame) results on slice level of the set used to compute the weights.
+    :param selection_threshold: (float) if given, all slices for which the classification accuracy is below the
+                                threshold is removed.
+    :param method: (str) 'soft' to combine the probabilities or 'hard' to combine the predicted labels.
+    :return:
+        - df_final (DataFrame) the results on the subject level
+        - results (dict) the metrics on the subject level
+    """
+
+    df_final = vote(performance_df, validation_df, 'slice_id', method=method, selection_threshold=selection_threshold)
 
     results = evaluate_prediction(df_final.true_label.values.astype(int),
                                   df_final.predicted_label.values.astype(int))
@@ -21,6 +21,13 @@ parser.add_argument('--gpu', action='store_true', default=False,
                     help='Uses gpu instead of cpu if cuda is available')
 parser.add_argument("--num_workers", '-w', default=1, type=int,
                     help='the number of batch being loaded in parallel')
+parser.add_argument('--precision', default='fp32', choices=['fp32', 'bf16'], type=str,
+                    help='Precision of the forward passes if it is not given in the json of the experiment.')
+parser.add_argument('--train_probe_size', default=0, type=int,
+                    help='Size of the train probe if it is not given in the json of the experiment.')
+parser.add_argument('--train_probe_frequency', default=1, type=int,
+                    help='Frequency of the evaluations of the train probe if it is not given in the json '
+                         'of the experiment.')
 
 
 def main(options):
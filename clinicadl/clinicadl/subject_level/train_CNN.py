@@ -5,11 +5,13 @@ from time import time
 from os import path
 from torch.utils.data import DataLoader
 
-from .utils import train
+from .utils import train, cache_subject_features
 from ..tools.deep_learning.iotools import Parameters
 from ..tools.deep_learning.data import MinMaxNormalization, MRIDataset, load_data
 from ..tools.deep_learning import create_model, commandline_to_json
 from ..tools.deep_learning.models import transfer_learning
+from ..tools.deep_learning.resources import apply_resource_plan, worker_init_function
+from ..tools.deep_learning.feature_cache import encoder_feature_cache
 
 
 def train_cnn(params):
@@ -33,6 +35,8 @@ def train_cnn(params):
         raise Exception('Evaluation steps %d must be a multiple of accumulation steps %d' %
                         (params.evaluation_steps, params.accumulation_steps))
 
+    apply_resource_plan(params.resource_plan)
+
     if params.minmaxnormalization:
         transformations = MinMaxNormalization()
     else:
@@ -54,20 +58,44 @@ def train_cnn(params):
             params.input_dir,
             training_tsv,
             params.preprocessing,
-            transform=transformations
+            transform=transformations,
+            cohort_path=params.cohort_path
             )
     data_valid = MRIDataset(
             params.input_dir,
             valid_tsv,
             params.preprocessing,
-            transform=transformations
+            transform=transformations,
+            cohort_path=params.cohort_path
             )
 
+    # Initialize the model
+    print('Initialization of the model')
+    model = create_model(params.model, params.gpu)
+    # Transfer learning function to review. Probably test if transfer learning path is given.
+    model = transfer_learning(model, params.split, params.output_dir, source_path=params.transfer_learning_path,
+                              transfer_learning_autoencoder=params.transfer_learning_autoencoder,
+                              gpu=params.gpu, selection=params.selection)
+
+    if params.feature_cache is not None:
+        if params.transfer_learning_path is None:
+            raise ValueError("The feature cache freezes the encoder of the model, which must be initialized "
+                             "with transfer learning.")
+        # the outputs of the frozen encoder are computed once per image, the training only runs the classifier
+        feature_cache = encoder_feature_cache(params.feature_cache, model, dtype=params.feature_cache_dtype,
+                                              input_tag='subject_%s_minmax-%s' % (params.preprocessing,
+                                                                                  params.minmaxnormalization))
+        data_train = cache_subject_features(model, data_train, feature_cache, batch_size=params.batch_size,
+                                            num_workers=params.num_workers, gpu=params.gpu)
+        data_valid = cache_subject_features(model, data_valid, feature_cache, batch_size=params.batch_size,
+                                            num_workers=params.num_workers, gpu=params.gpu)
+
     # Use argument load to distinguish training and testing
     train_loader = DataLoader(data_train,
                               batch_size=params.batch_size,
                               shuffle=True,
                               num_workers=params.num_workers,
+                              worker_init_fn=worker_init_function(params.resource_plan),
                               pin_memory=True
                               )
 
@@ -75,17 +103,10 @@ def train_cnn(params):
                               batch_size=params.batch_size,
                               shuffle=False,
                               num_workers=params.num_workers,
+                              worker_init_fn=worker_init_function(params.resource_plan),
                               pin_memory=True
                               )
 
-    # Initialize the model
-    print('Initialization of the model')
-    model = create_model(params.model, params.gpu)
-    # Transfer learning function to review. Probably test if transfer learning path is given.
-    model = transfer_learning(model, params.split, params.output_dir, source_path=params.transfer_learning_path,
-                              transfer_learning_autoencoder=params.transfer_learning_autoencoder,
-                              gpu=params.gpu, selection=params.selection)
-
     # Define criterion and optimizer
     criterion = torch.nn.CrossEntropyLoss()
     optimizer = eval("torch.optim." + params.optimizer)(filter(lambda x: x.requires_grad, model.parameters()), params.learning_rate, weight_decay=params.weight_decay)
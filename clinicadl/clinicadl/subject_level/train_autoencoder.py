@@ -11,6 +11,7 @@ from .utils import ae_finetuning
 from ..tools.deep_learning.iotools import Parameters
 from ..tools.deep_learning.data import MinMaxNormalization, MRIDataset, load_data
 from ..tools.deep_learning import create_autoencoder, commandline_to_json
+from ..tools.deep_learning.resources import apply_resource_plan, worker_init_function
 
 
 def train_autoencoder(params):
@@ -23,6 +24,8 @@ def train_autoencoder(params):
         raise Exception('Evaluation steps %d must be a multiple of accumulation steps %d' %
                         (params.evaluation_steps, params.accumulation_steps))
 
+    apply_resource_plan(params.resource_plan)
+
     if params.minmaxnormalization:
         transformations = MinMaxNormalization()
     else:
@@ -45,6 +48,7 @@ def train_autoencoder(params):
                               params.batch_size,
                               shuffle=True,
                               num_workers=params.num_workers,
+                              worker_init_fn=worker_init_function(params.resource_plan),
                               drop_last=True
                               )
 
@@ -55,6 +59,7 @@ def train_autoencoder(params):
                               batch_size=params.batch_size,
                               shuffle=False,
                               num_workers=params.num_workers,
+                              worker_init_fn=worker_init_function(params.resource_plan),
                               drop_last=False
                               )
 
@@ -8,6 +8,10 @@ from time import time
 
 from clinicadl.tools.deep_learning.iotools import check_and_clean, visualize_subject
 from clinicadl.tools.deep_learning import EarlyStopping, save_checkpoint
+from clinicadl.tools.deep_learning.results import ResultsAccumulator
+from clinicadl.tools.deep_learning.metrics import evaluate_prediction, RunningMetrics
+from clinicadl.tools.deep_learning.data import generate_probe_loader, use_train_probe
+from clinicadl.tools.deep_learning.precision import autocast, ThroughputMeter
 
 
 #####################
@@ -26,6 +30,7 @@ def train(model, train_loader, valid_loader, criterion, optimizer, resume, optio
     :param optimizer: (torch.optim) optimizer linked to model parameters
     :param resume: (bool) if True, a begun job is resumed
     :param options: (Namespace) ensemble of other options given to the main script.
+                    options.precision sets the precision of the forward passes ('fp32' or 'bf16').
     """
     from tensorboardX import SummaryWriter
     from time import time
@@ -67,6 +72,15 @@ def train(model, train_loader, valid_loader, criterion, optimizer, resume, optio
     mean_loss_valid = None
     t_beggining = time()
 
+    # The training metrics are computed during the forward passes, or on a fixed subset of the training set.
+    # running_metrics is reset at each evaluation and epoch_metrics at the end of each epoch, so that the
+    # metrics of the end of the epoch are not computed on an empty set of batches.
+    running_metrics = RunningMetrics()
+    epoch_metrics = RunningMetrics()
+    probe_loader = generate_probe_loader(train_loader, options.train_probe_size)
+    n_evaluations = 0
+    throughput = ThroughputMeter()
+
     while epoch < options.epochs and not early_stopping.step(mean_loss_valid):
         print("At %d-th epoch." % epoch)
 
@@ -83,12 +97,17 @@ def train(model, train_loader, valid_loader, criterion, optimizer, resume, optio
                 imgs, labels = data['image'].cuda(), data['label'].cuda()
             else:
                 imgs, labels = data['image'], data['label']
-            train_output = model(imgs)
+            throughput.start()
+            with autocast(options.precision, options.gpu):
+                train_output = model(imgs).float()
+                loss = criterion(train_output, labels)
             _, predict_batch = train_output.topk(1)
-            loss = criterion(train_output, labels)
+            running_metrics.update(labels, predict_batch, loss.item())
+            epoch_metrics.update(labels, predict_batch, loss.item())
 
             # Back propagation
             loss.backward()
+            throughput.stop(len(labels))
 
             del imgs, labels
 
@@ -104,8 +123,9 @@ def train(model, train_loader, valid_loader, criterion, optimizer, resume, optio
                     evaluation_flag = False
                     print('Iteration %d' % i)
 
-                    acc_mean_train, total_loss_train = test(model, train_loader, options.gpu, criterion)
-                    mean_loss_train = total_loss_train / (len(train_loader) * train_loader.batch_size)
+                    acc_mean_train, mean_loss_train = train_metrics(model, running_metrics, probe_loader,
+                                                                    n_evaluations, criterion, options)
+                    n_evaluations += 1
 
                     acc_mean_valid, total_loss_valid = test(model, valid_loader, options.gpu, criterion)
                     mean_loss_valid = total_loss_valid / (len(valid_loader) * valid_loader.batch_size)
@@ -127,6 +147,7 @@ def train(model, train_loader, valid_loader, criterion, optimizer, resume, optio
 
             tend = time()
         print('Mean time per batch (train):', total_time / len(train_loader) * train_loader.batch_size)
+        throughput.log(writer_train, epoch)
 
         # If no step has been performed, raise Exception
         if step_flag:
@@ -141,8 +162,10 @@ def train(model, train_loader, valid_loader, criterion, optimizer, resume, optio
         model.zero_grad()
         print('Last checkpoint at the end of the epoch %d' % epoch)
 
-        acc_mean_train, total_loss_train = test(model, train_loader, options.gpu, criterion)
-        mean_loss_train = total_loss_train / (len(train_loader) * train_loader.batch_size)
+        acc_mean_train, mean_loss_train = train_metrics(model, epoch_metrics, probe_loader,
+                                                        n_evaluations, criterion, options)
+        running_metrics.reset()
+        n_evaluations += 1
 
         acc_mean_valid, total_loss_valid = test(model, valid_loader, options.gpu, criterion)
         mean_loss_valid = total_loss_valid / (len(valid_loader) * valid_loader.batch_size)
@@ -183,52 +206,32 @@ def train(model, train_loader, valid_loader, criterion, optimizer, resume, optio
         epoch += 1
 
 
-def evaluate_prediction(y, y_pred):
+def train_metrics(model, running_metrics, probe_loader, n_evaluations, criterion, options):
     """
-    This is a function to calculate the different metrics based on the list of true label and predicted label
-    :param y: list of labels
-    :param y_pred: list of predictions
-    :return: (dict) ensemble of metrics
+    Computes the training metrics of an evaluation step without evaluating the whole training set.
+    The metrics are computed on the train probe (if any) according to options.train_probe_frequency,
+    else the running metrics accumulated since the last evaluation are used.
+
+    :param model: (Module) CNN being trained
+    :param running_metrics: (RunningMetrics) metrics of the forward passes to evaluate (reset here)
+    :param probe_loader: (DataLoader) wrapper of the train probe, or None
+    :param n_evaluations: (int) number of evaluations already performed
+    :param criterion: (loss) function to calculate the loss
+    :param options: (Namespace) ensemble of other options given to the main script.
+    :return:
+        (float) balanced accuracy
+        (float) mean loss
     """
-
-    true_positive = np.sum((y_pred == 1) & (y == 1))
-    true_negative = np.sum((y_pred == 0) & (y == 0))
-    false_positive = np.sum((y_pred == 1) & (y == 0))
-    false_negative = np.sum((y_pred == 0) & (y == 1))
-
-    accuracy = (true_positive + true_negative) / (true_positive + true_negative + false_positive + false_negative)
-
-    if (true_positive + false_negative) != 0:
-        sensitivity = true_positive / (true_positive + false_negative)
-    else:
-        sensitivity = 0.0
-
-    if (false_positive + true_negative) != 0:
-        specificity = true_negative / (false_positive + true_negative)
-    else:
-        specificity = 0.0
-
-    if (true_positive + false_positive) != 0:
-        ppv = true_positive / (true_positive + false_positive)
-    else:
-        ppv = 0.0
-
-    if (true_negative + false_negative) != 0:
-        npv = true_negative / (true_negative + false_negative)
+    if use_train_probe(probe_loader, n_evaluations, options.train_probe_frequency):
+        acc_mean_train, total_loss_train = test(model, probe_loader, options.gpu, criterion)
+        mean_loss_train = total_loss_train / (len(probe_loader) * probe_loader.batch_size)
+        model.train()
     else:
-        npv = 0.0
-
-    balanced_accuracy = (sensitivity + specificity) / 2
+        acc_mean_train = running_metrics.evaluate()['balanced_accuracy']
+        mean_loss_train = running_metrics.total_loss / (max(running_metrics.n_batches, 1) * options.batch_size)
+    running_metrics.reset()
 
-    results = {'accuracy': accuracy,
-               'balanced_accuracy': balanced_accuracy,
-               'sensitivity': sensitivity,
-               'specificity': specificity,
-               'ppv': ppv,
-               'npv': npv,
-               }
-
-    return results
+    return acc_mean_train, mean_loss_train
 
 
 def test(model, dataloader, use_cuda, criterion, full_return=False):
@@ -252,8 +255,7 @@ def test(model, dataloader, use_cuda, criterion, full_return=False):
     """
     model.eval()
 
-    columns = ["participant_id", "session_id", "true_label", "predicted_label"]
-    results_df = pd.DataFrame(columns=columns)
+    results_accumulator = ResultsAccumulator(len(dataloader.dataset))
 
     total_time = 0
     total_loss = 0
@@ -272,18 +274,16 @@ def test(model, dataloader, use_cuda, criterion, full_return=False):
             _, predicted = torch.max(outputs.data, 1)
 
             # Generate detailed DataFrame
-            for idx, sub in enumerate(data['participant_id']):
-                row = [sub, data['session_id'][idx], labels[idx].item(), predicted[idx].item()]
-                row_df = pd.DataFrame(np.array(row).reshape(1, -1), columns=columns)
-                results_df = pd.concat([results_df, row_df])
+            results_accumulator.add_batch(data, labels, predicted)
 
             del inputs, outputs, labels, loss
             tend = time()
         print('Mean time per batch (test):', total_time / len(dataloader) * dataloader.batch_size)
-        results_df.reset_index(inplace=True, drop=True)
+        results_df = results_accumulator.to_dataframe()
 
         results = evaluate_prediction(results_df.true_label.values.astype(int),
                                       results_df.predicted_label.values.astype(int))
+        del results['confusion_matrix']
 
     if full_return:
         return results, total_loss, results_df
@@ -475,3 +475,33 @@ def test_ae(model, dataloader, use_cuda, criterion):
         del inputs, outputs, loss
 
     return total_loss
+
+
+def cache_subject_features(model, dataset, feature_cache, batch_size=2, num_workers=0, gpu=False):
+    """
+    Computes the encoder features of the images of dataset which are not yet in the feature cache.
+    The images are keyed by their signature, or by their row in the cohort array when they are read from a cohort.
+
+    :param model: (Module) model whose features are frozen (see encoder_feature_cache).
+    :param dataset: (MRIDataset) dataset of the images.
+    :param feature_cache: (FeatureCache) the cache.
+    :param batch_size: (int) size of the batches in which the features are computed.
+    :param num_workers: (int) number of data loading workers.
+    :param gpu: (bool) if True a gpu is used.
+    :return: (CachedFeatureDataset) dataset whose samples have the same keys as the samples of dataset.
+    """
+    from clinicadl.tools.deep_learning.feature_cache import cache_features, file_signature
+
+    if dataset.cohort_path is not None:
+        cohort_signature = file_signature(dataset.cohort_path)
+        keys = ['cohort-%s_row-%i' % (cohort_signature, row) for row in dataset.cohort_index]
+    else:
+        keys = [file_signature(str(image_path)) for image_path in dataset.image_paths]
+
+    metadata = {'label': dataset.sessions.label,
+                'participant_id': dataset.sessions.participant_id,
+                'session_id': dataset.sessions.session_id,
+                'image_path': dataset.image_paths}
+
+    return cache_features(model.features, model, dataset, keys, metadata, feature_cache,
+                          batch_size=batch_size, num_workers=num_workers, gpu=gpu)
@@ -10,6 +10,9 @@ import numpy as np
 from sklearn.model_selection import StratifiedKFold
 import nibabel as nib
 
+from clinicadl.tools.deep_learning.metrics import evaluate_prediction
+from clinicadl.tools.deep_learning.data import load_data
+
 __author__ = "Junhao Wen"
 __copyright__ = "Copyright 2018 The Aramis Lab Team"
 __credits__ = ["Junhao Wen, Jorge Samper Gonzalez"]
@@ -306,35 +309,10 @@ def extract_indices_from_5_fold(diagnosis_tsv_folder, n_splits, output_dir, base
     splits_indices = []
 
     for i in range(n_splits):
-        train_df = pd.DataFrame()
-        valid_df = pd.DataFrame()
         train_index = []
         valid_index = []
 
-        train_path = path.join(diagnosis_tsv_folder, 'train_splits-' + str(n_splits),
-                               'split-' + str(i))
-        valid_path = path.join(diagnosis_tsv_folder, 'validation_splits-' + str(n_splits),
-                               'split-' + str(i))
-        print("Train", train_path)
-        print("Valid", valid_path)
-
-        for diagnosis in diagnoses_list:
-
-            if baseline:
-                train_diagnosis_tsv = path.join(train_path, diagnosis + '_baseline.tsv')
-            else:
-                train_diagnosis_tsv = path.join(train_path, diagnosis + '.tsv')
-
-            valid_diagnosis_tsv = path.join(valid_path, diagnosis + '_baseline.tsv')
-
-            train_diagnosis_df = pd.read_csv(train_diagnosis_tsv, sep='\t')
-            valid_diagnosis_df = pd.read_csv(valid_diagnosis_tsv, sep='\t')
-
-            train_df = pd.concat([train_df, train_diagnosis_df])
-            valid_df = pd.concat([valid_df, valid_diagnosis_df])
-
-        train_df.reset_index(inplace=True, drop=True)
-        valid_df.reset_index(inplace=True, drop=True)
+        train_df, valid_df = load_data(diagnosis_tsv_folder, diagnoses_list, i, n_splits=n_splits, baseline=baseline)
 
         if i == 0:
             # only concatenate the train + valid for the first fold
@@ -416,70 +394,6 @@ def revert_mask(weights, mask, shape):
     return new_weights
 
 
-def evaluate_prediction(y, y_hat):
-
-    true_positive = 0.0
-    true_negative = 0.0
-    false_positive = 0.0
-    false_negative = 0.0
-
-    tp = []
-    tn = []
-    fp = []
-    fn = []
-
-    for i in range(len(y)):
-        if y[i] == 1:
-            if y_hat[i] == 1:
-                true_positive += 1
-                tp.append(i)
-            else:
-                false_negative += 1
-                fn.append(i)
-        else:  # -1
-            if y_hat[i] == 0:
-                true_negative += 1
-                tn.append(i)
-            else:
-                false_positive += 1
-                fp.append(i)
-
-    accuracy = (true_positive + true_negative) / (true_positive + true_negative + false_positive + false_negative)
-
-    if (true_positive + false_negative) != 0:
-        sensitivity = true_positive / (true_positive + false_negative)
-    else:
-        sensitivity = 0.0
-
-    if (false_positive + true_negative) != 0:
-        specificity = true_negative / (false_positive + true_negative)
-    else:
-        specificity = 0.0
-
-    if (true_positive + false_positive) != 0:
-        ppv = true_positive / (true_positive + false_positive)
-    else:
-        ppv = 0.0
-
-    if (true_negative + false_negative) != 0:
-        npv = true_negative / (true_negative + false_negative)
-    else:
-        npv = 0.0
-
-    balanced_accuracy = (sensitivity + specificity) / 2
-
-    results = {'accuracy': accuracy,
-               'balanced_accuracy': balanced_accuracy,
-               'sensitivity': sensitivity,
-               'specificity': specificity,
-               'ppv': ppv,
-               'npv': npv,
-               'confusion_matrix': {'tp': len(tp), 'tn': len(tn), 'fp': len(fp), 'fn': len(fn)}
-               }
-
-    return results
-
-
 def save_data(df, output_dir, folder_name):
     """
     Save data so it can be used by the workflow
@@ -134,3 +134,50 @@ def generate_trivial_dataset(caps_dir, tsv_path, output_dir, n_subjects, preproc
         output_df = output_df.append(row_df)
 
     output_df.to_csv(path.join(output_dir, 'data.tsv'), sep='\t', index=False)
+
+
+def storage_error_report(caps_dir, tsv_path, output_path=None, preprocessing="linear",
+                         dtypes=('float16', 'uint16', 'uint8'), compress=False):
+    """
+    Measures the error made by the storage formats of the preprocessing_dl outputs compared to float32,
+    for example on a dataset written by generate_random_dataset or generate_trivial_dataset.
+
+    :param caps_dir: (str) path to the CAPS directory.
+    :param tsv_path: (str) path to tsv file of list of subjects/sessions.
+    :param output_path: (str) path to the output tsv file. If None the report is only returned.
+    :param preprocessing: (str) preprocessing performed. Must be in ['linear', 'extensive'].
+    :param dtypes: (list[str]) storage dtypes compared to float32 (see tools.deep_learning.data.encode_image).
+    :param compress: (bool) if True the sizes are measured with compression.
+    :return: (DataFrame) for each storage dtype, the mean compression ratio and the mean and maximum errors
+             (absolute and relative to the intensity range of the images).
+    """
+    import pickle
+    from ..deep_learning.data import encode_image, decode_image
+
+    data_df = pd.read_csv(tsv_path, sep='\t')
+    columns = ['participant_id', 'session_id', 'dtype', 'size_ratio', 'mean_abs_error', 'max_abs_error',
+               'max_relative_error']
+    rows = []
+    for participant_id, session_id in zip(data_df.participant_id.values, data_df.session_id.values):
+        image_path = find_image_path(caps_dir, participant_id, session_id, preprocessing)
+        image = torch.from_numpy(np.nan_to_num(nib.load(image_path).get_fdata())).float()
+        reference_size = len(pickle.dumps(encode_image(image, 'float32', compress)))
+        intensity_range = float(image.max() - image.min())
+
+        for dtype in dtypes:
+            stored = encode_image(image, dtype, compress)
+            error = (decode_image(stored) - image).abs()
+            max_error = float(error.max())
+            rows.append([participant_id, session_id, dtype, len(pickle.dumps(stored)) / reference_size,
+                         float(error.mean()), max_error,
+                         max_error / intensity_range if intensity_range > 0 else 0.0])
+
+    errors_df = pd.DataFrame(rows, columns=columns)
+    report_df = errors_df.groupby('dtype', sort=False).agg({'size_ratio': 'mean',
+                                                              'mean_abs_error': 'mean',
+                                                              'max_abs_error': 'max',
+                                                              'max_relative_error': 'max'}).reset_index()
+    if output_path is not None:
+        report_df.to_csv(output_path, sep='\t', index=False)
+
+    return report_df
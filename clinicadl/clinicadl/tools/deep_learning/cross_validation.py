@@ -0,0 +1,93 @@
+import os
+
+
+def _train_fold(train_function, params, fold):
+    """Entry point of the processes launched by run_folds, training one fold of params."""
+    import copy
+
+    fold_params = copy.copy(params)
+    fold_params.split = fold
+    train_function(fold_params)
+
+
+def run_folds(train_function, params, folds, n_processes, n_threads=None, retries=0):
+    """
+    Trains the folds of a cross-validation in separate processes, with at most n_processes folds at the same time.
+    Each process trains one fold by calling train_function on a copy of params whose split is the fold, so the
+    outputs of each fold are written in its fold_<i> folders as when the folds are trained one after the other.
+    The caches on disk (cohort array, feature cache) are shared by the processes through the page cache of the OS.
+
+    :param train_function: (callable) training function taking the parameters as only argument
+                           (e.g. train_cnn, train_slice). Must be defined at the top level of a module.
+    :param params: (Parameters) options of the training.
+    :param folds: (list) indices of the folds to train.
+    :param n_processes: (int) maximum number of folds trained at the same time.
+    :param n_threads: (int) number of threads used by torch in each process. If None the default of torch is used.
+    :param retries: (int) number of times a fold which failed is trained again.
+    :return: (list) the folds which failed after all the retries.
+    """
+    from .parallel import run_processes
+
+    args_list = [(train_function, params, fold) for fold in folds]
+    failed_args = run_processes(_train_fold, args_list, n_processes, n_threads=n_threads)
+    for attempt in range(retries):
+        if len(failed_args) == 0:
+            break
+        print("Retry %i/%i of the folds %s." % (attempt + 1, retries, str([args[2] for args in failed_args])))
+        failed_args = run_processes(_train_fold, failed_args, n_processes, n_threads=n_threads)
+
+    failed_folds = [args[2] for args in failed_args]
+    aggregated_files = aggregate_fold_metrics(params.output_dir, [fold for fold in folds if fold not in failed_folds])
+    if len(aggregated_files) == 0:
+        # the subject-level trainers and the autoencoders write no metrics in performances
+        print("Warning: no metrics were found in %s, the results of the folds were not aggregated. "
+              "The folds can be evaluated separately." % os.path.join(params.output_dir, 'performances'))
+
+    return failed_folds
+
+
+def aggregate_fold_metrics(output_dir, folds, selections=('best_acc', 'best_loss')):
+    """
+    Gathers the metrics written by each fold in performances/fold_<i>/<selection>/*_metrics*.tsv into
+    performances/cross_validation/<selection>, with one row per fold followed by the mean and the standard
+    deviation of the numerical metrics over the folds.
+
+    :param output_dir: (str) path to the output directory of the training.
+    :param folds: (list) indices of the folds to aggregate.
+    :param selections: (list) selections of the models.
+    :return: (list) paths of the aggregated tsv files.
+    """
+    import pandas as pd
+
+    aggregated_files = []
+
+    for selection in selections:
+        fold_dirs = {fold: os.path.join(output_dir, 'performances', 'fold_%i' % fold, selection) for fold in folds}
+        filenames = set()
+        for fold_dir in fold_dirs.values():
+            if os.path.isdir(fold_dir):
+                filenames |= {filename for filename in os.listdir(fold_dir)
+                              if filename.endswith('.tsv') and '_metrics' in filename}
+
+        for filename in sorted(filenames):
+            fold_dfs = []
+            for fold, fold_dir in fold_dirs.items():
+                metrics_path = os.path.join(fold_dir, filename)
+                if os.path.exists(metrics_path):
+                    fold_df = pd.read_csv(metrics_path, sep='\t')
+                    fold_df.insert(0, 'fold', str(fold))
+                    fold_dfs.append(fold_df)
+
+            metrics_df = pd.concat(fold_dfs, ignore_index=True, sort=False)
+            numerical_df = metrics_df.drop('fold', axis=1).select_dtypes('number')
+            summary_df = pd.DataFrame([numerical_df.mean(), numerical_df.std()])
+            summary_df.insert(0, 'fold', ['mean', 'std'])
+            metrics_df = pd.concat([metrics_df, summary_df], ignore_index=True, sort=False)
+
+            aggregate_dir = os.path.join(output_dir, 'performances', 'cross_validation', selection)
+            if not os.path.exists(aggregate_dir):
+                os.makedirs(aggregate_dir)
+            metrics_df.to_csv(os.path.join(aggregate_dir, filename), index=False, sep='\t')
+            aggregated_files.append(os.path.join(aggregate_dir, filename))
+
+    return aggregated_files
@@ -2,26 +2,69 @@ import torch
 import pandas as pd
 import numpy as np
 from os import path
+from functools import lru_cache
 from torch.utils.data import Dataset, sampler
 from scipy.ndimage.filters import gaussian_filter
 
 
+class SessionIndex(object):
+    """
+    Compact arrays describing the sessions of a DataFrame, built once when a dataset is created.
+    The identifiers are fixed-width numpy strings: the arrays are single buffers which are read without
+    touching reference counts, so the forked DataLoader workers share their pages instead of copying them,
+    which is not the case when the rows of a DataFrame are accessed in __getitem__.
+    """
+
+    def __init__(self, df, diagnosis_code):
+        """
+        :param df: (DataFrame) sessions with participant_id, session_id and diagnosis columns.
+        :param diagnosis_code: (dict) code of each diagnosis.
+        """
+        self.participant_id = df.participant_id.values.astype(str)
+        self.session_id = df.session_id.values.astype(str)
+
+        labels = df.diagnosis.map(diagnosis_code)
+        if labels.isnull().any():
+            unknown_diagnoses = df.diagnosis[labels.isnull()].unique()
+            raise ValueError("The diagnoses %s are not in %s." % (list(unknown_diagnoses), list(diagnosis_code)))
+        self.label = labels.values.astype(np.int64)
+
+    def __len__(self):
+        return len(self.label)
+
+    def caps_prefixes(self, caps_dir, *sub_dirs):
+        """
+        Builds the common prefix of the CAPS files of each session.
+
+        :param caps_dir: (str) path to the CAPS directory.
+        :param sub_dirs: (str) folders between the session folder and the files (e.g. 't1', 'preprocessing_dl').
+        :return: (np.array) caps_dir/subjects/<participant_id>/<session_id>/<sub_dirs>/<participant_id>_<session_id>
+        """
+        return np.array([path.join(caps_dir, 'subjects', participant_id, session_id, *sub_dirs,
+                                   participant_id + '_' + session_id)
+                         for participant_id, session_id in zip(self.participant_id, self.session_id)])
+
+
 class MRIDataset(Dataset):
     """Dataset of MRI organized in a CAPS folder."""
 
-    def __init__(self, img_dir, data_file, preprocessing='linear', transform=None):
+    def __init__(self, img_dir, data_file, preprocessing='linear', transform=None, cohort_path=None):
         """
         Args:
             img_dir (string): Directory of all the images.
             data_file (string): File name of the train/test split file.
             preprocessing (string): Defines the path to the data in CAPS
             transform (callable, optional): Optional transform to be applied on a sample.
+            cohort_path (string, optional): Path to a cohort array written by pack_cohort. If given, the images
+                are views on this memory-mapped array instead of being loaded from CAPS.
 
         """
         self.img_dir = img_dir
         self.transform = transform
         self.diagnosis_code = {'CN': 0, 'AD': 1, 'sMCI': 0, 'pMCI': 1, 'MCI': 1, 'unlabeled': -1}
         self.data_path = preprocessing
+        self.cohort_path = cohort_path
+        self._cohort_array = None
 
         # Check the format of the tsv file here
         if isinstance(data_file, str):
@@ -36,29 +79,56 @@ class MRIDataset(Dataset):
             raise Exception("the data file is not in the correct format."
                             "Columns should include ['participant_id', 'session_id', 'diagnosis']")
 
-        self.size = self[0]['image'].numpy().size
+        self.build_index()
 
-    def __len__(self):
-        return len(self.df)
+    def __getstate__(self):
+        # the memory map of the cohort is opened again in each worker
+        state = self.__dict__.copy()
+        state['_cohort_array'] = None
+        return state
 
-    def __getitem__(self, idx):
-        img_name = self.df.loc[idx, 'participant_id']
-        img_label = self.df.loc[idx, 'diagnosis']
-        sess_name = self.df.loc[idx, 'session_id']
+    @property
+    def size(self):
+        """
+        Number of values of an image, read from the header of the cohort array or from the shape metadata
+        of the CAPS when the transform does not change the shape of the images.
+        """
+        if self.transform is None or isinstance(self.transform, MinMaxNormalization):
+            if self.cohort_path is not None:
+                return int(np.prod(cohort_image_shape(self.cohort_path)))
+            return int(np.prod(caps_image_shape(self.img_dir, str(self.image_paths[0]))))
+        return self[0]['image'].numpy().size
+
+    def build_index(self):
+        """Computes the arrays read by __getitem__ from self.df."""
+        self.sessions = SessionIndex(self.df, self.diagnosis_code)
         # Not in BIDS but in CAPS
         if self.data_path == "linear":
-            image_path = path.join(self.img_dir, 'subjects', img_name, sess_name,
-                                   't1', 'preprocessing_dl',
-                                   img_name + '_' + sess_name + '_space-MNI_res-1x1x1.pt')
+            self.image_paths = np.char.add(self.sessions.caps_prefixes(self.img_dir, 't1', 'preprocessing_dl'),
+                                           '_space-MNI_res-1x1x1.pt')
         elif self.data_path == "mni":
-            image_path = path.join(self.img_dir, 'subjects', img_name, sess_name,
-                                   't1', 'spm', 'segmentation', 'normalized_space',
-                                   img_name + '_' + sess_name + '_space-Ixi549Space_T1w.pt')
+            self.image_paths = np.char.add(self.sessions.caps_prefixes(self.img_dir, 't1', 'spm', 'segmentation',
+                                                                       'normalized_space'),
+                                           '_space-Ixi549Space_T1w.pt')
         else:
             raise NotImplementedError("The data path %s is not implemented" % self.data_path)
 
-        image = torch.load(image_path)
-        label = self.diagnosis_code[img_label]
+        if self.cohort_path is not None:
+            self.cohort_index = cohort_rows(self.cohort_path, self.df)
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __getitem__(self, idx):
+        img_name = str(self.sessions.participant_id[idx])
+        sess_name = str(self.sessions.session_id[idx])
+        image_path = str(self.image_paths[idx])
+
+        if self.cohort_path is not None:
+            image = self.cohort_image(idx)
+        else:
+            image = load_image(image_path)
+        label = int(self.sessions.label[idx])
 
         if self.transform:
             image = self.transform(image)
@@ -67,6 +137,22 @@ class MRIDataset(Dataset):
 
         return sample
 
+    def cohort_image(self, idx):
+        """
+        Returns the image of the idx-th session as a view on the cohort array.
+        The array is opened lazily so that each DataLoader worker maps it after being forked, and all
+        the workers share the same pages of the OS page cache.
+        """
+        if self._cohort_array is None:
+            # copy-on-write mapping: the views are writable but modifications are never written on disk
+            self._cohort_array = np.load(self.cohort_path, mmap_mode='c')
+
+        image = torch.from_numpy(self._cohort_array[self.cohort_index[idx]])
+        if image.dtype != torch.float32:
+            image = image.float()
+
+        return image
+
     def session_restriction(self, session):
         """
             Allows to generate a new MRIDataset using some specific sessions only (mostly used for evaluation of test)
@@ -83,11 +169,616 @@ class MRIDataset(Dataset):
             df_session = self.df[self.df.session_id == session]
             df_session.reset_index(drop=True, inplace=True)
             data_output.df = df_session
+            data_output.build_index()
             if len(data_output) == 0:
                 raise Exception("The session %s doesn't exist for any of the subjects in the test data" % session)
             return data_output
 
 
+def pack_cohort(caps_dir, tsv_file, output_path, preprocessing='linear', dtype='float32'):
+    """
+    Packs the images of all the sessions of a tsv file in one array which can be memory-mapped by MRIDataset.
+    The array is saved in .npy format with shape [n_sessions, *image_shape] and a sidecar tsv file
+    (same name with .tsv extension) indexes its rows by participant_id and session_id.
+
+    :param caps_dir: (str) path to the CAPS directory.
+    :param tsv_file: (str) path to the tsv file of the cohort (participant_id, session_id, diagnosis).
+    :param output_path: (str) path to the output .npy file.
+    :param preprocessing: (str) preprocessing of the images in CAPS (see MRIDataset).
+    :param dtype: (str) dtype of the stored images. Must be in ['float32', 'float16'].
+    :return: (str) path to the sidecar tsv file.
+    """
+    if dtype not in ['float32', 'float16']:
+        raise ValueError("The dtype %s must be in ['float32', 'float16']." % dtype)
+
+    if not output_path.endswith('.npy'):
+        output_path += '.npy'
+    output_dir = path.dirname(path.abspath(output_path))
+    if not path.exists(output_dir):
+        import os
+        os.makedirs(output_dir)
+
+    dataset = MRIDataset(caps_dir, tsv_file, preprocessing)
+    first_image = dataset[0]['image']
+    cohort_array = np.lib.format.open_memmap(output_path, mode='w+', dtype=dtype,
+                                             shape=(len(dataset),) + tuple(first_image.shape))
+
+    for idx in range(len(dataset)):
+        image = dataset[idx]['image']
+        if image.shape != first_image.shape:
+            raise ValueError("All the images of a cohort must have the same shape. Image %s has shape %s "
+                             "instead of %s." % (dataset[idx]['image_path'], tuple(image.shape),
+                                                 tuple(first_image.shape)))
+        cohort_array[idx] = image.numpy()
+    cohort_array.flush()
+    del cohort_array
+
+    index_df = dataset.df[['participant_id', 'session_id', 'diagnosis']].copy()
+    index_df['index'] = np.arange(len(index_df))
+    index_path = path.splitext(output_path)[0] + '.tsv'
+    index_df.to_csv(index_path, sep='\t', index=False)
+
+    return index_path
+
+
+def cohort_image_shape(cohort_path):
+    """
+    Reads the shape of the images of a cohort array from the header of the .npy file, without mapping the array.
+
+    :param cohort_path: (str) path to the .npy file written by pack_cohort.
+    :return: (tuple) shape of the images.
+    """
+    with open(cohort_path, 'rb') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, _, _ = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, _, _ = np.lib.format.read_array_header_2_0(f)
+
+    return tuple(shape[1:])
+
+
+def cohort_rows(cohort_path, df):
+    """
+    Finds the rows of the cohort array corresponding to the sessions of a DataFrame.
+
+    :param cohort_path: (str) path to the .npy file written by pack_cohort.
+    :param df: (DataFrame) sessions to find, with participant_id and session_id columns.
+    :return: (np.array) the row of each session of df in the cohort array.
+    """
+    index_df = pd.read_csv(path.splitext(cohort_path)[0] + '.tsv', sep='\t')
+    index_df.set_index(['participant_id', 'session_id'], inplace=True)
+    sessions = pd.MultiIndex.from_arrays([df.participant_id.values, df.session_id.values])
+    missing_sessions = sessions.difference(index_df.index)
+    if len(missing_sessions) > 0:
+        raise ValueError("The sessions %s are not in the cohort %s." % (list(missing_sessions), cohort_path))
+
+    return index_df.loc[sessions, 'index'].values.astype(np.int64)
+
+
+STORAGE_DTYPES = ['float32', 'float16', 'uint16', 'uint8']
+
+
+def encode_image(image, dtype='float32', compress=False):
+    """
+    Encodes a float tensor in one of the storage formats of the preprocessing_dl outputs.
+    float32 and float16 images are stored as tensors. uint16 and uint8 images are quantized linearly between the
+    minimum and the maximum of the image, and the scale and offset needed to decode them are stored with the data.
+    NaN values are stored as 0 by the quantized formats.
+
+    :param image: (tensor) float image.
+    :param dtype: (str) storage dtype. Must be in STORAGE_DTYPES.
+    :param compress: (bool) if True the data is compressed with zlib (fastest level).
+    :return: (tensor or dict) the object to save with torch.save, decoded by decode_image.
+    """
+    if dtype not in STORAGE_DTYPES:
+        raise ValueError("The storage dtype %s must be in %s." % (dtype, STORAGE_DTYPES))
+
+    image = image.float()
+    scale, offset = 1.0, 0.0
+    if dtype in ['float32', 'float16']:
+        data = image.numpy().astype(dtype)
+    else:
+        image = torch.where(torch.isnan(image), torch.zeros_like(image), image)
+        levels = np.iinfo(dtype).max
+        offset = float(image.min())
+        scale = (float(image.max()) - offset) / levels
+        if scale == 0:
+            scale = 1.0
+        data = np.rint(((image - offset) / scale).numpy()).clip(0, levels).astype(dtype)
+
+    if not compress and dtype in ['float32', 'float16']:
+        return torch.from_numpy(data)
+
+    stored = {'dtype': dtype, 'shape': data.shape, 'scale': scale, 'offset': offset, 'compressed': compress}
+    if compress:
+        import zlib
+        stored['data'] = zlib.compress(np.ascontiguousarray(data).tobytes(), 1)
+    elif dtype == 'uint16':
+        # torch < 2.3 has no uint16 tensors, the data is stored with the same bits as int16
+        stored['data'] = torch.from_numpy(data.view(np.int16))
+    else:
+        stored['data'] = torch.from_numpy(data)
+
+    return stored
+
+
+def decode_image(stored):
+    """
+    Decodes an object written by encode_image.
+
+    :param stored: (tensor or dict) object loaded from a preprocessing_dl output.
+    :return: (tensor) float32 image.
+    """
+    if isinstance(stored, torch.Tensor):
+        return stored.float()
+
+    if stored['compressed']:
+        import zlib
+        data = np.frombuffer(zlib.decompress(stored['data']), dtype=stored['dtype']).reshape(stored['shape'])
+        image = torch.from_numpy(data.astype(np.float32))
+    elif stored['dtype'] == 'uint16':
+        image = torch.from_numpy(stored['data'].numpy().view(np.uint16).astype(np.float32))
+    else:
+        image = stored['data'].float()
+
+    if stored['dtype'] not in ['float32', 'float16']:
+        image = image.mul_(stored['scale']).add_(stored['offset'])
+
+    return image
+
+
+def load_image(image_path):
+    """
+    Reads an image, a patch or a slice saved in any of the storage formats of encode_image.
+
+    :param image_path: (str) path to the .pt file.
+    :return: (tensor) float32 tensor.
+    """
+    return decode_image(torch.load(image_path))
+
+
+def save_image(image, image_path, dtype='float32', compress=False):
+    """
+    Saves an image, a patch or a slice in one of the storage formats of encode_image.
+
+    :param image: (tensor) float tensor.
+    :param image_path: (str) path to the .pt file.
+    :param dtype: (str) storage dtype. Must be in STORAGE_DTYPES.
+    :param compress: (bool) if True the data is compressed with zlib.
+    """
+    # encode_image copies the data, so the file never contains the storage of a larger tensor
+    torch.save(encode_image(image, dtype, compress), image_path)
+
+
+def shape_sidecar_path(image_path):
+    """:return: (str) path to the json file storing the shape of the tensor saved at image_path."""
+    return path.splitext(image_path)[0] + '.json'
+
+
+# Number of slices discarded at each border of an axis due to the lack of information
+DISCARDED_SLICES = 20
+SLICE_AXES = ['sag', 'cor', 'axi']
+
+
+def foreground_mask(image):
+    """
+    Computes the foreground of an image. A voxel is in the foreground if its intensity exceeds the minimum
+    of the image by more than 1% of the intensity range.
+
+    :param image: (tensor) image of shape [1, X, Y, Z] or [X, Y, Z].
+    :return: (tensor) float mask of shape [X, Y, Z], 1 in the foreground and 0 in the background.
+    """
+    image = image.reshape(image.shape[-3:])
+    image = torch.where(torch.isnan(image), torch.zeros_like(image), image)
+    threshold = image.min() + 0.01 * (image.max() - image.min())
+    return (image > threshold).float()
+
+
+def slice_foreground(image):
+    """
+    Computes the fraction of foreground voxels of each slice of each axis of an image (see foreground_mask).
+
+    :param image: (tensor) image of shape [1, X, Y, Z] or [X, Y, Z].
+    :return: (dict) list of the fractions of the slices of each axis, indexed by the names of SLICE_AXES.
+    """
+    foreground = foreground_mask(image)
+
+    fractions = dict()
+    for direction, axis_name in enumerate(SLICE_AXES):
+        other_dims = tuple(dim for dim in range(3) if dim != direction)
+        fractions[axis_name] = [round(fraction, 4) for fraction in foreground.mean(dim=other_dims).tolist()]
+
+    return fractions
+
+
+def write_image_metadata(image, image_path):
+    """
+    Writes the sidecar json file of an image, so that its shape and the foreground of its slices can be known
+    without loading the image.
+
+    :param image: (tensor) image saved at image_path.
+    :param image_path: (str) path to the .pt file.
+    :return: (str) path to the json file.
+    """
+    import json
+
+    sidecar_path = shape_sidecar_path(image_path)
+    with open(sidecar_path, 'w') as f:
+        json.dump({'shape': list(image.shape), 'slice_foreground': slice_foreground(image)}, f)
+
+    return sidecar_path
+
+
+def read_image_metadata(image_path):
+    """
+    Reads the sidecar json file of an image. If it does not exist, the metadata is computed from the image.
+
+    :param image_path: (str) path to the .pt file.
+    :return: (dict) with keys 'shape' and 'slice_foreground' (see write_image_metadata).
+    """
+    sidecar_path = shape_sidecar_path(image_path)
+    if path.exists(sidecar_path):
+        import json
+
+        with open(sidecar_path, 'r') as f:
+            metadata = json.load(f)
+        if 'slice_foreground' in metadata:
+            return metadata
+
+    image = load_image(image_path)
+    return {'shape': list(image.shape), 'slice_foreground': slice_foreground(image)}
+
+
+_caps_image_shapes = dict()
+
+
+def caps_image_shape(caps_dir, image_path):
+    """
+    Returns the shape of the images of a CAPS directory. All the images sharing the file suffix of image_path
+    (e.g. space-MNI_res-1x1x1.pt) are assumed to have the same shape, which is read once per process from the
+    sidecar json of image_path. The image itself is loaded only when the sidecar does not exist.
+
+    :param caps_dir: (str) path to the CAPS directory.
+    :param image_path: (str) path to one image of the CAPS directory.
+    :return: (tuple) shape of the images.
+    """
+    key = (path.abspath(caps_dir), path.basename(image_path).split('_', 2)[-1])
+    if key not in _caps_image_shapes:
+        sidecar_path = shape_sidecar_path(image_path)
+        if path.exists(sidecar_path):
+            import json
+
+            with open(sidecar_path, 'r') as f:
+                _caps_image_shapes[key] = tuple(json.load(f)['shape'])
+        else:
+            _caps_image_shapes[key] = tuple(load_image(image_path).shape)
+
+    return _caps_image_shapes[key]
+
+
+class PatchGrid(object):
+    """
+    Grid of the cubic patches extracted from images of a given shape.
+    The patches are indexed in the same order as tensor.unfold along the three spatial dimensions.
+    """
+
+    def __init__(self, image_shape, patch_size, stride_size):
+        """
+        :param image_shape: (tuple) shape of the images [C, X, Y, Z] (only the last three dimensions are used).
+        :param patch_size: (int) size of the patches.
+        :param stride_size: (int) stride between two patches.
+        """
+        spatial_shape = tuple(image_shape[-3:])
+        if any(dim < patch_size for dim in spatial_shape):
+            raise ValueError("The patch size %i is larger than the image of shape %s." % (patch_size, spatial_shape))
+
+        self.patch_size = patch_size
+        self.stride_size = stride_size
+        self.grid_shape = tuple((dim - patch_size) // stride_size + 1 for dim in spatial_shape)
+        self.num_patches = int(np.prod(self.grid_shape))
+        # offsets[i] is the corner of the patch of index i
+        self.offsets = np.indices(self.grid_shape).reshape(3, -1).T * stride_size
+
+    def extract_patch(self, image_tensor, index_patch):
+        """
+        Returns a view on one patch of an image.
+
+        :param image_tensor: (tensor) image of shape [C, X, Y, Z].
+        :param index_patch: (int) index of the patch.
+        :return: (tensor) view of shape [C, patch_size, patch_size, patch_size].
+        """
+        x, y, z = self.offsets[index_patch]
+        return image_tensor[:, x:x + self.patch_size, y:y + self.patch_size, z:z + self.patch_size]
+
+    def extract_all_patches(self, image_tensor):
+        """
+        Returns all the patches of an image as one batch.
+
+        :param image_tensor: (tensor) image of shape [C, X, Y, Z].
+        :return: (tensor) patches of shape [num_patches, C, patch_size, patch_size, patch_size].
+        """
+        # strided view of shape [C, n_x, n_y, n_z, P, P, P]: no data is copied until the final reshape
+        patches_tensor = image_tensor.unfold(1, self.patch_size, self.stride_size
+                                             ).unfold(2, self.patch_size, self.stride_size
+                                                      ).unfold(3, self.patch_size, self.stride_size)
+        patches_tensor = patches_tensor.permute(1, 2, 3, 0, 4, 5, 6)
+        return patches_tensor.reshape(self.num_patches, image_tensor.shape[0],
+                                      self.patch_size, self.patch_size, self.patch_size)
+
+
+@lru_cache(maxsize=None)
+def patch_grid(image_shape, patch_size, stride_size):
+    """
+    Returns the PatchGrid of the images of shape image_shape, computed once per process.
+
+    :param image_shape: (tuple) shape of the images [C, X, Y, Z].
+    :param patch_size: (int) size of the patches.
+    :param stride_size: (int) stride between two patches.
+    :return: (PatchGrid)
+    """
+    return PatchGrid(tuple(image_shape), patch_size, stride_size)
+
+
+def patch_occupancy(image, patch_size, stride_size):
+    """
+    Computes the fraction of foreground voxels of each patch of an image (see foreground_mask).
+
+    :param image: (tensor) image of shape [1, X, Y, Z].
+    :param patch_size: (int) size of the patches.
+    :param stride_size: (int) stride between two patches.
+    :return: (np.array) fraction of each patch, in the order of the patch indices.
+    """
+    mask = foreground_mask(image).unsqueeze(0)
+    mask_patches = patch_grid(tuple(mask.shape), patch_size, stride_size).extract_all_patches(mask)
+    return mask_patches.reshape(mask_patches.shape[0], -1).mean(dim=1).numpy()
+
+
+def patch_occupancy_path(image_path, patch_size, stride_size):
+    """:return: (str) path to the json file storing the occupancy of the patches of the image saved at image_path."""
+    return path.splitext(image_path)[0] + '_patchsize-%i_stride-%i_occupancy.json' % (patch_size, stride_size)
+
+
+def write_patch_occupancy(image, image_path, patch_size, stride_size):
+    """
+    Writes the occupancy of the patches of an image in a sidecar json file, read to select the patches
+    without loading the image.
+
+    :param image: (tensor) image saved at image_path.
+    :param image_path: (str) path to the .pt file of the image.
+    :param patch_size: (int) size of the patches.
+    :param stride_size: (int) stride between two patches.
+    :return: (str) path to the json file.
+    """
+    import json
+
+    occupancy_path = patch_occupancy_path(image_path, patch_size, stride_size)
+    with open(occupancy_path, 'w') as f:
+        json.dump({'occupancy': [round(float(fraction), 4)
+                                 for fraction in patch_occupancy(image, patch_size, stride_size)]}, f)
+
+    return occupancy_path
+
+
+def read_patch_occupancy(image_path, patch_size, stride_size):
+    """
+    Reads the occupancy of the patches of an image. If the sidecar file does not exist, it is computed
+    from the image.
+
+    :param image_path: (str) path to the .pt file of the image.
+    :param patch_size: (int) size of the patches.
+    :param stride_size: (int) stride between two patches.
+    :return: (np.array) fraction of foreground voxels of each patch.
+    """
+    occupancy_path = patch_occupancy_path(image_path, patch_size, stride_size)
+    if path.exists(occupancy_path):
+        import json
+
+        with open(occupancy_path, 'r') as f:
+            return np.array(json.load(f)['occupancy'])
+
+    return patch_occupancy(load_image(image_path), patch_size, stride_size)
+
+
+class ImageCache(object):
+    """
+    Least-recently-used cache of whole images bounded by a memory budget.
+
+    Each DataLoader worker owns its copy of the dataset, hence its own cache. The hit and miss counters are
+    shared between the workers so that they can be logged by the main process.
+    """
+
+    def __init__(self, max_bytes):
+        """
+        Args:
+            max_bytes (int): maximum number of bytes of the images kept in memory.
+        """
+        from collections import OrderedDict
+        import multiprocessing
+
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._images = OrderedDict()
+        self._hits = multiprocessing.Value('l', 0)
+        self._misses = multiprocessing.Value('l', 0)
+
+    def load(self, image_path):
+        """
+        Returns the image stored at image_path, from memory if it was already loaded.
+        The returned tensor is shared with the cache and must not be modified in place.
+
+        :param image_path: (str) path to the tensor file.
+        :return: (tensor) the image.
+        """
+        if image_path in self._images:
+            self._images.move_to_end(image_path)
+            with self._hits.get_lock():
+                self._hits.value += 1
+            return self._images[image_path]
+
+        image = load_image(image_path)
+        with self._misses.get_lock():
+            self._misses.value += 1
+
+        n_bytes = image.element_size() * image.nelement()
+        if n_bytes <= self.max_bytes:
+            while self.current_bytes + n_bytes > self.max_bytes:
+                _, evicted_image = self._images.popitem(last=False)
+                self.current_bytes -= evicted_image.element_size() * evicted_image.nelement()
+            self._images[image_path] = image
+            self.current_bytes += n_bytes
+
+        return image
+
+    @property
+    def hits(self):
+        return self._hits.value
+
+    @property
+    def misses(self):
+        return self._misses.value
+
+    @property
+    def hit_rate(self):
+        if self.hits + self.misses == 0:
+            return 0.0
+        return self.hits / (self.hits + self.misses)
+
+    def reset_counters(self):
+        with self._hits.get_lock():
+            self._hits.value = 0
+        with self._misses.get_lock():
+            self._misses.value = 0
+
+
+def log_cache_statistics(dataset, writer, step):
+    """
+    Logs and resets the counters of the image cache of a dataset, if the dataset uses one.
+
+    :param dataset: (Dataset) a dataset which may have an image_cache attribute.
+    :param writer: (SummaryWriter) writer in which the hit rate is written.
+    :param step: (int) step associated to the value in the writer.
+    """
+    image_cache = getattr(dataset, 'image_cache', None)
+    if image_cache is None:
+        return
+
+    print("Image cache: %i hits, %i misses (hit rate %f)" % (image_cache.hits, image_cache.misses,
+                                                             image_cache.hit_rate))
+    writer.add_scalar('image cache hit rate', image_cache.hit_rate, step)
+    image_cache.reset_counters()
+
+
+def session_offsets(dataset):
+    """
+    Returns the index of the first element (patch / slice) of each image of a dataset.
+
+    The elements of an image must have consecutive indices. Datasets with a variable number of elements per
+    image define a session_offsets attribute, the other ones index their elements as
+    image_index * elem_per_image + elem_index.
+
+    :param dataset: (Dataset) dataset with a df attribute.
+    :return: (np.array) array of length n_images + 1, the last value being the length of the dataset.
+    """
+    if hasattr(dataset, 'session_offsets'):
+        return dataset.session_offsets
+
+    n_images = len(dataset.df)
+    elem_per_image = len(dataset) // n_images
+    return np.arange(n_images + 1) * elem_per_image
+
+
+class SubjectGroupedSampler(sampler.Sampler):
+    """
+    Samples all the patches / slices of an image consecutively, so that a cache of whole images
+    is hit by consecutive indices. The order of the images and the order of the patches / slices
+    inside an image are shuffled at each epoch.
+
+    The elements of an image must have consecutive indices (see session_offsets).
+    """
+
+    def __init__(self, data_source, shuffle=True):
+        self.data_source = data_source
+        self.shuffle = shuffle
+        self.offsets = session_offsets(data_source)
+        self.n_images = len(self.offsets) - 1
+
+    def __iter__(self):
+        if self.shuffle:
+            image_order = torch.randperm(self.n_images)
+        else:
+            image_order = torch.arange(self.n_images)
+
+        for image_index in image_order.tolist():
+            start, stop = int(self.offsets[image_index]), int(self.offsets[image_index + 1])
+            if self.shuffle:
+                elem_order = torch.randperm(stop - start)
+            else:
+                elem_order = torch.arange(stop - start)
+            for elem_index in elem_order.tolist():
+                yield start + elem_index
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+
+def generate_sampler(dataset, sampler_option='random'):
+    """
+    Returns the sampler of the training set according to sampler_option.
+
+    :param dataset: (Dataset) the training set.
+    :param sampler_option: (str) 'random' to shuffle all the elements of the dataset,
+        'grouped' to shuffle the images and yield all the elements of an image consecutively.
+    :return: (Sampler)
+    """
+    if sampler_option == 'random':
+        return sampler.RandomSampler(dataset)
+    elif sampler_option == 'grouped':
+        return SubjectGroupedSampler(dataset)
+    else:
+        raise NotImplementedError("The option %s for sampler is not implemented" % sampler_option)
+
+
+def generate_probe_loader(data_loader, probe_size, seed=0):
+    """
+    Returns a DataLoader on a fixed random subset of the sessions of the training set (the train probe).
+    All the patches / slices of the chosen sessions are kept, so that the subject-level metrics can be
+    computed on the probe.
+
+    :param data_loader: (DataLoader) wrapper of the training dataset.
+    :param probe_size: (int) number of sessions in the probe. If 0 no probe is used.
+    :param seed: (int) seed of the choice of the sessions, so that the probe does not change between epochs.
+    :return: (DataLoader) wrapper of the probe, or None if probe_size is 0.
+    """
+    from torch.utils.data import DataLoader, Subset
+
+    if probe_size <= 0:
+        return None
+
+    dataset = data_loader.dataset
+    offsets = session_offsets(dataset)
+    n_images = len(offsets) - 1
+    random_state = np.random.RandomState(seed)
+    sessions = np.sort(random_state.choice(n_images, min(probe_size, n_images), replace=False))
+    indices = np.concatenate([np.arange(offsets[session], offsets[session + 1]) for session in sessions])
+
+    return DataLoader(Subset(dataset, indices.tolist()),
+                      batch_size=data_loader.batch_size,
+                      shuffle=False,
+                      num_workers=data_loader.num_workers,
+                      worker_init_fn=data_loader.worker_init_fn,
+                      collate_fn=data_loader.collate_fn,
+                      pin_memory=data_loader.pin_memory)
+
+
+def use_train_probe(probe_loader, n_evaluations, probe_frequency):
+    """
+    Returns True if the training metrics of the n_evaluations-th evaluation are computed on the train probe
+    (one evaluation out of probe_frequency) and False if the running metrics of the training loop are used.
+    """
+    return probe_loader is not None and n_evaluations % probe_frequency == 0
+
+
 class GaussianSmoothing(object):
 
     def __init__(self, sigma):
@@ -119,11 +810,49 @@ class MinMaxNormalization(object):
         return (image - image.min()) / (image.max() - image.min())
 
 
-def load_data(train_val_path, diagnoses_list, split, n_splits=None, baseline=True):
+TSV_COLUMNS = ['participant_id', 'session_id', 'diagnosis']
+
 
-    train_df = pd.DataFrame()
-    valid_df = pd.DataFrame()
+@lru_cache(maxsize=None)
+def _read_split_directory(split_path, diagnoses, baseline):
+    """
+    Reads and concatenates the tsv files of the diagnoses in a split directory, once per process.
+    The frames returned must not be modified: load_data and load_data_test return copies.
 
+    :param split_path: (str) absolute path to the directory containing the tsv files.
+    :param diagnoses: (tuple) diagnoses to load.
+    :param baseline: (bool) if True the <diagnosis>_baseline.tsv files are read, else <diagnosis>.tsv.
+    :return: (DataFrame) the sessions of all the diagnoses.
+    """
+    suffix = '_baseline.tsv' if baseline else '.tsv'
+    diagnosis_dfs = []
+    for diagnosis in diagnoses:
+        diagnosis_path = path.join(split_path, diagnosis + suffix)
+        diagnosis_df = pd.read_csv(diagnosis_path, sep='\t')
+        missing_columns = [column for column in TSV_COLUMNS if column not in diagnosis_df.columns]
+        if len(missing_columns) > 0:
+            raise ValueError("The tsv file %s does not contain the columns %s." % (diagnosis_path, missing_columns))
+        diagnosis_dfs.append(diagnosis_df)
+
+    if len(diagnosis_dfs) == 0:
+        return pd.DataFrame(columns=TSV_COLUMNS)
+
+    return pd.concat(diagnosis_dfs, ignore_index=True)
+
+
+def load_data(train_val_path, diagnoses_list, split, n_splits=None, baseline=True):
+    """
+    Loads the training and validation sessions of a split.
+    The tsv files are read once per process, the following calls with the same arguments return copies
+    of the frames already loaded.
+
+    :param train_val_path: (str) path to the directory containing the train and validation folders.
+    :param diagnoses_list: (list) diagnoses to load.
+    :param split: (int) index of the split.
+    :param n_splits: (int) number of splits. If None, the train and validation folders are used directly.
+    :param baseline: (bool) if True only the baseline sessions of the training set are loaded.
+    :return: (DataFrame, DataFrame) training and validation sessions.
+    """
     if n_splits is None:
         train_path = path.join(train_val_path, 'train')
         valid_path = path.join(train_val_path, 'validation')
@@ -137,37 +866,21 @@ def load_data(train_val_path, diagnoses_list, split, n_splits=None, baseline=Tru
     print("Train", train_path)
     print("Valid", valid_path)
 
-    for diagnosis in diagnoses_list:
+    diagnoses = tuple(diagnoses_list)
+    train_df = _read_split_directory(path.abspath(train_path), diagnoses, bool(baseline))
+    valid_df = _read_split_directory(path.abspath(valid_path), diagnoses, True)
 
-        if baseline:
-            train_diagnosis_path = path.join(train_path, diagnosis + '_baseline.tsv')
-        else:
-            train_diagnosis_path = path.join(train_path, diagnosis + '.tsv')
-
-        valid_diagnosis_path = path.join(valid_path, diagnosis + '_baseline.tsv')
-
-        train_diagnosis_df = pd.read_csv(train_diagnosis_path, sep='\t')
-        valid_diagnosis_df = pd.read_csv(valid_diagnosis_path, sep='\t')
-
-        train_df = pd.concat([train_df, train_diagnosis_df])
-        valid_df = pd.concat([valid_df, valid_diagnosis_df])
-
-    train_df.reset_index(inplace=True, drop=True)
-    valid_df.reset_index(inplace=True, drop=True)
-
-    return train_df, valid_df
+    return train_df.copy(), valid_df.copy()
 
 
 def load_data_test(test_path, diagnoses_list):
+    """
+    Loads the baseline sessions of a test directory.
 
-    test_df = pd.DataFrame()
-
-    for diagnosis in diagnoses_list:
-
-        test_diagnosis_path = path.join(test_path, diagnosis + '_baseline.tsv')
-        test_diagnosis_df = pd.read_csv(test_diagnosis_path, sep='\t')
-        test_df = pd.concat([test_df, test_diagnosis_df])
-
-    test_df.reset_index(inplace=True, drop=True)
+    :param test_path: (str) path to the directory containing the tsv files.
+    :param diagnoses_list: (list) diagnoses to load.
+    :return: (DataFrame) test sessions.
+    """
+    test_df = _read_split_directory(path.abspath(test_path), tuple(diagnoses_list), True)
 
-    return test_df
+    return test_df.copy()
@@ -0,0 +1,264 @@
+import os
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import Dataset
+
+
+def file_signature(file_path):
+    """
+    Identifies the content of a file from its path, size and modification time, without reading it.
+    The images of a CAPS are only rewritten by the preprocessing, which changes their modification time.
+
+    :param file_path: (str) path to the file.
+    :return: (str) md5 checksum of the absolute path, the size and the modification time of the file.
+    """
+    import hashlib
+
+    file_stat = os.stat(file_path)
+    return hashlib.md5(('%s_%i_%f' % (os.path.abspath(file_path), file_stat.st_size,
+                                      file_stat.st_mtime)).encode()).hexdigest()
+
+
+def freeze(modules):
+    """
+    Disables the gradients of the parameters of modules, so that the optimizers built on the parameters
+    which require gradients do not update them.
+
+    :param modules: (list) modules to freeze.
+    """
+    for module in modules:
+        for p in module.parameters():
+            p.requires_grad = False
+
+
+class FeatureCache(object):
+    """
+    Memory-mapped cache of the outputs of the frozen layers of a model.
+    The features of an element (image, patch, slice) are keyed by the signature of the image from which it is
+    extracted (see file_signature) and the identifier of the element, so that the same cache is shared by all
+    the folds and epochs, and is not reused if an image changes.
+
+    The cache is stored in a sub-folder of cache_dir named after the checksum of the weights of the frozen
+    layers and of the input_tag:
+        - features.dat: raw array of shape [n_rows, ...],
+        - index.tsv: key and row of each element,
+        - metadata.json: shape and dtype of the features.
+    """
+
+    def __init__(self, cache_dir, modules, dtype='float16', input_tag=''):
+        """
+        :param cache_dir: (str) folder of the caches.
+        :param modules: (list) frozen modules whose outputs are cached.
+        :param dtype: (str) dtype of the stored features ('float16' or 'float32').
+        :param input_tag: (str) description of the inputs of the frozen modules (preprocessing, normalization...).
+                          Inputs built differently are stored in different caches.
+        """
+        import hashlib
+        import json
+
+        if dtype not in ['float16', 'float32']:
+            raise ValueError("The dtype %s of the feature cache must be in ['float16', 'float32']." % dtype)
+
+        md5 = hashlib.md5(input_tag.encode())
+        for module in modules:
+            for name, tensor in module.state_dict().items():
+                md5.update(name.encode())
+                md5.update(tensor.detach().cpu().numpy().tobytes())
+
+        self.cache_dir = os.path.join(cache_dir, 'frozen-' + md5.hexdigest()[:16])
+        self.features_path = os.path.join(self.cache_dir, 'features.dat')
+        self.index_path = os.path.join(self.cache_dir, 'index.tsv')
+        self.metadata_path = os.path.join(self.cache_dir, 'metadata.json')
+        self.dtype = np.dtype(dtype)
+        self.feature_shape = None
+        self.index = {}
+        self.n_rows = 0
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        if os.path.exists(self.metadata_path):
+            with open(self.metadata_path, 'r') as f:
+                metadata = json.load(f)
+            if metadata['dtype'] != self.dtype.name:
+                raise ValueError("The feature cache %s stores features in %s, not in %s."
+                                 % (self.cache_dir, metadata['dtype'], self.dtype.name))
+            self.feature_shape = tuple(metadata['feature_shape'])
+
+            index_df = pd.read_csv(self.index_path, sep='\t')
+            self.index = dict(zip(index_df.key.values, index_df.row.values.astype(int)))
+            self.n_rows = os.path.getsize(self.features_path) // self.row_size
+
+    @property
+    def row_size(self):
+        return int(np.prod(self.feature_shape)) * self.dtype.itemsize
+
+    def add(self, keys, features):
+        """
+        Appends the features of a batch to the cache.
+        The cache is locked during the writing, so that processes training at the same time can share it.
+
+        :param keys: (list) keys of the elements of the batch.
+        :param features: (np.array) features of the batch of shape [batch_size, ...].
+        """
+        import fcntl
+        import json
+
+        features = np.ascontiguousarray(features, dtype=self.dtype)
+        with open(os.path.join(self.cache_dir, 'lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            if not os.path.exists(self.metadata_path):
+                with open(self.index_path, 'w') as f:
+                    f.write('key\trow\n')
+                with open(self.metadata_path, 'w') as f:
+                    json.dump({'feature_shape': list(features.shape[1:]), 'dtype': self.dtype.name}, f)
+            self.feature_shape = tuple(features.shape[1:])
+
+            # the features are written before the index, so that the index only refers to complete rows
+            with open(self.features_path, 'ab') as f:
+                first_row = f.tell() // self.row_size
+                f.write(features.tobytes())
+
+            with open(self.index_path, 'a') as f:
+                for i, key in enumerate(keys):
+                    self.index[key] = first_row + i
+                    f.write('%s\t%i\n' % (key, first_row + i))
+            self.n_rows = first_row + len(keys)
+
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def rows(self, keys):
+        """:return: (np.array) rows of the elements in the cache."""
+        return np.array([self.index[key] for key in keys], dtype=np.int64)
+
+
+def cache_features(frozen_forward, model, dataset, keys, metadata, feature_cache, batch_size=32, num_workers=0,
+                   gpu=False, collate_fn=None):
+    """
+    Computes the features of the elements of dataset which are not yet in the feature cache.
+    The model is in eval mode during the computation, so the frozen batch normalizations use their running
+    statistics, as during testing.
+
+    :param frozen_forward: (callable) function computing the outputs of the frozen layers of a batch of inputs.
+    :param model: (Module) model to which frozen_forward belongs.
+    :param dataset: (Dataset) dataset giving the inputs of the frozen layers.
+    :param keys: (list) key of each element of the dataset.
+    :param metadata: (dict) arrays of the values of each element given with the features (participant_id,
+                     session_id, label...).
+    :param feature_cache: (FeatureCache) the cache.
+    :param batch_size: (int) size of the batches in which the features are computed.
+    :param num_workers: (int) number of data loading workers.
+    :param gpu: (bool) if True a gpu is used.
+    :param collate_fn: (callable) collate function of the DataLoader of dataset.
+    :return: (CachedFeatureDataset) dataset reading the features of the elements in the cache.
+    """
+    from torch.utils.data import DataLoader, Subset
+
+    missing_rows = {}
+    for i, key in enumerate(keys):
+        if key not in feature_cache.index and key not in missing_rows:
+            missing_rows[key] = i
+    missing_indices = list(missing_rows.values())
+
+    if len(missing_indices) > 0:
+        print("Computing the features of %i elements with the frozen layers." % len(missing_indices))
+        loader = DataLoader(Subset(dataset, missing_indices),
+                            batch_size=batch_size,
+                            shuffle=False,
+                            num_workers=num_workers,
+                            collate_fn=collate_fn)
+        training = model.training
+        model.eval()
+        position = 0
+        with torch.no_grad():
+            for data in loader:
+                inputs = data['image'].cuda() if gpu else data['image']
+                features = frozen_forward(inputs).float().cpu().numpy()
+                batch_keys = [keys[i] for i in missing_indices[position:position + len(features)]]
+                feature_cache.add(batch_keys, features)
+                position += len(features)
+        model.train(training)
+
+    return CachedFeatureDataset(dataset, feature_cache, feature_cache.rows(keys), metadata)
+
+
+class CachedFeatureDataset(Dataset):
+    """
+    Gives the cached features of the elements of a dataset instead of their images.
+    The samples have the keys of metadata and an 'image' key containing the features.
+    """
+
+    def __init__(self, dataset, feature_cache, rows, metadata):
+        """
+        :param dataset: (Dataset) dataset whose elements are cached.
+        :param feature_cache: (FeatureCache) cache containing all the elements of the dataset.
+        :param rows: (np.array) row of each element of the dataset in the cache.
+        :param metadata: (dict) arrays of the values of each element given with the features.
+        """
+        self.df = dataset.df
+        if hasattr(dataset, 'session_offsets'):
+            self.session_offsets = dataset.session_offsets
+        self.image_cache = None
+        self.rows = rows
+        self.metadata = metadata
+        self.features_path = feature_cache.features_path
+        self.feature_shape = feature_cache.feature_shape
+        self.dtype = feature_cache.dtype
+        self.n_rows = feature_cache.n_rows
+        self._features = None
+
+    def __getstate__(self):
+        # the memory map is opened again in each worker
+        state = self.__dict__.copy()
+        state['_features'] = None
+        return state
+
+    @property
+    def features(self):
+        if self._features is None:
+            self._features = np.memmap(self.features_path, dtype=self.dtype, mode='r',
+                                       shape=(self.n_rows,) + tuple(self.feature_shape))
+        return self._features
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, idx):
+        sample = {key: values[idx].item() for key, values in self.metadata.items()}
+        sample['image'] = torch.from_numpy(np.array(self.features[self.rows[idx]], dtype=np.float32))
+
+        return sample
+
+
+def encoder_feature_cache(cache_dir, model, dtype='float16', input_tag=''):
+    """
+    Freezes the convolutional part (features) of a model, typically initialized with a pretrained autoencoder,
+    so that only its classifier is trained on the cached outputs of features.
+    The model is then fed with the samples of a CachedFeatureDataset instead of images.
+
+    :param cache_dir: (str) folder of the caches.
+    :param model: (Module) model with features and classifier modules and a features_cached attribute.
+    :param dtype: (str) dtype of the stored features ('float16' or 'float32').
+    :param input_tag: (str) description of the inputs of features (see FeatureCache).
+    :return: (FeatureCache) cache of the outputs of features.
+    """
+    freeze_encoder(model)
+
+    return FeatureCache(cache_dir, [model.features], dtype=dtype, input_tag=input_tag)
+
+
+def freeze_encoder(model):
+    """
+    Freezes the convolutional part (features) of a model, which is then fed with the cached outputs of features.
+    Used when the cache of the encoder was already built by encoder_feature_cache with the same weights.
+
+    :param model: (Module) model with features and classifier modules and a features_cached attribute.
+    """
+    if not hasattr(model, 'features_cached'):
+        raise ValueError("The model %s has no frozen encoder whose features can be cached."
+                         % model.__class__.__name__)
+
+    freeze([model.features])
+    model.features_cached = True
@@ -0,0 +1,242 @@
+import os
+import numpy as np
+import pandas as pd
+import torch
+
+
+class InferenceEngine(object):
+    """
+    Keeps the models of all the folds of a training in memory, so that sessions are classified by the ensemble of
+    the folds in a single pass on the data: each batch of sessions is loaded once and given to the models of all
+    the folds, whose probabilities are averaged.
+
+    Implemented for the subject-level CNNs and the patch-level single and multi-CNNs. The probability of a
+    session given by a patch-level fold is the mean of the probabilities of the patches used by the fold.
+    """
+
+    def __init__(self, network_dir, selection='best_loss', gpu=False, precision='fp32'):
+        """
+        :param network_dir: (str) output directory of the training.
+        :param selection: (str) models loaded in each fold ('best_loss' or 'best_acc').
+        :param gpu: (bool) if True a gpu is used.
+        :param precision: (str) precision of the forward passes ('fp32' or 'bf16').
+        """
+        import argparse
+        from glob import glob
+        from .iotools import read_json
+
+        # the options are the same in all the folds, except the split
+        json_paths = sorted(glob(os.path.join(network_dir, 'log_dir', 'commandline_*.json'))) + \
+            sorted(glob(os.path.join(network_dir, 'log_dir', 'fold_*', 'commandline_*.json')))
+        if len(json_paths) == 0:
+            raise ValueError("The options of the training were not found in %s."
+                             % os.path.join(network_dir, 'log_dir'))
+        self.options = read_json(argparse.Namespace(), None, json_path=json_paths[0])
+
+        if getattr(self.options, 'train_autoencoder', False):
+            raise ValueError("The training of %s is the training of an autoencoder, not a classifier." % network_dir)
+        if self.options.mode not in ['subject', 'patch']:
+            raise NotImplementedError("The classification is not implemented for the mode %s." % self.options.mode)
+        if self.options.mode == 'patch' and self.options.hippocampus_roi:
+            raise NotImplementedError("The classification is not implemented for the hippocampus ROI.")
+
+        self.network_dir = network_dir
+        self.selection = selection
+        self.gpu = gpu
+        self.precision = precision
+
+        fold_dirs = glob(os.path.join(network_dir, 'best_model_dir', 'fold_*'))
+        self.folds = sorted(int(fold_dir.split('_')[-1]) for fold_dir in fold_dirs)
+        if len(self.folds) == 0:
+            raise ValueError("No trained fold was found in %s." % os.path.join(network_dir, 'best_model_dir'))
+
+        print("Loading the models of the folds %s." % str(self.folds))
+        self.fold_models = {fold: self.load_fold(fold) for fold in self.folds}
+
+    @property
+    def mode(self):
+        return self.options.mode
+
+    def load_fold(self, fold):
+        """
+        Loads the models of a fold.
+
+        :param fold: (int) index of the fold.
+        :return: (list) tuples (patches, model): model classifies the patches of a session (None for all the
+                 patches, or for the whole image in subject mode).
+        """
+        from . import create_model, load_model
+
+        fold_dir = os.path.join(self.network_dir, 'best_model_dir', 'fold_%i' % fold)
+        model = create_model(self.options.network, self.gpu)
+
+        if self.mode == 'patch' and self.options.network_type == 'multi':
+            from clinicadl.patch_level.utils import selected_patches
+
+            # the CNNs of the patches excluded by the selection of the fold were not trained
+            patches = selected_patches(self.network_dir, fold)
+            if patches is None:
+                patches = range(self.options.num_cnn)
+            fold_models = []
+            for i in [i for i in patches if i < self.options.num_cnn]:
+                cnn_model, _ = load_model(model, os.path.join(fold_dir, 'cnn-%i' % i, self.selection), self.gpu,
+                                          filename='model_best.pth.tar')
+                fold_models.append(([int(i)], cnn_model.eval()))
+            return fold_models
+
+        best_model, _ = load_model(model, os.path.join(fold_dir, 'CNN', self.selection), self.gpu,
+                                   filename='model_best.pth.tar')
+        if self.mode == 'patch':
+            from clinicadl.patch_level.utils import selected_patches
+
+            return [(selected_patches(self.network_dir, fold), best_model.eval())]
+
+        return [(None, best_model.eval())]
+
+    def dataset(self, caps_dir, df):
+        """
+        :param caps_dir: (str) path to the CAPS directory.
+        :param df: (DataFrame) sessions to classify.
+        :return: (Dataset) dataset whose samples are the inputs of a session (whole image or all its patches).
+        """
+        from .data import MRIDataset, MinMaxNormalization, caps_image_shape, patch_grid
+
+        if self.mode == 'subject':
+            transformations = MinMaxNormalization() if self.options.minmaxnormalization else None
+            return MRIDataset(caps_dir, df, self.options.preprocessing, transform=transformations)
+
+        from clinicadl.patch_level.utils import MRIDataset_patch_multi
+
+        participant_id, session_id = str(df.participant_id.values[0]), str(df.session_id.values[0])
+        image_path = os.path.join(caps_dir, 'subjects', participant_id, session_id, 't1', 'preprocessing_dl',
+                                  participant_id + '_' + session_id + '_space-MNI_res-1x1x1.pt')
+        grid = patch_grid(caps_image_shape(caps_dir, image_path), self.options.patch_size, self.options.patch_stride)
+
+        return MRIDataset_patch_multi(caps_dir, df, self.options.patch_size, self.options.patch_stride,
+                                      grid.num_patches, transformations=MinMaxNormalization())
+
+    def predict(self, images):
+        """
+        :param images: (tensor) batch of sessions, of shape [batch_size, C, D, H, W] in subject mode
+                       and [batch_size, num_patches, patch_size, patch_size, patch_size] in patch mode.
+        :return: (tensor) probabilities of shape [batch_size, n_folds, n_classes].
+        """
+        fold_probas = []
+        for fold in self.folds:
+            probas = []
+            for patches, model in self.fold_models[fold]:
+                if self.mode == 'subject':
+                    probas.append(torch.softmax(model(images).float(), dim=1).unsqueeze(1))
+                else:
+                    patch_images = images if patches is None else images[:, torch.as_tensor(patches)]
+                    batch_size, n_patches = patch_images.shape[:2]
+                    outputs = model(patch_images.reshape((-1, 1) + tuple(patch_images.shape[2:]))).float()
+                    probas.append(torch.softmax(outputs, dim=1).view(batch_size, n_patches, -1))
+            fold_probas.append(torch.cat(probas, dim=1).mean(dim=1))
+
+        return torch.stack(fold_probas, dim=1)
+
+    def classify(self, caps_dir, df, batch_size=8, num_workers=0):
+        """
+        Classifies the sessions of df with the ensemble of the folds.
+
+        :param caps_dir: (str) path to the CAPS directory.
+        :param df: (DataFrame) sessions to classify.
+        :param batch_size: (int) number of sessions in a batch.
+        :param num_workers: (int) number of data loading workers.
+        :return: (DataFrame) true label (-1 if unknown), predicted label and probabilities of each session, with
+                 the probability of class 1 given by each fold.
+        """
+        from time import time
+        from torch.utils.data import DataLoader
+        from .precision import autocast, ThroughputMeter
+
+        loader = DataLoader(self.dataset(caps_dir, df),
+                            batch_size=batch_size,
+                            shuffle=False,
+                            num_workers=num_workers,
+                            pin_memory=True)
+
+        meter = ThroughputMeter()
+        columns = ['participant_id', 'session_id', 'true_label', 'predicted_label']
+        results = {column: [] for column in columns}
+        fold_probas = []
+
+        t_start = time()
+        with torch.no_grad():
+            for data in loader:
+                meter.start()
+                images = data['image'].cuda() if self.gpu else data['image']
+                with autocast(self.precision, self.gpu):
+                    probas = self.predict(images)
+                probas = probas.cpu().numpy()
+                meter.stop(len(probas))
+
+                results['participant_id'] += list(data['participant_id'])
+                results['session_id'] += list(data['session_id'])
+                results['true_label'] += data['label'].tolist()
+                results['predicted_label'] += list(probas.mean(axis=1).argmax(axis=1))
+                fold_probas.append(probas)
+        duration = time() - t_start
+
+        fold_probas = np.concatenate(fold_probas)
+        results_df = pd.DataFrame(results, columns=columns)
+        mean_probas = fold_probas.mean(axis=1)
+        for c in range(mean_probas.shape[1]):
+            results_df['proba%i' % c] = mean_probas[:, c]
+        for i, fold in enumerate(self.folds):
+            results_df['proba1_fold-%i' % fold] = fold_probas[:, i, 1]
+
+        print("Inference throughput: %f sessions/s (%f sessions/s without data loading)"
+              % (len(results_df) / duration, meter.samples_per_second))
+
+        return results_df
+
+
+def classify(caps_dir, tsv_path, output_dir, network_dir, mode=None, selection='best_loss', batch_size=8,
+             num_workers=0, gpu=False, precision='fp32'):
+    """
+    Classifies the sessions of a tsv file with the ensemble of the folds of a training, and writes the results
+    in output_dir/classification_result.tsv. If the diagnoses of all the sessions are known, the metrics of the
+    ensemble are written in output_dir/classification_metrics.tsv.
+
+    :param caps_dir: (str) path to the CAPS directory.
+    :param tsv_path: (str) path to a tsv file of sessions, or to a directory of tsv files of diagnoses (the
+                     baseline sessions of the diagnoses of the training are classified).
+    :param output_dir: (str) folder in which the results are written.
+    :param network_dir: (str) output directory of the training.
+    :param mode: (str) mode of the training. If given, it is checked against the options of the training.
+    :param selection: (str) models loaded in each fold ('best_loss' or 'best_acc').
+    :param batch_size: (int) number of sessions in a batch.
+    :param num_workers: (int) number of data loading workers.
+    :param gpu: (bool) if True a gpu is used.
+    :param precision: (str) precision of the forward passes ('fp32' or 'bf16').
+    :return: (DataFrame) results of the classification.
+    """
+    from .data import load_data_test
+    from .metrics import evaluate_prediction
+
+    engine = InferenceEngine(network_dir, selection=selection, gpu=gpu, precision=precision)
+    if mode is not None and mode != engine.mode:
+        raise ValueError("The models of %s were trained in mode %s, not %s." % (network_dir, engine.mode, mode))
+
+    if os.path.isdir(tsv_path):
+        df = load_data_test(tsv_path, engine.options.diagnoses)
+    else:
+        df = pd.read_csv(tsv_path, sep='\t')
+    if 'diagnosis' not in df.columns:
+        df['diagnosis'] = 'unlabeled'
+
+    results_df = engine.classify(caps_dir, df, batch_size=batch_size, num_workers=num_workers)
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    results_df.to_csv(os.path.join(output_dir, 'classification_result.tsv'), sep='\t', index=False)
+
+    if (results_df.true_label >= 0).all():
+        metrics = evaluate_prediction(results_df.true_label.values, results_df.predicted_label.values)
+        print("Balanced accuracy of the ensemble of %i folds: %f" % (len(engine.folds), metrics['balanced_accuracy']))
+        pd.DataFrame(metrics, index=[0]).to_csv(os.path.join(output_dir, 'classification_metrics.tsv'),
+                                                sep='\t', index=False)
+
+    return results_df
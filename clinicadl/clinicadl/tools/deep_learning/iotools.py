@@ -38,9 +38,11 @@ class Parameters:
             optimizer: str = "Adam",
             weight_decay: float = 1e-4,
             gpu: bool = False,
+            precision: str = "fp32",
             batch_size: int = 12,
             evaluation_steps: int = 1,
             num_workers: int = 1,
+            resource_plan: dict = None,
             transfer_learning_path: str = None,
             transfer_learning_autoencoder: str = None,
             transfer_learning_multicnn: bool = False,
@@ -50,8 +52,20 @@ class Parameters:
             hippocampus_roi: bool = False,
             selection_threshold: float = 0.0,
             num_cnn: int = 36,
+            num_parallel_cnn: int = 1,
+            threads_per_cnn: int = 0,
+            multihead: bool = False,
+            patch_occupancy_threshold: float = 0.0,
             mri_plane: int = 0,
+            foreground_threshold: float = 0.0,
+            feature_cache: str = None,
+            feature_cache_dtype: str = "float16",
             prepare_dl: bool = False,
+            packed_patches: bool = False,
+            image_cache_size: int = 0,
+            cohort_path: str = None,
+            train_probe_size: int = 0,
+            train_probe_frequency: int = 1,
             visualization: bool = False):
         """
         Optional parameters used for training CNN.
@@ -62,7 +76,7 @@ class Parameters:
         diagnoses: Take all the subjects possible for autoencoder training.
         baseline: Use only the baseline if True.
         minmaxnormalization: Performs MinMaxNormalization.
-        sampler: Sampler choice.
+        sampler: Sampler choice. Choices=["random", "grouped"].
         n_splits: If a value is given will load data of a k-fold CV
         split: User can specify a chosen split.
         accumulation_steps: Accumulates gradients in order to increase the size
@@ -76,9 +90,14 @@ class Parameters:
                    Choices=["SGD", "Adadelta", "Adam"].
         weight_decay: Weight decay of the optimizer.
         gpu: GPU usage if True.
+        precision: Precision of the forward passes during training. Choices:
+                   "fp32" or "bf16" (autocast, the weights stay in float32).
         batch_size: Batch size for training. (default=1)
         evaluation_steps: Fix the number of batches to use before validation
         num_workers:  Define the number of batch being loaded in parallel
+        resource_plan: Split of the cores between the data loading workers
+                       and the compute threads, given by plan_resources.
+                       If None the defaults of PyTorch are kept.
         selection: Allow to choose which model of the experiment is loaded .
                    choices ["best_loss", "best_acc"]
         patch_size: The patch size extracted from the MRI.
@@ -88,12 +107,41 @@ class Parameters:
                              the subject_level performance.
         num_cnn: How many CNNs we want to train in a patch-wise way.
                  By default, each patch is trained from all subjects for one CNN.
+        num_parallel_cnn: Number of CNNs of a multi-CNN trained at the same time
+                          in separate processes.
+        threads_per_cnn: Number of CPU threads used by each CNN trained in
+                         parallel (0 keeps the default of PyTorch).
+        multihead: If True the CNNs of a multi-CNN are trained together as
+                   the heads of one model, from one load of each session.
+        patch_occupancy_threshold: The patches whose mean fraction of
+                                   foreground voxels in the training set
+                                   is lower than this threshold are
+                                   excluded from training and voting.
         mri_plane: Which coordinate axis to take for slicing the MRI.
                    0 is for sagittal,
                    1 is for coronal and
                    2 is for axial direction
+        foreground_threshold: The slices whose fraction of foreground voxels
+                              is lower than this threshold are skipped.
+        feature_cache: Folder in which the outputs of the frozen layers are
+                       cached (first layers of resnet18 for slice-level,
+                       convolutional layers for subject and patch-level). If
+                       None the whole network is trained on each input.
+        feature_cache_dtype: Type of the cached features. Choices: "float16"
+                             or "float32".
         prepare_dl: If True the outputs of preprocessing are used, else the
                     whole MRI is loaded.
+        packed_patches: If True the extracted patches are read from the packed
+                        array of each session instead of one file per patch.
+        image_cache_size: Memory budget in MB of the cache of whole images of
+                          each data loading worker (0 disables the cache).
+        cohort_path: Path to a cohort array written by the pack command. If
+                     given, the whole MRI are read from this array.
+        train_probe_size: Number of training sessions on which the training
+                          metrics are evaluated. If 0 the metrics are computed
+                          during the training pass.
+        train_probe_frequency: The train probe is evaluated once every
+                               train_probe_frequency evaluations.
         transfer_learning_multicnn : If true use each model from the multicnn to
                                      initialize corresponding models.
         """
@@ -116,9 +164,11 @@ class Parameters:
         self.optimizer = optimizer
         self.weight_decay = weight_decay
         self.gpu = gpu
+        self.precision = precision
         self.batch_size = batch_size
         self.evaluation_steps = evaluation_steps
         self.num_workers = num_workers
+        self.resource_plan = resource_plan
         self.transfer_learning_path = transfer_learning_path
         self.transfer_learning_autoencoder = transfer_learning_autoencoder
         self.transfer_learning_multicnn = transfer_learning_multicnn
@@ -127,8 +177,20 @@ class Parameters:
         self.patch_stride = patch_stride
         self.hippocampus_roi = hippocampus_roi
         self.num_cnn = num_cnn
+        self.num_parallel_cnn = num_parallel_cnn
+        self.threads_per_cnn = threads_per_cnn
+        self.multihead = multihead
+        self.patch_occupancy_threshold = patch_occupancy_threshold
         self.mri_plane = mri_plane
+        self.foreground_threshold = foreground_threshold
+        self.feature_cache = feature_cache
+        self.feature_cache_dtype = feature_cache_dtype
         self.prepare_dl = prepare_dl
+        self.packed_patches = packed_patches
+        self.image_cache_size = image_cache_size
+        self.cohort_path = cohort_path
+        self.train_probe_size = train_probe_size
+        self.train_probe_frequency = train_probe_frequency
         self.visualization = visualization
         self.selection_threshold = selection_threshold
 
@@ -0,0 +1,138 @@
+import numpy as np
+
+
+def _to_numpy(labels):
+    """Converts a list, a numpy array or a tensor of labels to a numpy array of integers."""
+    if hasattr(labels, 'detach'):
+        labels = labels.detach().cpu().numpy()
+    return np.asarray(labels).astype(np.int64).ravel()
+
+
+def _safe_divide(numerator, denominator):
+    """Element-wise division in which a null denominator gives 0."""
+    numerator = np.asarray(numerator, dtype=np.float64)
+    denominator = np.asarray(denominator, dtype=np.float64)
+    return np.divide(numerator, denominator, out=np.zeros_like(numerator), where=denominator != 0)
+
+
+def confusion_matrix(y, y_hat, n_classes=2, groups=None):
+    """
+    Computes confusion matrices with one np.bincount.
+
+    :param y: (list / array / tensor) true labels in [0, n_classes).
+    :param y_hat: (list / array / tensor) predicted labels in [0, n_classes).
+    :param n_classes: (int) number of classes.
+    :param groups: (array) if given, group of each sample. One matrix is computed per group.
+    :return: (np.array) confusion matrix of shape [n_classes, n_classes] (true labels in rows, predicted labels
+             in columns), or [n_groups, n_classes, n_classes] if groups is given.
+    """
+    y = _to_numpy(y)
+    y_hat = _to_numpy(y_hat)
+    if len(y) != len(y_hat):
+        raise ValueError("There are %i true labels but %i predicted labels." % (len(y), len(y_hat)))
+    for name, labels in [('true', y), ('predicted', y_hat)]:
+        invalid_labels = labels[(labels < 0) | (labels >= n_classes)]
+        if len(invalid_labels) > 0:
+            raise ValueError("The %s labels must be in [0, %i), the labels %s are not (unlabeled sessions cannot "
+                             "be evaluated)." % (name, n_classes, sorted(set(invalid_labels.tolist()))))
+    flat_index = y * n_classes + y_hat
+
+    if groups is None:
+        return np.bincount(flat_index, minlength=n_classes ** 2).reshape(n_classes, n_classes)
+
+    _, group_index = np.unique(np.asarray(groups), return_inverse=True)
+    n_groups = group_index.max() + 1 if len(group_index) > 0 else 0
+    flat_index = group_index * n_classes ** 2 + flat_index
+    return np.bincount(flat_index, minlength=n_groups * n_classes ** 2).reshape(n_groups, n_classes, n_classes)
+
+
+def metrics_from_confusion_matrix(matrix):
+    """
+    Computes the metrics of one confusion matrix.
+
+    In the binary case the class 1 is the positive class. In the multi-class case sensitivity, specificity,
+    ppv and npv are the means of the one-vs-rest values of each class.
+
+    :param matrix: (np.array) confusion matrix of shape [n_classes, n_classes].
+    :return: (dict) ensemble of metrics
+    """
+    matrix = np.asarray(matrix)
+    n_classes = matrix.shape[0]
+    total = matrix.sum()
+
+    # one-vs-rest counts of each class
+    tp = np.diag(matrix)
+    fn = matrix.sum(axis=1) - tp
+    fp = matrix.sum(axis=0) - tp
+    tn = total - tp - fn - fp
+
+    sensitivities = _safe_divide(tp, tp + fn)
+    specificities = _safe_divide(tn, tn + fp)
+    ppvs = _safe_divide(tp, tp + fp)
+    npvs = _safe_divide(tn, tn + fn)
+
+    if n_classes == 2:
+        sensitivity, specificity, ppv, npv = sensitivities[1], specificities[1], ppvs[1], npvs[1]
+        balanced_accuracy = (sensitivity + specificity) / 2
+        confusion = {'tp': int(tp[1]), 'tn': int(tn[1]), 'fp': int(fp[1]), 'fn': int(fn[1])}
+    else:
+        sensitivity, specificity, ppv, npv = sensitivities.mean(), specificities.mean(), ppvs.mean(), npvs.mean()
+        balanced_accuracy = sensitivity
+        confusion = matrix.tolist()
+
+    results = {'accuracy': float(_safe_divide(tp.sum(), total)),
+               'balanced_accuracy': float(balanced_accuracy),
+               'sensitivity': float(sensitivity),
+               'specificity': float(specificity),
+               'ppv': float(ppv),
+               'npv': float(npv),
+               'confusion_matrix': confusion
+               }
+
+    return results
+
+
+def evaluate_prediction(y, y_hat, n_classes=2, groups=None):
+    """
+    This is a function to calculate the different metrics based on the list of true label and predicted label
+
+    :param y: (list / array / tensor) true labels
+    :param y_hat: (list / array / tensor) predicted labels
+    :param n_classes: (int) number of classes.
+    :param groups: (array) if given, the metrics are computed for each group of samples (participant, patch...).
+    :return: (dict) ensemble of metrics, or a dict of ensembles of metrics indexed by group if groups is given.
+    """
+    matrix = confusion_matrix(y, y_hat, n_classes=n_classes, groups=groups)
+
+    if groups is None:
+        return metrics_from_confusion_matrix(matrix)
+
+    group_names = np.unique(np.asarray(groups))
+    return {group: metrics_from_confusion_matrix(matrix[i]) for i, group in enumerate(group_names)}
+
+
+class RunningMetrics(object):
+    """Accumulates the confusion matrix and the loss of the batches seen during the training loop."""
+
+    def __init__(self, n_classes=2):
+        self.n_classes = n_classes
+        self.reset()
+
+    def reset(self):
+        self.matrix = np.zeros((self.n_classes, self.n_classes), dtype=np.int64)
+        self.total_loss = 0.0
+        self.n_batches = 0
+
+    def update(self, y, y_hat, loss):
+        """
+        :param y: (tensor) true labels of the batch.
+        :param y_hat: (tensor) predicted labels of the batch.
+        :param loss: (float) loss of the batch.
+        """
+        self.matrix += confusion_matrix(y, y_hat, n_classes=self.n_classes)
+        self.total_loss += loss
+        self.n_batches += 1
+
+    def evaluate(self):
+        """:return: (dict) ensemble of metrics of the batches seen since the last reset."""
+        return metrics_from_confusion_matrix(self.matrix)
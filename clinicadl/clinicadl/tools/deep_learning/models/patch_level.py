@@ -2,7 +2,7 @@
 Script containing the models for the patch level experiments.
 """
 from torch import nn
-from .modules import PadMaxPool3d, Flatten
+from .modules import PadMaxPool3d, Flatten, Reshape
 
 __author__ = "Junhao Wen"
 __copyright__ = "Copyright 2018 The Aramis Lab Team"
@@ -67,8 +67,150 @@ class Conv4_FC3(nn.Module):
 
         self.flattened_shape = [-1, 50, 2, 2, 2]
 
+        # if True the inputs of forward are the outputs of features, read from a feature cache
+        self.features_cached = False
+
     def forward(self, x):
-        x = self.features(x)
+        if not self.features_cached:
+            x = self.features(x)
         x = self.classifier(x)
 
         return x
+
+
+class MultiConv4_FC3(nn.Module):
+    """
+    Stack of n_heads Conv4_FC3 trained in one pass: the head i classifies the patch i of a session.
+
+    The input is of shape [batch_size, n_heads, patch_size, patch_size, patch_size] and the output of shape
+    [batch_size, n_heads, n_classes]. The weights of the heads are stacked along the channels of grouped
+    convolutions, so that the parameters of the head i are the slices of size 1 / n_heads of every parameter.
+    The names of the parameters are the ones of Conv4_FC3, so that each head can be exported to a Conv4_FC3.
+    """
+
+    def __init__(self, n_heads=36, dropout=0, n_classes=2):
+        super(MultiConv4_FC3, self).__init__()
+
+        self.n_heads = n_heads
+        self.n_classes = n_classes
+
+        self.features = nn.Sequential(
+            # Convolutions
+            nn.Conv3d(n_heads, 15 * n_heads, 3, groups=n_heads),
+            nn.BatchNorm3d(15 * n_heads),
+            nn.ReLU(),
+            PadMaxPool3d(2, 2),
+
+            nn.Conv3d(15 * n_heads, 25 * n_heads, 3, groups=n_heads),
+            nn.BatchNorm3d(25 * n_heads),
+            nn.ReLU(),
+            PadMaxPool3d(2, 2),
+
+            nn.Conv3d(25 * n_heads, 50 * n_heads, 3, groups=n_heads),
+            nn.BatchNorm3d(50 * n_heads),
+            nn.ReLU(),
+            PadMaxPool3d(2, 2),
+
+            nn.Conv3d(50 * n_heads, 50 * n_heads, 3, groups=n_heads),
+            nn.BatchNorm3d(50 * n_heads),
+            nn.ReLU(),
+            PadMaxPool3d(2, 2)
+
+        )
+        self.classifier = nn.Sequential(
+            # Fully connected layers of each head as grouped 1x1 convolutions
+            Reshape([-1, 50 * 2 * 2 * 2 * n_heads, 1]),
+
+            nn.Dropout(p=dropout),
+            nn.Conv1d(50 * 2 * 2 * 2 * n_heads, 50 * n_heads, 1, groups=n_heads),
+            nn.ReLU(),
+
+            nn.Dropout(p=dropout),
+            nn.Conv1d(50 * n_heads, 40 * n_heads, 1, groups=n_heads),
+            nn.ReLU(),
+
+            nn.Conv1d(40 * n_heads, n_classes * n_heads, 1, groups=n_heads)
+        )
+
+    def forward(self, x):
+        x = self.features(x)
+        x = self.classifier(x)
+
+        return x.view(-1, self.n_heads, self.n_classes)
+
+    def export_head(self, head_index):
+        """
+        Returns the state_dict of a Conv4_FC3 equivalent to one head.
+
+        :param head_index: (int) index of the head.
+        :return: (dict) state_dict loadable by Conv4_FC3.
+        """
+        head_state = dict()
+        for key, value in self.state_dict().items():
+            if key.endswith('num_batches_tracked'):
+                head_state[key] = value.clone()
+            else:
+                head_state[key] = self._head_value(key, value, head_index)
+
+        return head_state
+
+    def export_head_optimizer(self, optimizer, head_index):
+        """
+        Returns the state_dict of the optimizer of a Conv4_FC3 equivalent to one head. The optimizers of
+        torch update each parameter element-wise, so the state of a head is the slice of the state of
+        each parameter corresponding to the head.
+
+        :param optimizer: (torch.optim) optimizer of all the parameters of the model.
+        :param head_index: (int) index of the head.
+        :return: (dict) state_dict loadable by an optimizer of the parameters of Conv4_FC3.
+        """
+        import copy
+
+        optimizer_state = optimizer.state_dict()
+        # the states are indexed by the position of the parameters in the parameter groups
+        names = [name for name, parameter in self.named_parameters() if parameter.requires_grad]
+        if len(names) != sum(len(group['params']) for group in optimizer_state['param_groups']):
+            raise ValueError("The optimizer must optimize all the trainable parameters of the model.")
+
+        head_state = dict()
+        for index, parameter_state in optimizer_state['state'].items():
+            head_state[index] = dict()
+            for key, value in parameter_state.items():
+                if hasattr(value, 'dim') and value.dim() > 0:
+                    value = self._head_value(names[index], value, head_index)
+                head_state[index][key] = copy.deepcopy(value)
+
+        return {'state': head_state, 'param_groups': copy.deepcopy(optimizer_state['param_groups'])}
+
+    def _head_value(self, key, value, head_index):
+        """Returns the slice of a parameter (or of a tensor of the same shape) belonging to a head."""
+        head_size = value.size(0) // self.n_heads
+        head_value = value[head_index * head_size:(head_index + 1) * head_size].clone()
+        if key.startswith('classifier') and key.endswith('weight'):
+            # Conv1d weight [out, in, 1] -> Linear weight [out, in]
+            head_value = head_value.squeeze(-1)
+
+        return head_value
+
+    def load_heads(self, head_states):
+        """
+        Loads the state_dict of a Conv4_FC3 in each head.
+
+        :param head_states: (list) n_heads state_dicts of Conv4_FC3.
+        """
+        import torch
+
+        if len(head_states) != self.n_heads:
+            raise ValueError("%i states were given for %i heads." % (len(head_states), self.n_heads))
+
+        state = dict()
+        for key, value in self.state_dict().items():
+            if key.endswith('num_batches_tracked'):
+                state[key] = head_states[0][key].clone()
+                continue
+            head_values = [head_state[key].to(value.device) for head_state in head_states]
+            if key.startswith('classifier') and key.endswith('weight'):
+                head_values = [head_value.unsqueeze(-1) for head_value in head_values]
+            state[key] = torch.cat(head_values, dim=0)
+
+        self.load_state_dict(state)
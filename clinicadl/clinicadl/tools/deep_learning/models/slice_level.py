@@ -67,6 +67,9 @@ class ResNetDesigner(nn.Module):
         self.avgpool = nn.AvgPool2d(7, stride=1)
         self.fc = nn.Linear(512 * block.expansion, num_classes)
 
+        # if True the inputs of forward are the outputs of trunk, read from a feature cache
+        self.trunk_cached = False
+
         for m in self.modules():
             if isinstance(m, nn.Conv2d):
                 n = m.kernel_size[0] * m.kernel_size[1] * m.out_channels
@@ -92,7 +95,8 @@ class ResNetDesigner(nn.Module):
 
         return nn.Sequential(*layers)
 
-    def forward(self, x):
+    def trunk(self, x):
+        """Layers frozen by resnet18 (conv1 to layer3)."""
         x = self.conv1(x)
         x = self.bn1(x)
         x = self.relu(x)
@@ -101,6 +105,17 @@ class ResNetDesigner(nn.Module):
         x = self.layer1(x)
         x = self.layer2(x)
         x = self.layer3(x)
+
+        return x
+
+    def trunk_modules(self):
+        """:return: (list) the modules of the trunk."""
+        return [self.conv1, self.bn1, self.layer1, self.layer2, self.layer3]
+
+    def forward(self, x):
+        if not self.trunk_cached:
+            x = self.trunk(x)
+
         x = self.layer4(x)
 
         x = self.avgpool(x)
@@ -59,8 +59,12 @@ class Conv5_FC3(nn.Module):
 
         self.flattened_shape = [-1, 128, 6, 7, 6]
 
+        # if True the inputs of forward are the outputs of features, read from a feature cache
+        self.features_cached = False
+
     def forward(self, x):
-        x = self.features(x)
+        if not self.features_cached:
+            x = self.features(x)
         x = self.classifier(x)
 
         return x
@@ -119,8 +123,12 @@ class Conv5_FC3_mni(nn.Module):
 
         self.flattened_shape = [-1, 128, 4, 5, 4]
 
+        # if True the inputs of forward are the outputs of features, read from a feature cache
+        self.features_cached = False
+
     def forward(self, x):
-        x = self.features(x)
+        if not self.features_cached:
+            x = self.features(x)
         x = self.classifier(x)
 
         return x
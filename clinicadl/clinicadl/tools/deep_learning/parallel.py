@@ -0,0 +1,48 @@
+def _run_with_threads(target, args, n_threads):
+    """Entry point of the processes launched by run_processes."""
+    import torch
+
+    if n_threads is not None and n_threads > 0:
+        torch.set_num_threads(n_threads)
+    target(*args)
+
+
+def run_processes(target, args_list, n_processes, n_threads=None):
+    """
+    Runs target(*args) for each args of args_list, with at most n_processes processes at the same time.
+    The processes are started with the 'spawn' method and are not daemonic, so that each of them can use
+    DataLoader workers.
+
+    :param target: (callable) function to run. Must be defined at the top level of a module.
+    :param args_list: (list) list of tuples of arguments given to target.
+    :param n_processes: (int) maximum number of processes running at the same time.
+    :param n_threads: (int) number of threads used by torch in each process. If None the default of torch is used.
+    :return: (list) the arguments of the runs which failed.
+    """
+    import multiprocessing
+    from multiprocessing.connection import wait
+
+    if n_processes < 1:
+        raise ValueError("The number of processes must be at least 1, not %i." % n_processes)
+
+    context = multiprocessing.get_context('spawn')
+    pending = list(args_list)
+    running = {}
+    failed = []
+
+    while len(pending) > 0 or len(running) > 0:
+        while len(pending) > 0 and len(running) < n_processes:
+            args = pending.pop(0)
+            process = context.Process(target=_run_with_threads, args=(target, args, n_threads))
+            process.start()
+            running[process.sentinel] = (process, args)
+
+        for sentinel in wait(list(running.keys())):
+            process, args = running.pop(sentinel)
+            process.join()
+            if process.exitcode != 0:
+                print("The process running %s with arguments %s failed with exit code %i."
+                      % (target.__name__, str(args), process.exitcode))
+                failed.append(args)
+
+    return failed
@@ -0,0 +1,74 @@
+from time import time
+
+PRECISIONS = ['fp32', 'bf16']
+
+
+def autocast(precision, use_cuda=False):
+    """
+    Context manager in which the forward pass and the loss are computed in the given precision.
+    The operations of the backward pass run in the precision of the corresponding forward operations.
+    The parameters of the model and their gradients stay in float32, so the checkpoints and the optimizer
+    states are the same whatever the precision and can be read with load_model.
+
+    :param precision: (str) 'fp32' to compute in float32, 'bf16' to let autocast run the matrix
+                      multiplications and convolutions in bfloat16.
+    :param use_cuda: (bool) if True the model is on a gpu, else on the cpu.
+    :return: context manager
+    """
+    import contextlib
+    import torch
+
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+    elif precision == 'bf16':
+        if not hasattr(torch, 'autocast'):
+            raise ValueError("The precision bf16 needs a version of PyTorch providing torch.autocast (>= 1.10).")
+        device_type = 'cuda' if use_cuda else 'cpu'
+        return torch.autocast(device_type=device_type, dtype=torch.bfloat16)
+    else:
+        raise ValueError("The precision %s must be in %s." % (precision, PRECISIONS))
+
+
+class ThroughputMeter(object):
+    """
+    Measures the number of samples per second processed by the training steps.
+    The time spent loading the data or evaluating the model is not counted.
+    """
+
+    def __init__(self):
+        self.t_start = None
+        self.reset()
+
+    def reset(self):
+        self.n_samples = 0
+        self.duration = 0.0
+
+    def start(self):
+        """Called before the forward pass of a batch."""
+        self.t_start = time()
+
+    def stop(self, n_samples):
+        """
+        Called at the end of the training step of a batch.
+
+        :param n_samples: (int) number of samples of the batch.
+        """
+        self.duration += time() - self.t_start
+        self.n_samples += n_samples
+
+    @property
+    def samples_per_second(self):
+        return self.n_samples / self.duration if self.duration > 0 else 0.0
+
+    def log(self, writer, step):
+        """
+        Prints and writes the throughput since the last reset, then resets the meter.
+
+        :param writer: (SummaryWriter) writer in which the throughput is written.
+        :param step: (int) step of the scalar in the writer.
+        """
+        throughput = self.samples_per_second
+        print("Training throughput: %f samples/s" % throughput)
+        if writer is not None:
+            writer.add_scalar('throughput', throughput, step)
+        self.reset()
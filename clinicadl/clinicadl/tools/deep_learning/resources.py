@@ -0,0 +1,92 @@
+import os
+from functools import partial
+
+
+def available_cores():
+    """:return: (list) indices of the cores on which the current process is allowed to run."""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def plan_resources(num_workers, num_threads=0, num_interop_threads=0, pin_workers=False, n_processes=1):
+    """
+    Splits the available cores between the data loading workers and the compute threads of PyTorch,
+    so that they do not compete for the same cores.
+
+    :param num_workers: (int) number of data loading workers of each training process.
+    :param num_threads: (int) number of intra-op threads of each training process. If 0 the cores which
+                        are not used by the workers are shared between the training processes.
+    :param num_interop_threads: (int) number of inter-op threads of PyTorch (0 keeps the default of PyTorch).
+    :param pin_workers: (bool) if True the workers are pinned to their own cores and the training
+                        processes to the remaining cores.
+    :param n_processes: (int) number of training processes running at the same time.
+    :return: (dict) the resource plan.
+    """
+    cores = available_cores()
+    n_cores = len(cores)
+
+    # at least one core per training process is kept for computation
+    n_worker_cores = min(num_workers * n_processes, max(n_cores - n_processes, 0))
+    if num_threads <= 0:
+        num_threads = max(1, (n_cores - n_worker_cores) // n_processes)
+
+    if (num_workers + num_threads) * n_processes > n_cores:
+        print("Warning: %i data loading workers and %i compute threads in each of the %i training processes "
+              "oversubscribe the %i available cores." % (num_workers, num_threads, n_processes, n_cores))
+
+    if pin_workers:
+        compute_cores = cores[:n_cores - n_worker_cores]
+        worker_cores = cores[n_cores - n_worker_cores:]
+    else:
+        compute_cores = []
+        worker_cores = []
+
+    return {'n_cores': n_cores,
+            'n_processes': n_processes,
+            'num_workers': num_workers,
+            'num_threads': num_threads,
+            'num_interop_threads': num_interop_threads,
+            'pin_workers': pin_workers,
+            'compute_cores': compute_cores,
+            'worker_cores': worker_cores}
+
+
+def apply_resource_plan(plan):
+    """
+    Sets the number of threads of PyTorch and the cores of the current process according to the plan.
+    Must be called before the creation of the DataLoaders, which copy the affinity of the process.
+
+    :param plan: (dict) resource plan given by plan_resources. If None nothing is changed.
+    """
+    import torch
+
+    if plan is None:
+        return
+
+    torch.set_num_threads(plan['num_threads'])
+    if plan['num_interop_threads'] > 0:
+        try:
+            torch.set_num_interop_threads(plan['num_interop_threads'])
+        except RuntimeError:
+            # the inter-op thread pool can only be sized once, before any parallel work
+            print("Warning: the number of inter-op threads was already set and cannot be changed.")
+
+    if len(plan['compute_cores']) > 0 and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, plan['compute_cores'])
+
+
+def _pin_worker(worker_cores, worker_id):
+    """Entry point of the DataLoader workers pinning each worker to one of the worker cores."""
+    os.sched_setaffinity(0, {worker_cores[worker_id % len(worker_cores)]})
+
+
+def worker_init_function(plan):
+    """
+    :param plan: (dict) resource plan given by plan_resources, or None.
+    :return: (callable) worker_init_fn of the DataLoaders, or None if the workers are not pinned.
+    """
+    if plan is None or len(plan['worker_cores']) == 0 or not hasattr(os, 'sched_setaffinity'):
+        return None
+
+    return partial(_pin_worker, tuple(plan['worker_cores']))
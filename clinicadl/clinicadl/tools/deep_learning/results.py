@@ -0,0 +1,143 @@
+import numpy as np
+import pandas as pd
+
+
+class ResultsAccumulator(object):
+    """
+    Collects the results of a model batch by batch in preallocated arrays
+    and builds the DataFrame of the results once at the end.
+    """
+
+    def __init__(self, n_samples, id_column=None, n_probabilities=0):
+        """
+        :param n_samples: (int) expected number of samples (usually the length of the dataset).
+        :param id_column: (str) name of the column identifying a sample in a session ('patch_id', 'slice_id'...).
+                          If None, a sample is a whole session.
+        :param n_probabilities: (int) number of probability columns (proba0, proba1...) to store.
+        """
+        self.id_column = id_column
+        self.n_probabilities = n_probabilities
+        self.n_samples = 0
+
+        self.participant_id = np.empty(n_samples, dtype=object)
+        self.session_id = np.empty(n_samples, dtype=object)
+        self.sample_id = np.empty(n_samples, dtype=np.int64)
+        self.true_label = np.empty(n_samples, dtype=np.int64)
+        self.predicted_label = np.empty(n_samples, dtype=np.int64)
+        self.probabilities = np.empty((n_samples, n_probabilities), dtype=np.float64)
+
+    def _reserve(self, n_samples):
+        """Doubles the size of the arrays until n_samples can be stored."""
+        capacity = len(self.true_label)
+        if n_samples <= capacity:
+            return
+
+        new_capacity = max(n_samples, 2 * capacity)
+        for attribute in ['participant_id', 'session_id', 'sample_id', 'true_label', 'predicted_label',
+                          'probabilities']:
+            old_array = getattr(self, attribute)
+            new_array = np.empty((new_capacity,) + old_array.shape[1:], dtype=old_array.dtype)
+            new_array[:capacity] = old_array
+            setattr(self, attribute, new_array)
+
+    def add_batch(self, data, labels, predicted, probabilities=None):
+        """
+        Stores the results of one batch.
+
+        :param data: (dict) batch given by the DataLoader.
+        :param labels: (tensor) true labels of the batch.
+        :param predicted: (tensor) predicted labels of the batch.
+        :param probabilities: (tensor) output probabilities of the batch of shape [batch_size, n_probabilities].
+        """
+        batch_size = len(labels)
+        self._reserve(self.n_samples + batch_size)
+        batch_slice = slice(self.n_samples, self.n_samples + batch_size)
+
+        self.participant_id[batch_slice] = data['participant_id']
+        self.session_id[batch_slice] = data['session_id']
+        if self.id_column is not None:
+            self.sample_id[batch_slice] = np.asarray(data[self.id_column])
+        self.true_label[batch_slice] = labels.detach().cpu().numpy()
+        self.predicted_label[batch_slice] = predicted.detach().cpu().numpy()
+        if self.n_probabilities > 0:
+            self.probabilities[batch_slice] = probabilities.detach().cpu().numpy()[:, :self.n_probabilities]
+
+        self.n_samples += batch_size
+
+    def to_dataframe(self):
+        """
+        :return: (DataFrame) the results with columns participant_id, session_id, [id_column], true_label,
+                 predicted_label, [proba0, proba1...].
+        """
+        n = self.n_samples
+        results = {'participant_id': self.participant_id[:n], 'session_id': self.session_id[:n]}
+        columns = ['participant_id', 'session_id']
+        if self.id_column is not None:
+            results[self.id_column] = self.sample_id[:n]
+            columns.append(self.id_column)
+        results['true_label'] = self.true_label[:n]
+        results['predicted_label'] = self.predicted_label[:n]
+        columns += ['true_label', 'predicted_label']
+        for i in range(self.n_probabilities):
+            results['proba%i' % i] = self.probabilities[:n, i]
+            columns.append('proba%i' % i)
+
+        return pd.DataFrame(results, columns=columns)
+
+
+def vote(performance_df, validation_df, id_column, method='soft', selection_threshold=None):
+    """
+    Combines the results of the samples of each session (patches, slices...) in one prediction per session.
+    Each sample is weighted by its accuracy on validation_df.
+
+    ref: S. Raschka. Python Machine Learning., 2015
+    :param performance_df: (DataFrame) results of the samples of the set on which the combination is made.
+    :param validation_df: (DataFrame) results of the samples of the set used to compute the weights.
+    :param id_column: (str) name of the column identifying a sample in a session ('patch_id', 'slice_id'...).
+    :param method: (str) 'soft' to sum the weighted probabilities or 'hard' to sum the weighted predicted labels.
+    :param selection_threshold: (float) if given, the weight of all samples for which the accuracy is below the
+                                threshold is set to 0.
+    :return: (DataFrame) the results on the session level, sorted by participant_id and session_id.
+    """
+    if method not in ['soft', 'hard']:
+        raise ValueError("The voting method %s must be in ['soft', 'hard']." % method)
+
+    # Compute the sample accuracies on the validation set
+    right_classified = validation_df['true_label'].values == validation_df['predicted_label'].values
+    n_valid = len(validation_df.drop_duplicates(['participant_id', 'session_id']))
+    accuracies = validation_df.loc[right_classified, id_column].value_counts() / n_valid
+    if selection_threshold is not None:
+        accuracies[accuracies < selection_threshold] = 0
+    weight_series = accuracies / accuracies.sum()
+
+    # Samples which were never well classified have a null weight
+    weights = performance_df[id_column].map(weight_series).fillna(0).values
+
+    proba_columns = sorted([column for column in performance_df.columns if column.startswith('proba')],
+                           key=lambda column: int(column[len('proba'):]))
+    n_classes = max(len(proba_columns), 2)
+    if method == 'soft':
+        scores = performance_df[proba_columns].values.astype(float) * weights[:, np.newaxis]
+    else:
+        predicted_labels = performance_df['predicted_label'].values.astype(int)
+        invalid_labels = predicted_labels[(predicted_labels < 0) | (predicted_labels >= n_classes)]
+        if len(invalid_labels) > 0:
+            raise ValueError("The predicted labels must be in [0, %i), the labels %s are not."
+                             % (n_classes, sorted(set(invalid_labels.tolist()))))
+        scores = np.zeros((len(performance_df), n_classes))
+        scores[np.arange(len(performance_df)), predicted_labels] = weights
+
+    scores_df = pd.DataFrame(scores, index=pd.MultiIndex.from_arrays(
+        [performance_df['participant_id'].values, performance_df['session_id'].values],
+        names=['participant_id', 'session_id']))
+    session_scores = scores_df.groupby(level=['participant_id', 'session_id'], sort=True).sum()
+    true_labels = performance_df.groupby(['participant_id', 'session_id'], sort=True)['true_label'].first()
+
+    # argmax keeps the first class in case of equality
+    df_final = pd.DataFrame({'participant_id': session_scores.index.get_level_values('participant_id'),
+                             'session_id': session_scores.index.get_level_values('session_id'),
+                             'true_label': true_labels.loc[session_scores.index].values.astype(int),
+                             'predicted_label': session_scores.values.argmax(axis=1)},
+                            columns=['participant_id', 'session_id', 'true_label', 'predicted_label'])
+
+    return df_final
@@ -5,6 +5,7 @@ from clinicadl.tools.deep_learning.iotools import Parameters
 
 @pytest.fixture(params=['preprocessing',
     'extract',
+    'pack',
     'generate',
     'train_subject',
     'train_slice',
@@ -47,6 +48,22 @@ def generate_cli_commands(request):
               'slice_direction',
               'slice_mode']
 
+  if request.param == 'pack':
+      test_input = [
+              'pack',
+              '/dir/caps',
+              '/dir/tsv.file',
+              '/dir/cohort.npy',
+              '--preprocessing', 'linear',
+              '--dtype', 'float16']
+      keys_output = [
+              'task',
+              'caps_dir',
+              'tsv_file',
+              'output_path',
+              'preprocessing',
+              'dtype']
+
   if request.param == 'generate':
       test_input = [
               'generate',
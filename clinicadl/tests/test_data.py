@@ -0,0 +1,136 @@
+import os
+import pickle
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+from clinicadl.tools.deep_learning.data import STORAGE_DTYPES, encode_image, decode_image, save_image, load_image
+from clinicadl.tools.deep_learning.data import MRIDataset, MinMaxNormalization, pack_cohort
+
+
+def random_image(seed, shape=(1, 12, 14, 10)):
+    """Builds a float image whose intensities are uniform in [-3, 5]."""
+    torch.manual_seed(seed)
+    return 8 * torch.rand(shape) - 3
+
+
+def max_error(dtype, image):
+    """Maximal error of the round trip of image through a storage dtype."""
+    if dtype == 'float32':
+        return 0.0
+    if dtype == 'float16':
+        # 11 bits of mantissa
+        return float(image.abs().max()) * 2 ** -11
+    # half a quantization step, plus the rounding of the float32 operations of the decoding
+    step = (float(image.max()) - float(image.min())) / np.iinfo(dtype).max
+    return step / 2 + 1e-5
+
+
+@pytest.mark.parametrize('dtype', STORAGE_DTYPES)
+@pytest.mark.parametrize('compress', [False, True])
+def test_round_trip(dtype, compress):
+    image = random_image(0)
+
+    decoded_image = decode_image(encode_image(image, dtype, compress))
+    assert decoded_image.dtype == torch.float32
+    assert decoded_image.shape == image.shape
+    assert float((decoded_image - image).abs().max()) <= max_error(dtype, image)
+
+
+@pytest.mark.parametrize('dtype', STORAGE_DTYPES)
+def test_compression_is_lossless(dtype):
+    image = random_image(1)
+
+    decoded_image = decode_image(encode_image(image, dtype, compress=False))
+    decoded_compressed_image = decode_image(encode_image(image, dtype, compress=True))
+    assert torch.equal(decoded_image, decoded_compressed_image)
+
+
+@pytest.mark.parametrize('dtype', ['uint16', 'uint8'])
+def test_quantized_extrema_are_exact(dtype):
+    image = random_image(2)
+
+    decoded_image = decode_image(encode_image(image, dtype))
+    assert float(decoded_image.min()) == float(image.min())
+    assert float(decoded_image.max()) == pytest.approx(float(image.max()), rel=1e-6)
+
+
+@pytest.mark.parametrize('dtype', STORAGE_DTYPES)
+@pytest.mark.parametrize('compress', [False, True])
+def test_constant_image(dtype, compress):
+    # the minimum and the maximum are equal, so the quantization step is null
+    image = torch.full((1, 6, 5, 4), 2.5)
+
+    decoded_image = decode_image(encode_image(image, dtype, compress))
+    assert torch.equal(decoded_image, image)
+
+
+def test_uint16_is_stored_as_int16():
+    # torch < 2.3 cannot build uint16 tensors
+    image = random_image(5)
+
+    stored = encode_image(image, 'uint16')
+    assert stored['data'].dtype == torch.int16
+    # the values above 32767 are stored as negative int16
+    assert int(stored['data'].min()) < 0
+    assert float((decode_image(stored) - image).abs().max()) <= max_error('uint16', image)
+
+
+def test_quantized_nan_are_zero():
+    image = random_image(3)
+    tolerance = max_error('uint16', image)
+    image[0, 0, 0, 0] = float('nan')
+
+    decoded_image = decode_image(encode_image(image, 'uint16'))
+    assert not torch.isnan(decoded_image).any()
+    assert float(decoded_image[0, 0, 0, 0]) == pytest.approx(0, abs=tolerance)
+
+
+@pytest.mark.parametrize('dtype', STORAGE_DTYPES)
+@pytest.mark.parametrize('compress', [False, True])
+def test_save_load(tmp_path, dtype, compress):
+    image = random_image(4)
+    image_path = str(tmp_path / 'image.pt')
+
+    save_image(image, image_path, dtype, compress)
+    assert torch.equal(load_image(image_path), decode_image(encode_image(image, dtype, compress)))
+
+
+def test_unknown_dtype():
+    with pytest.raises(ValueError):
+        encode_image(random_image(0), 'int8')
+
+
+def write_caps(caps_dir, n_sessions):
+    """Writes random images as the preprocessing_dl outputs of n_sessions sessions of a CAPS directory."""
+    participant_ids = ['sub-%02i' % i for i in range(n_sessions)]
+    for i, participant_id in enumerate(participant_ids):
+        image_dir = os.path.join(caps_dir, 'subjects', participant_id, 'ses-M00', 't1', 'preprocessing_dl')
+        os.makedirs(image_dir)
+        save_image(random_image(i), os.path.join(image_dir, participant_id + '_ses-M00_space-MNI_res-1x1x1.pt'))
+
+    return pd.DataFrame({'participant_id': participant_ids, 'session_id': ['ses-M00'] * n_sessions,
+                         'diagnosis': ['AD', 'CN'] * (n_sessions // 2)})
+
+
+@pytest.mark.parametrize('transform', [None, MinMaxNormalization()])
+def test_cohort_dataset(tmp_path, monkeypatch, transform):
+    caps_dir = str(tmp_path / 'caps')
+    df = write_caps(caps_dir, 4)
+    cohort_path = str(tmp_path / 'cohort.npy')
+    pack_cohort(caps_dir, df, cohort_path)
+
+    dataset = MRIDataset(caps_dir, df, transform=transform, cohort_path=cohort_path)
+    reference_dataset = MRIDataset(caps_dir, df, transform=transform)
+    for idx in range(len(dataset)):
+        assert torch.equal(dataset[idx]['image'], reference_dataset[idx]['image'])
+
+    # the memory map is not sent to the workers
+    assert dataset._cohort_array is not None
+    assert pickle.loads(pickle.dumps(dataset))._cohort_array is None
+
+    # the size is read from the header of the cohort array, no image is loaded
+    def fail(self, idx):
+        raise AssertionError("An image was loaded to compute the size of the dataset.")
+    monkeypatch.setattr(MRIDataset, '__getitem__', fail)
+    assert dataset.size == random_image(0).numel()
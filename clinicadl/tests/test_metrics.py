@@ -0,0 +1,122 @@
+import numpy as np
+import pytest
+from clinicadl.tools.deep_learning.metrics import confusion_matrix, evaluate_prediction, RunningMetrics
+
+
+def reference_metrics(y, y_pred):
+    """Loop implementation of the binary metrics which was used before confusion_matrix."""
+    y, y_pred = np.asarray(y), np.asarray(y_pred)
+    true_positive = np.sum((y_pred == 1) & (y == 1))
+    true_negative = np.sum((y_pred == 0) & (y == 0))
+    false_positive = np.sum((y_pred == 1) & (y == 0))
+    false_negative = np.sum((y_pred == 0) & (y == 1))
+
+    def divide(numerator, denominator):
+        return numerator / denominator if denominator != 0 else 0.0
+
+    sensitivity = divide(true_positive, true_positive + false_negative)
+    specificity = divide(true_negative, false_positive + true_negative)
+    return {'accuracy': divide(true_positive + true_negative, len(y)),
+            'balanced_accuracy': (sensitivity + specificity) / 2,
+            'sensitivity': sensitivity,
+            'specificity': specificity,
+            'ppv': divide(true_positive, true_positive + false_positive),
+            'npv': divide(true_negative, true_negative + false_negative),
+            'confusion_matrix': {'tp': int(true_positive), 'tn': int(true_negative),
+                                 'fp': int(false_positive), 'fn': int(false_negative)}}
+
+
+def test_binary_counts():
+    y = [1, 1, 1, 0, 0, 0, 0]
+    y_hat = [1, 1, 0, 0, 0, 1, 0]
+
+    matrix = confusion_matrix(y, y_hat)
+    np.testing.assert_array_equal(matrix, [[3, 1], [1, 2]])
+
+    metrics = evaluate_prediction(y, y_hat)
+    assert metrics['confusion_matrix'] == {'tp': 2, 'tn': 3, 'fp': 1, 'fn': 1}
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_binary_matches_reference(seed):
+    rng = np.random.RandomState(seed)
+    y = rng.randint(0, 2, size=50)
+    y_hat = rng.randint(0, 2, size=50)
+
+    metrics = evaluate_prediction(y, y_hat)
+    expected = reference_metrics(y, y_hat)
+    assert metrics['confusion_matrix'] == expected.pop('confusion_matrix')
+    for key, value in expected.items():
+        assert metrics[key] == pytest.approx(value)
+
+
+@pytest.mark.parametrize('y, y_hat', [
+    ([0, 0, 0], [0, 0, 0]),  # no positive sample and no positive prediction
+    ([1, 1, 1], [1, 1, 1]),  # no negative sample and no negative prediction
+    ([1, 1], [0, 0]),
+    ([0, 0], [1, 1]),
+])
+def test_zero_denominators(y, y_hat):
+    metrics = evaluate_prediction(y, y_hat)
+    expected = reference_metrics(y, y_hat)
+    expected.pop('confusion_matrix')
+    for key, value in expected.items():
+        assert metrics[key] == pytest.approx(value)
+        assert np.isfinite(metrics[key])
+
+
+def test_empty_prediction():
+    metrics = evaluate_prediction([], [])
+    assert metrics['accuracy'] == 0.0
+    assert metrics['confusion_matrix'] == {'tp': 0, 'tn': 0, 'fp': 0, 'fn': 0}
+
+
+def test_multi_class():
+    y = [0, 0, 1, 1, 2, 2]
+    y_hat = [0, 1, 1, 1, 2, 0]
+
+    matrix = confusion_matrix(y, y_hat, n_classes=3)
+    np.testing.assert_array_equal(matrix, [[1, 1, 0], [0, 2, 0], [1, 0, 1]])
+
+    metrics = evaluate_prediction(y, y_hat, n_classes=3)
+    assert metrics['accuracy'] == pytest.approx(4 / 6)
+    # the balanced accuracy is the mean of the recalls of the classes
+    assert metrics['balanced_accuracy'] == pytest.approx((1 / 2 + 1 + 1 / 2) / 3)
+    assert metrics['sensitivity'] == metrics['balanced_accuracy']
+    # specificities one-vs-rest: class 0 3/4, class 1 3/4, class 2 4/4
+    assert metrics['specificity'] == pytest.approx((3 / 4 + 3 / 4 + 1) / 3)
+    assert metrics['confusion_matrix'] == matrix.tolist()
+
+
+def test_groups():
+    y = np.array([1, 0, 1, 1, 0, 0])
+    y_hat = np.array([1, 1, 0, 1, 0, 0])
+    groups = np.array(['b', 'a', 'b', 'a', 'a', 'c'])
+
+    matrices = confusion_matrix(y, y_hat, groups=groups)
+    assert matrices.shape == (3, 2, 2)
+    for i, group in enumerate(['a', 'b', 'c']):
+        np.testing.assert_array_equal(matrices[i], confusion_matrix(y[groups == group], y_hat[groups == group]))
+
+    grouped_metrics = evaluate_prediction(y, y_hat, groups=groups)
+    assert sorted(grouped_metrics.keys()) == ['a', 'b', 'c']
+    for group, metrics in grouped_metrics.items():
+        assert metrics == evaluate_prediction(y[groups == group], y_hat[groups == group])
+
+
+def test_running_metrics():
+    running_metrics = RunningMetrics()
+    running_metrics.update(np.array([1, 0]), np.array([1, 1]), 0.5)
+    running_metrics.update(np.array([0, 1, 1]), np.array([0, 0, 1]), 1.5)
+
+    assert running_metrics.evaluate() == evaluate_prediction([1, 0, 0, 1, 1], [1, 1, 0, 0, 1])
+
+
+@pytest.mark.parametrize('y, y_hat', [
+    ([0, -1], [0, 1]),  # unlabeled session
+    ([0, 1], [0, 2]),
+    ([0, 1], [0]),
+])
+def test_invalid_labels(y, y_hat):
+    with pytest.raises(ValueError):
+        confusion_matrix(y, y_hat)
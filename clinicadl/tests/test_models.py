@@ -0,0 +1,79 @@
+import pytest
+import torch
+from clinicadl.tools.deep_learning.models import Conv4_FC3, MultiConv4_FC3
+
+
+def random_conv4_fc3_state(seed):
+    """Builds a Conv4_FC3 whose weights and batch normalization statistics are all random."""
+    torch.manual_seed(seed)
+    model = Conv4_FC3()
+    state = model.state_dict()
+    for key, value in state.items():
+        if key.endswith('running_var'):
+            state[key] = torch.rand_like(value) + 0.5
+        elif value.is_floating_point():
+            state[key] = 0.1 * torch.randn_like(value)
+    return state
+
+
+def test_heads_round_trip():
+    n_heads = 3
+    head_states = [random_conv4_fc3_state(seed) for seed in range(n_heads)]
+
+    multi_model = MultiConv4_FC3(n_heads)
+    multi_model.load_heads(head_states)
+    multi_model.eval()
+
+    torch.manual_seed(0)
+    patches = torch.randn(2, n_heads, 50, 50, 50)
+    with torch.no_grad():
+        multi_outputs = multi_model(patches)
+    assert multi_outputs.shape == (2, n_heads, 2)
+
+    for i, head_state in enumerate(head_states):
+        exported_state = multi_model.export_head(i)
+        assert sorted(exported_state.keys()) == sorted(head_state.keys())
+        for key, value in head_state.items():
+            assert exported_state[key].shape == value.shape, key
+            assert torch.equal(exported_state[key], value), key
+
+        # the exported head is a plain Conv4_FC3 checkpoint, as written in the cnn-%i folders
+        model = Conv4_FC3()
+        model.load_state_dict(exported_state)
+        model.eval()
+        with torch.no_grad():
+            outputs = model(patches[:, i:i + 1])
+        assert torch.allclose(multi_outputs[:, i], outputs, rtol=1e-4, atol=1e-5)
+
+
+def test_load_heads_checks_number_of_states():
+    with pytest.raises(ValueError):
+        MultiConv4_FC3(2).load_heads([Conv4_FC3().state_dict()])
+
+
+def test_export_head_optimizer():
+    n_heads = 2
+    multi_model = MultiConv4_FC3(n_heads)
+    multi_model.load_heads([random_conv4_fc3_state(seed) for seed in range(n_heads)])
+    optimizer = torch.optim.Adam(multi_model.parameters(), lr=1e-3)
+
+    torch.manual_seed(0)
+    outputs = multi_model(torch.randn(2, n_heads, 50, 50, 50))
+    torch.nn.functional.cross_entropy(outputs.view(-1, 2), torch.tensor([0, 1, 1, 0])).backward()
+    optimizer.step()
+
+    for i in range(n_heads):
+        model = Conv4_FC3()
+        model.load_state_dict(multi_model.export_head(i))
+        head_optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+        head_optimizer.load_state_dict(multi_model.export_head_optimizer(optimizer, i))
+
+        # the moments of each parameter of the head are the slices of the moments of the multi-head model
+        multi_parameters = dict(multi_model.named_parameters())
+        for name, parameter in model.named_parameters():
+            head_state = head_optimizer.state[parameter]
+            multi_state = optimizer.state[multi_parameters[name]]
+            for key in ['exp_avg', 'exp_avg_sq']:
+                assert head_state[key].shape == parameter.shape, name
+                assert torch.equal(head_state[key], multi_model._head_value(name, multi_state[key], i)), name
+            assert float(head_state['step']) == float(multi_state['step'])
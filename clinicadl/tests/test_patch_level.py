@@ -0,0 +1,38 @@
+import os
+import pandas as pd
+import torch
+from clinicadl.tools.deep_learning.data import save_image
+from clinicadl.patch_level.utils import MRIDataset_patch, extract_patch_from_mri
+
+
+def write_caps(caps_dir, image):
+    """Writes image as the preprocessing_dl output of one session of a CAPS directory."""
+    image_dir = os.path.join(caps_dir, 'subjects', 'sub-01', 'ses-M00', 't1', 'preprocessing_dl')
+    os.makedirs(image_dir)
+    save_image(image, os.path.join(image_dir, 'sub-01_ses-M00_space-MNI_res-1x1x1.pt'))
+
+    return pd.DataFrame({'participant_id': ['sub-01'], 'session_id': ['ses-M00'], 'diagnosis': ['AD']})
+
+
+def test_extract_patch_is_a_copy():
+    image = torch.randn(1, 8, 8, 8)
+    original_image = image.clone()
+
+    patch = extract_patch_from_mri(image, 1, 4, 4)
+    assert torch.equal(patch, image[:, :4, :4, 4:])
+    patch.fill_(0)
+    assert torch.equal(image, original_image)
+
+
+def test_cached_image_is_not_modified(tmp_path):
+    image = torch.randn(1, 8, 8, 8)
+    image[0, 0, 0, 0] = float('nan')
+    df = write_caps(str(tmp_path), image)
+
+    dataset = MRIDataset_patch(str(tmp_path), df, 4, 4, cache_size=10 ** 6)
+    assert torch.equal(dataset[0]['image'][0, 0, 0, 0], torch.tensor(0.))
+
+    # the NaN of the patch is replaced in the patch only, not in the image shared with the other patches
+    cached_image = dataset.image_cache.load(os.path.join(str(tmp_path), 'subjects', 'sub-01', 'ses-M00', 't1',
+                                                         'preprocessing_dl', 'sub-01_ses-M00_space-MNI_res-1x1x1.pt'))
+    assert torch.isnan(cached_image[0, 0, 0, 0])
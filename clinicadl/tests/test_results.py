@@ -0,0 +1,108 @@
+import numpy as np
+import pandas as pd
+import pytest
+from clinicadl.tools.deep_learning.results import vote
+
+
+def reference_vote(performance_df, validation_df, id_column, method='soft', selection_threshold=None):
+    """Loop implementation of the soft voting which was used before vote, extended to the hard voting."""
+    right_classified_df = validation_df[validation_df['true_label'] == validation_df['predicted_label']]
+    n_valid = len(validation_df.groupby(['participant_id', 'session_id']).nunique())
+    accuracies = right_classified_df[id_column].value_counts() / n_valid
+    if selection_threshold is not None:
+        accuracies[accuracies < selection_threshold] = 0
+    weight_series = accuracies / accuracies.sum()
+
+    rows = []
+    for (participant_id, session_id), session_df in performance_df.groupby(['participant_id', 'session_id']):
+        scores = [0.0, 0.0]
+        for _, row in session_df.iterrows():
+            weight = weight_series[row[id_column]] if row[id_column] in weight_series.index else 0.0
+            if method == 'soft':
+                scores[0] += weight * row['proba0']
+                scores[1] += weight * row['proba1']
+            else:
+                scores[int(row['predicted_label'])] += weight
+        rows.append([participant_id, session_id, int(session_df['true_label'].iloc[0]),
+                     scores.index(max(scores))])
+
+    return pd.DataFrame(rows, columns=['participant_id', 'session_id', 'true_label', 'predicted_label'])
+
+
+def random_results(seed, n_sessions=6, n_samples=5):
+    """Builds the sample level results of n_sessions sessions of n_samples samples."""
+    rng = np.random.RandomState(seed)
+    participant_id = np.repeat(['sub-%02i' % (i // 2) for i in range(n_sessions)], n_samples)
+    session_id = np.repeat(['ses-M%02i' % (i % 2) for i in range(n_sessions)], n_samples)
+    true_label = np.repeat(rng.randint(0, 2, size=n_sessions), n_samples)
+    proba1 = rng.uniform(size=n_sessions * n_samples)
+
+    return pd.DataFrame({'participant_id': participant_id,
+                         'session_id': session_id,
+                         'slice_id': np.tile(np.arange(n_samples), n_sessions),
+                         'true_label': true_label,
+                         'predicted_label': (proba1 > 0.5).astype(int),
+                         'proba0': 1 - proba1,
+                         'proba1': proba1})
+
+
+def validation_results(seed, n_sessions=6, n_samples=5):
+    """
+    Builds validation results in which the slice k is well classified in k + 1 sessions, so that the weights
+    of the slices are all different and the hard votes cannot be tied.
+    """
+    validation_df = random_results(seed, n_sessions, n_samples)
+    session_index = np.repeat(np.arange(n_sessions), n_samples)
+    right_classified = session_index <= validation_df.slice_id.values
+    validation_df['predicted_label'] = np.where(right_classified, validation_df.true_label,
+                                                1 - validation_df.true_label)
+
+    return validation_df
+
+
+@pytest.mark.parametrize('method', ['soft', 'hard'])
+@pytest.mark.parametrize('selection_threshold', [None, 0.5])
+@pytest.mark.parametrize('seed', range(3))
+def test_vote_matches_reference(method, selection_threshold, seed):
+    performance_df = random_results(seed)
+    validation_df = validation_results(seed + 100)
+
+    df_final = vote(performance_df, validation_df, 'slice_id', method=method,
+                    selection_threshold=selection_threshold)
+    expected_df = reference_vote(performance_df, validation_df, 'slice_id', method=method,
+                                 selection_threshold=selection_threshold)
+
+    pd.testing.assert_frame_equal(df_final.reset_index(drop=True), expected_df, check_dtype=False)
+
+
+def test_never_well_classified_sample_has_null_weight():
+    validation_df = random_results(0, n_samples=2)
+    # the slice 1 is never well classified on the validation set
+    is_slice_1 = validation_df.slice_id == 1
+    validation_df.loc[is_slice_1, 'predicted_label'] = 1 - validation_df.loc[is_slice_1, 'true_label']
+    validation_df.loc[~is_slice_1, 'predicted_label'] = validation_df.loc[~is_slice_1, 'true_label']
+
+    performance_df = random_results(1, n_samples=2)
+    # the slice 1 is confident and wrong, the slice 0 is right
+    performance_df['proba1'] = np.where(performance_df.slice_id == 1, 1 - performance_df.true_label,
+                                        performance_df.true_label).astype(float)
+    performance_df['proba0'] = 1 - performance_df['proba1']
+    performance_df['predicted_label'] = (performance_df['proba1'] > 0.5).astype(int)
+
+    for method in ['soft', 'hard']:
+        df_final = vote(performance_df, validation_df, 'slice_id', method=method)
+        np.testing.assert_array_equal(df_final.predicted_label.values, df_final.true_label.values)
+
+
+def test_unknown_method():
+    results_df = random_results(0)
+    with pytest.raises(ValueError):
+        vote(results_df, results_df, 'slice_id', method='majority')
+
+
+@pytest.mark.parametrize('predicted_label', [-1, 2])
+def test_hard_vote_invalid_labels(predicted_label):
+    performance_df = random_results(0)
+    performance_df.loc[3, 'predicted_label'] = predicted_label
+    with pytest.raises(ValueError):
+        vote(performance_df, validation_results(1), 'slice_id', method='hard')
@@ -0,0 +1,59 @@
+import argparse
+import os
+import pandas as pd
+import pytest
+import torch
+from torch.utils.data import DataLoader
+from clinicadl.subject_level.utils import train, test
+
+
+def random_sessions(n_sessions, seed=0):
+    """Builds sessions whose label is 1 if the second feature of the image is larger than the first one."""
+    torch.manual_seed(seed)
+    sessions = []
+    for i in range(n_sessions):
+        image = torch.randn(4)
+        sessions.append({'participant_id': 'sub-%02i' % i,
+                         'session_id': 'ses-M00',
+                         'image': image,
+                         'label': int(image[1] > image[0])})
+    return sessions
+
+
+def training_options(output_dir, batch_size, evaluation_steps):
+    return argparse.Namespace(output_dir=output_dir, split=0, epochs=1, tolerance=0.0, patience=10,
+                              gpu=False, precision='fp32', batch_size=batch_size, accumulation_steps=1,
+                              evaluation_steps=evaluation_steps, train_probe_size=0, train_probe_frequency=1,
+                              optimizer='SGD')
+
+
+@pytest.mark.parametrize('evaluation_steps', [1, 2, 3])
+def test_end_of_epoch_metrics(tmp_path, evaluation_steps):
+    batch_size = 2
+    train_loader = DataLoader(random_sessions(12), batch_size=batch_size, shuffle=False)
+    valid_loader = DataLoader(random_sessions(4, seed=1), batch_size=batch_size, shuffle=False)
+
+    # the model predicts the class of the largest of the two first features, so it classifies all the sessions
+    model = torch.nn.Linear(4, 2)
+    with torch.no_grad():
+        model.weight.copy_(torch.tensor([[1., 0., 0., 0.], [0., 1., 0., 0.]]))
+        model.bias.zero_()
+    criterion = torch.nn.CrossEntropyLoss()
+    # the model is not updated, so that the metrics of the epoch are those of the model on the training set
+    optimizer = torch.optim.SGD(model.parameters(), lr=0)
+
+    options = training_options(str(tmp_path), batch_size, evaluation_steps)
+    train(model, train_loader, valid_loader, criterion, optimizer, False, options)
+
+    expected_accuracy, total_loss = test(model, train_loader, False, criterion)
+    expected_loss = total_loss / (len(train_loader) * batch_size)
+    assert expected_accuracy == 1
+    assert expected_loss > 0
+
+    training_df = pd.read_csv(os.path.join(str(tmp_path), 'log_dir', 'fold_0', 'CNN', 'training.tsv'), sep='\t')
+    assert len(training_df) == len(train_loader) // evaluation_steps + 1
+    # the last row is written at the end of the epoch, just after an evaluation when evaluation_steps divides
+    # the number of batches
+    end_of_epoch = training_df.iloc[-1]
+    assert end_of_epoch.acc_train == pytest.approx(expected_accuracy)
+    assert end_of_epoch.mean_loss_train == pytest.approx(expected_loss, rel=1e-5)